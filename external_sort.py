@@ -0,0 +1,196 @@
+import numpy
+import os
+import tempfile
+
+__author__ = 'jontedesco'
+
+# Ids are spilled to disk as fixed-width (little-endian, signed 64-bit) integers, so only compact ids can be spilled
+id_dtype = numpy.dtype('<i8')
+
+# Counts of ordinals are spilled as fixed-width (little-endian, signed 64-bit) integers, like those of numpy.bincount
+count_dtype = numpy.dtype('<i8')
+
+
+def ids_for_budget(memory_budget):
+    """
+      Get how many ids to hold in memory at once, for the given memory budget (in bytes). Sorting or merging a buffer of
+      ids takes a few copies of it, so only a fraction of the budget holds ids.
+    """
+
+    return max(1, memory_budget // (4 * id_dtype.itemsize))
+
+
+def map_ids(path, dtype=id_dtype):
+    """
+      Memory-map a file of fixed-width ids (read-only), or return an empty array if it's empty
+    """
+
+    if not os.path.getsize(path):
+        return numpy.zeros(0, dtype=dtype)
+    return numpy.memmap(path, dtype=dtype, mode='r')
+
+
+def create_map(path, length, dtype=id_dtype):
+    """
+      Create a file of the given number of fixed-width values (all 0), memory-mapped for writing (or just create the
+      file & return an empty array, if there are none)
+    """
+
+    if not length:
+        open(path, 'wb').close()
+        return numpy.zeros(0, dtype=dtype)
+    return numpy.memmap(path, dtype=dtype, mode='w+', shape=(length,))
+
+
+class RunWriter(object):
+    """
+      Buffers ids in memory, spilling them to a new sorted run file in the given folder whenever the buffer is full
+    """
+
+    def __init__(self, folder, buffer_size):
+        self.folder = folder
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.buffered = 0
+        self.run_paths = []
+
+    def add(self, ids):
+        """
+          Add an array of ids to the next run
+        """
+
+        if ids.dtype == object:
+            raise ValueError("Only fixed-width (compact) ids can be spilled to disk")
+
+        self.buffer.append(ids)
+        self.buffered += len(ids)
+        if self.buffered >= self.buffer_size:
+            self.spill()
+
+    def spill(self):
+        """
+          Sort the buffered ids & write them out as a run
+        """
+
+        if not self.buffered:
+            return
+
+        ids = numpy.concatenate(self.buffer).astype(id_dtype)
+        self.buffer = []
+        self.buffered = 0
+        ids.sort()
+
+        run_fd, run_path = tempfile.mkstemp('.run', 'ids-', self.folder)
+        with os.fdopen(run_fd, 'wb') as run_file:
+            ids.tofile(run_file)
+        self.run_paths.append(run_path)
+
+    def close(self):
+        """
+          Spill any ids left in the buffer, returning the paths to all runs written
+        """
+
+        self.spill()
+        return self.run_paths
+
+
+def __read_run(run_path, block_size):
+    """
+      Generator over the blocks of ids in a run file, reading one block at a time
+    """
+
+    run = map_ids(run_path)
+    for start in xrange(0, len(run), block_size):
+        yield numpy.array(run[start:start + block_size])
+
+
+def merge_runs(run_paths, block_size):
+    """
+      Generator over blocks of ids in sorted order, k-way merged from sorted run files while holding just one block of
+      each run in memory. Each round emits every buffered id up to the smallest of the last ids of the buffered blocks
+      (so at least one block is used up each round), since no id still on disk can be smaller.
+    """
+
+    blocks = []
+    for run_path in run_paths:
+        run = __read_run(run_path, block_size)
+        block = next(run, None)
+        if block is not None:
+            blocks.append((block, run))
+
+    while blocks:
+        bound = min(block[-1] for block, run in blocks)
+
+        merged = []
+        remaining_blocks = []
+        for block, run in blocks:
+            split = numpy.searchsorted(block, bound, side='right')
+            merged.append(block[:split])
+
+            # Read the next block of this run if this one was used up
+            if split == len(block):
+                block = next(run, None)
+                if block is None:
+                    continue
+            else:
+                block = block[split:]
+            remaining_blocks.append((block, run))
+        blocks = remaining_blocks
+
+        yield numpy.sort(numpy.concatenate(merged), kind='mergesort')
+
+
+def find_collisions(run_paths, folder, block_size):
+    """
+      Merge sorted runs of ids, writing the sorted unique ids & the ids found more than once to files in the given
+      folder. Returns both as read-only memory maps (which can be searched like in-memory arrays), along with the number
+      of repeated ids, like id_arrays.find_collisions.
+    """
+
+    unique_path = os.path.join(folder, 'unique.ids')
+    collisions_path = os.path.join(folder, 'collisions.ids')
+    repeat_count = 0
+
+    with open(unique_path, 'wb') as unique_file, open(collisions_path, 'wb') as collisions_file:
+
+        # The last id of each block is held back, in case the next block starts with more copies of it
+        last_id = None
+        last_count = 0
+        for block in merge_runs(run_paths, block_size):
+            ids, counts = numpy.unique(block, return_counts=True)
+            if last_id is not None:
+                if ids[0] == last_id:
+                    counts[0] += last_count
+                else:
+                    ids = numpy.concatenate(([last_id], ids))
+                    counts = numpy.concatenate(([last_count], counts))
+
+            ids[:-1].tofile(unique_file)
+            ids[:-1][counts[:-1] > 1].tofile(collisions_file)
+            repeat_count += int((counts[:-1] - 1).sum())
+            last_id = ids[-1]
+            last_count = counts[-1]
+
+        if last_id is not None:
+            ids = numpy.array([last_id], dtype=id_dtype)
+            ids.tofile(unique_file)
+            if last_count > 1:
+                ids.tofile(collisions_file)
+            repeat_count += int(last_count - 1)
+
+    return map_ids(unique_path), map_ids(collisions_path), repeat_count
+
+
+def bincount(ordinals, minlength, block_size, path):
+    """
+      Count the occurrences of each ordinal in an array (or memory map) of ordinals, a block at a time, into a file of
+      counts at the given path (returned as a read-only memory map). Each block only adds to the counts of the ordinals
+      found in it, so no array of counts is ever held in memory.
+    """
+
+    counts = create_map(path, minlength, count_dtype)
+    for start in xrange(0, len(ordinals), block_size):
+        block_ordinals, block_counts = numpy.unique(ordinals[start:start + block_size], return_counts=True)
+        counts[block_ordinals] += block_counts
+    del counts
+    return map_ids(path, count_dtype)
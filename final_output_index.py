@@ -0,0 +1,172 @@
+import external_sort
+import mmap
+import numpy
+import os
+import struct
+
+__author__ = 'jontedesco'
+
+# The index of a final output file is a header (a magic string, and the number of papers), followed by three blocks of
+# fixed-width little-endian fields, one entry per paper, sorted by paper id:
+#   paper ids (int64) | byte offset of each paper's record (uint64) | length of each paper's record (uint32)
+# Each block can be memory-mapped straight into an array, so a paper is found with one binary search over its id.
+index_header = struct.Struct('<8sQ')
+index_magic = 'AMINDEX1'
+index_suffix = '.idx'
+field_dtypes = [numpy.dtype('<i8'), numpy.dtype('<u8'), numpy.dtype('<u4')]
+
+
+def index_path_for(output_path):
+    """
+      Get the path to the index of the given final output file
+    """
+
+    return output_path + index_suffix
+
+
+class IndexWriter(object):
+    """
+      Writes the index of a final output file as papers are written to it (in any order), given the sorted unique ids of
+      every paper that may be written. The offset & record length of each paper written are kept at its position in
+      those ids (in memory, or in memory-mapped files in the given folder), and the entries of the papers written are
+      copied into the index in order, a block at a time, when it's closed.
+    """
+
+    def __init__(self, output_path, paper_ids, folder=None, block_size=None):
+        self.output_path = output_path
+        self.paper_ids = paper_ids
+        self.block_size = block_size or max(1, len(paper_ids))
+        if folder is None:
+            self.offsets = numpy.zeros(len(paper_ids), field_dtypes[1])
+            self.lengths = numpy.zeros(len(paper_ids), field_dtypes[2])
+        else:
+            self.offsets = external_sort.create_map(os.path.join(folder, 'offsets.index'), len(paper_ids),
+                                                    field_dtypes[1])
+            self.lengths = external_sort.create_map(os.path.join(folder, 'lengths.index'), len(paper_ids),
+                                                    field_dtypes[2])
+        self.paper_count = 0
+        self.output_length = numpy.uint64(0)
+
+    def add(self, positions, record_lengths):
+        """
+          Add the entries of papers just written to the end of the output file, given their positions in the paper ids &
+          the lengths of their records (records are never empty, so papers not written keep a length of 0)
+        """
+
+        record_ends = numpy.cumsum(record_lengths, dtype=numpy.uint64) + self.output_length
+        self.offsets[positions] = record_ends - record_lengths.astype(numpy.uint64)
+        self.lengths[positions] = record_lengths
+        self.paper_count += len(positions)
+        if len(positions):
+            self.output_length = record_ends[-1]
+
+    def close(self):
+        """
+          Atomically write the index, from the entries of the papers written
+        """
+
+        index_path = index_path_for(self.output_path)
+        with open(index_path + '.partial', 'wb') as index_file:
+            index_file.write(index_header.pack(index_magic, self.paper_count))
+            for field, dtype in zip([self.paper_ids, self.offsets, self.lengths], field_dtypes):
+                for start in xrange(0, len(self.paper_ids), self.block_size):
+                    is_written = self.lengths[start:start + self.block_size] > 0
+                    field[start:start + self.block_size][is_written].astype(dtype).tofile(index_file)
+        os.rename(index_path + '.partial', index_path)
+
+
+def record_references(record):
+    """
+      Get the ids of the papers referenced by a record of the final output
+    """
+
+    return [int(line[len('#%'):]) for line in record.split('\n') if line.startswith('#%')]
+
+
+class OutputIndex(object):
+    """
+      Random access to the records of a final output file by paper id, through its memory-mapped index
+    """
+
+    def __init__(self, output_path, index_path=None):
+        index_path = index_path or index_path_for(output_path)
+        with open(index_path, 'rb') as index_file:
+            magic, paper_count = index_header.unpack(index_file.read(index_header.size))
+        if magic != index_magic:
+            raise ValueError("'%s' is not a final output index" % index_path)
+
+        # Map each block of the index
+        self.fields = []
+        block_offset = index_header.size
+        for dtype in field_dtypes:
+            if paper_count:
+                self.fields.append(numpy.memmap(index_path, dtype, 'r', block_offset, (paper_count,)))
+            else:
+                self.fields.append(numpy.zeros(0, dtype))
+            block_offset += dtype.itemsize * paper_count
+        self.paper_ids, self.offsets, self.lengths = self.fields
+
+        self.output_file = open(output_path, 'rb')
+        self.output = mmap.mmap(self.output_file.fileno(), 0, access=mmap.ACCESS_READ) if paper_count else ''
+
+    def __len__(self):
+        return len(self.paper_ids)
+
+    def positions(self, paper_ids):
+        """
+          Find the position in the index of each of the given paper ids, or -1 for those not found (including ids out of
+          the range of indexed ids, like full 160-bit ids)
+        """
+
+        paper_ids = numpy.asarray(paper_ids)
+        if paper_ids.dtype.kind == 'i':
+            is_in_range = numpy.ones(len(paper_ids), dtype=bool)
+        else:
+            id_range = numpy.iinfo(field_dtypes[0])
+            is_in_range = numpy.array([id_range.min <= paper_id <= id_range.max for paper_id in paper_ids.tolist()],
+                                      dtype=bool)
+        compact_ids = numpy.zeros(len(paper_ids), dtype=field_dtypes[0])
+        compact_ids[is_in_range] = paper_ids[is_in_range]
+        if not len(self.paper_ids):
+            return numpy.zeros(len(paper_ids), dtype=numpy.int64) - 1
+
+        positions = numpy.searchsorted(self.paper_ids, compact_ids)
+        positions[positions == len(self.paper_ids)] = 0
+        positions[(self.paper_ids[positions] != compact_ids) | ~is_in_range] = -1
+        return positions
+
+    def lookup_all(self, paper_ids):
+        """
+          Get the records of the given papers (None for papers not found), with one batch of binary searches
+        """
+
+        records = []
+        for position in self.positions(paper_ids).tolist():
+            if position < 0:
+                records.append(None)
+            else:
+                offset = int(self.offsets[position])
+                records.append(self.output[offset:offset + int(self.lengths[position])])
+        return records
+
+    def lookup(self, paper_id):
+        """
+          Get the record of the given paper, or None if it isn't found
+        """
+
+        return self.lookup_all([paper_id])[0]
+
+    def references(self, paper_id):
+        """
+          Get the records of the papers referenced by the given paper (or None if the paper isn't found)
+        """
+
+        record = self.lookup(paper_id)
+        if record is None:
+            return None
+        return self.lookup_all(record_references(record))
+
+    def close(self):
+        if len(self.paper_ids):
+            self.output.close()
+        self.output_file.close()
@@ -0,0 +1,55 @@
+import hashlib
+import struct
+
+__author__ = 'jontedesco'
+
+# Whether paper ids are compact 63-bit fingerprints (which fit in a machine word, and a signed 64-bit field), rather
+# than the full 160-bit SHA-1 of each paper's key. Compact ids are the low 63 bits of the full ids, so they are just as
+# stable across runs, and can be derived from the full ids of older output.
+compact_fingerprints = True
+compact_fingerprint_mask = (1 << 63) - 1
+
+
+def id_format():
+    """
+      Name the kind of ids being generated, so output using different kinds of ids is never mixed
+    """
+
+    return 'sha1-63' if compact_fingerprints else 'sha1-160'
+
+
+def fingerprint(key):
+    """
+      Calculate the id for the given (ascii) key
+    """
+
+    digest = hashlib.sha1(key).digest()
+    if compact_fingerprints:
+        return struct.unpack('>Q', digest[-8:])[0] & compact_fingerprint_mask
+    return int(digest.encode('hex'), 16)
+
+
+class CollisionAudit(object):
+    """
+      Remembers the key behind each id, to count ids shared by different keys (rather than repeats of the same key)
+    """
+
+    def __init__(self):
+        self.keys = {}
+        self.ids_checked = 0
+        self.collisions = 0
+        self.colliding_ids = set()
+
+    def check(self, paper_id, key):
+        """
+          Record the key behind the given id, returning whether a different key already had the same id
+        """
+
+        self.ids_checked += 1
+        first_key = self.keys.setdefault(paper_id, key)
+        if first_key == key:
+            return False
+
+        self.collisions += 1
+        self.colliding_ids.add(paper_id)
+        return True
@@ -0,0 +1,81 @@
+import numpy
+import os
+import first_pass_manifest
+import id_arrays
+
+__author__ = 'jontedesco'
+
+# The report of paper ids shared by different papers across the whole corpus, one line per paper found with an id that
+# was already taken: the id, the zip file it was found in, and a zip file it was already found in
+collision_report_path = os.path.join(first_pass_manifest.intermediate_results_folder, 'collisions.txt')
+
+
+def read_id_run(zip_file, folder=first_pass_manifest.intermediate_results_folder):
+    """
+      Read the sorted run of paper ids written alongside the shard of the given zip file, or None if there isn't one
+    """
+
+    run_path = os.path.join(folder, first_pass_manifest.id_run_name(zip_file))
+    if not os.path.exists(run_path):
+        return None
+    return numpy.fromfile(run_path, dtype=first_pass_manifest.id_run_dtype)
+
+
+class CollisionDetector(object):
+    """
+      Finds paper ids shared by papers across all shards as each shard's run of ids arrives, appending them to a
+      collision report. The ids seen so far are kept in sorted levels of (at least) doubling size, like a log-structured
+      merge tree, so each new run is checked with one binary search per level, and each id is only merged into a bigger
+      level a logarithmic number of times.
+    """
+
+    def __init__(self, report_path=collision_report_path):
+        self.report_file = open(report_path, 'w')
+        self.levels = []
+        self.zip_files = []
+        self.ids_checked = 0
+        self.runs_checked = 0
+        self.collisions = 0
+        self.colliding_ids = set()
+
+    def add_run(self, zip_file, ids):
+        """
+          Check a sorted run of the paper ids found in a zip file against all ids seen so far (and itself), reporting
+          each paper whose id was already taken
+        """
+
+        shard_number = len(self.zip_files)
+        self.zip_files.append(zip_file)
+        self.runs_checked += 1
+        self.ids_checked += len(ids)
+
+        # Find ids already seen in each level (and which zip file they were seen in), then ids repeated in this run
+        is_taken = numpy.zeros(len(ids), dtype=bool)
+        taken_by = numpy.empty(len(ids), dtype=numpy.int32)
+        taken_by.fill(shard_number)
+        for level_ids, level_shards in self.levels:
+            is_found = id_arrays.in_sorted(level_ids, ids) & ~is_taken
+            taken_by[is_found] = level_shards[numpy.searchsorted(level_ids, ids[is_found])]
+            is_taken |= is_found
+        is_taken[1:] |= ids[1:] == ids[:-1]
+
+        for paper_id, taken_shard in zip(ids[is_taken].tolist(), taken_by[is_taken].tolist()):
+            self.collisions += 1
+            self.colliding_ids.add(paper_id)
+            self.report_file.write('%d\t%s\t%s\n' % (paper_id, zip_file, self.zip_files[taken_shard]))
+        self.report_file.flush()
+
+        # Merge this run into the levels no bigger than it, so there are only ever a logarithmic number of levels
+        shards = numpy.empty(len(ids), dtype=numpy.int32)
+        shards.fill(shard_number)
+        while self.levels and len(self.levels[-1][0]) <= len(ids):
+            level_ids, level_shards = self.levels.pop()
+            ids = numpy.concatenate((level_ids, ids))
+            shards = numpy.concatenate((level_shards, shards))
+            order = numpy.argsort(ids, kind='mergesort')
+            ids = ids[order]
+            shards = shards[order]
+        self.levels.append((ids, shards))
+
+    def close(self):
+        self.report_file.close()
@@ -0,0 +1,259 @@
+from collections import namedtuple
+import hashlib
+import os
+import struct
+import zipfile
+import fingerprints
+import intermediate_records
+
+__author__ = 'jontedesco'
+
+# Each zip file's papers are written to their own shard of intermediate output, which is only renamed into place (and
+# recorded in the manifest) once the whole zip file has been parsed
+intermediate_results_folder = 'intermediate_output'
+manifest_path = os.path.join(intermediate_results_folder, 'manifest.txt')
+partial_shard_suffix = '.partial'
+
+# Alongside each shard, the sorted ids of the papers in it are written as a run of little-endian signed 64-bit integers
+# (when ids are compact enough), so the master can check for ids shared across shards as they finish
+id_run_dtype = '<i8'
+
+# What the manifest records about each zip file, to tell whether it changed since its shard was written (and the kind of
+# paper ids in its shard, which must match across all shards)
+ManifestEntry = namedtuple('ManifestEntry', ['size', 'mtime', 'checksum', 'shard', 'id_format'])
+
+# The kind of paper ids in shards recorded before the manifest tracked them
+original_id_format = 'sha1-160'
+
+
+def shard_name(zip_file, binary=False):
+    """
+      Get the name of the shard of intermediate output (plain text or binary) for the given zip file
+    """
+
+    return '%s-%s' % (zip_file, intermediate_records.binary_suffix if binary else 'intermediate_output.txt')
+
+
+def id_run_name(zip_file):
+    """
+      Get the name of the run of paper ids for the given zip file's shard
+    """
+
+    return '%s-paper_ids.run' % zip_file
+
+
+def stats_name(zip_file):
+    """
+      Get the name of the file of parsing stats for the given zip file's shard
+    """
+
+    return '%s-stats.json' % zip_file
+
+
+def tallies_name(zip_file):
+    """
+      Get the name of the file of title & venue tallies for the given zip file's shard
+    """
+
+    return '%s-tallies.json' % zip_file
+
+
+def write_id_run(zip_file, paper_ids):
+    """
+      Atomically write the sorted run of the given paper ids for a zip file's shard
+    """
+
+    run_path = os.path.join(intermediate_results_folder, id_run_name(zip_file))
+    with open(run_path + partial_shard_suffix, 'wb') as run_file:
+        run_file.write(struct.pack('<%dq' % len(paper_ids), *sorted(paper_ids)))
+        run_file.flush()
+        os.fsync(run_file.fileno())
+    os.rename(run_path + partial_shard_suffix, run_path)
+
+
+def write_summary(name, summary):
+    """
+      Atomically write a summary of a zip file's shard (its parsing stats or tallies, see parse_stats.py) to the file of
+      the given name, as JSON
+    """
+
+    summary_path = os.path.join(intermediate_results_folder, name)
+    with open(summary_path + partial_shard_suffix, 'w') as summary_file:
+        summary_file.write(summary.to_json())
+        summary_file.flush()
+        os.fsync(summary_file.fileno())
+    os.rename(summary_path + partial_shard_suffix, summary_path)
+
+
+def open_shard(zip_file, binary=False):
+    """
+      Open a new shard of intermediate output for the given zip file, which isn't visible until it's committed
+    """
+
+    return open(os.path.join(intermediate_results_folder, shard_name(zip_file, binary) + partial_shard_suffix), 'wb')
+
+
+def discard_shard(shard_file):
+    """
+      Throw away a shard that was never committed
+    """
+
+    shard_file.close()
+    os.remove(shard_file.name)
+
+
+def zip_file_checksum(zip_file_path):
+    """
+      Checksum the contents of a zip file, from the name, CRC & size of each member in its central directory (so only
+      the end of the file has to be read)
+    """
+
+    zipped_file = zipfile.ZipFile(zip_file_path, 'r')
+    try:
+        checksum = hashlib.sha1()
+        for info in zipped_file.infolist():
+            checksum.update('%s\t%08x\t%d\n' % (info.filename, info.CRC & 0xffffffff, info.file_size))
+        return checksum.hexdigest()
+    finally:
+        zipped_file.close()
+
+
+def commit_shard(zip_file, zip_file_path, zip_file_stat, shard_file, paper_ids=None, stats=None, tallies=None):
+    """
+      Atomically move a finished shard into place (along with the run of its paper ids, its parsing stats & its tallies
+      of titles & venues, if given),
+      and record its zip file as complete in the manifest. The zip file's size & modification time should be taken
+      before it was parsed, so changes made while parsing it aren't missed.
+    """
+
+    if paper_ids is not None:
+        write_id_run(zip_file, paper_ids)
+    if stats is not None:
+        write_summary(stats_name(zip_file), stats)
+    if tallies is not None:
+        write_summary(tallies_name(zip_file), tallies)
+    shard_file.flush()
+    os.fsync(shard_file.fileno())
+    shard_file.close()
+    shard_path = shard_file.name[:-len(partial_shard_suffix)]
+    os.rename(shard_file.name, shard_path)
+    record_completed(zip_file, ManifestEntry(
+        zip_file_stat.st_size, int(zip_file_stat.st_mtime), zip_file_checksum(zip_file_path),
+        os.path.basename(shard_path), fingerprints.id_format()
+    ))
+
+
+def format_entry(zip_file, entry):
+    return '%s\t%d\t%d\t%s\t%s\t%s\n' % ((zip_file,) + tuple(entry))
+
+
+def record_completed(zip_file, entry):
+    """
+      Append a completed zip file to the manifest (in a single write, so concurrent slaves don't interleave lines)
+    """
+
+    manifest_fd = os.open(manifest_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+    try:
+        os.write(manifest_fd, format_entry(zip_file, entry))
+        os.fsync(manifest_fd)
+    finally:
+        os.close(manifest_fd)
+
+
+def read_manifest(folder=intermediate_results_folder):
+    """
+      Get the latest manifest entry for each zip file recorded as complete, skipping any whose shard is missing
+    """
+
+    manifest = {}
+    path = os.path.join(folder, os.path.basename(manifest_path))
+    if not os.path.exists(path):
+        return manifest
+
+    with open(path) as manifest_file:
+        for line in manifest_file:
+
+            # Ignore a last line cut short by a crash, or entries from before zip files were checksummed
+            fields = line.rstrip('\n').split('\t')
+            if not line.endswith('\n') or len(fields) not in {5, 6}:
+                continue
+            if len(fields) == 5:
+                fields.append(original_id_format)
+
+            zip_file, size, mtime, checksum, shard, id_format = fields
+            if os.path.exists(os.path.join(folder, shard)):
+                manifest[zip_file] = ManifestEntry(int(size), int(mtime), checksum, shard, id_format)
+            else:
+                manifest.pop(zip_file, None)
+
+    return manifest
+
+
+def is_unchanged(entry, zip_file_path):
+    """
+      Check whether a zip file is unchanged since the given manifest entry was recorded, only checksumming it if its
+      size or modification time changed. Returns the (possibly updated) entry if so, or None if the zip file changed
+      (or its shard has a different kind of paper ids than we're generating now).
+    """
+
+    if entry.id_format != fingerprints.id_format():
+        return None
+
+    zip_file_stat = os.stat(zip_file_path)
+    if zip_file_stat.st_size == entry.size and int(zip_file_stat.st_mtime) == entry.mtime:
+        return entry
+
+    try:
+        checksum = zip_file_checksum(zip_file_path)
+    except (zipfile.BadZipfile, IOError):
+        return None
+    if zip_file_stat.st_size == entry.size and checksum == entry.checksum:
+        return entry._replace(mtime=int(zip_file_stat.st_mtime))
+    return None
+
+
+def reconcile(data_path, zip_files):
+    """
+      Compare the manifest against the zip files now in the input data, dropping the shards of zip files that were
+      deleted or changed, and rewriting the manifest with just the zip files whose shards can be kept as they are.
+      Returns the zip files that still need to be parsed.
+    """
+
+    manifest = read_manifest()
+    zip_files_found = set(zip_files)
+    unchanged = {}
+    for zip_file, entry in manifest.iteritems():
+        if zip_file in zip_files_found:
+            entry = is_unchanged(entry, os.path.join(data_path, zip_file))
+            if entry is not None:
+                unchanged[zip_file] = entry
+                continue
+
+        # Drop the shard (and run of paper ids, stats & tallies) of a deleted or changed zip file
+        for path in [manifest[zip_file].shard, id_run_name(zip_file), stats_name(zip_file), tallies_name(zip_file)]:
+            path = os.path.join(intermediate_results_folder, path)
+            if os.path.exists(path):
+                os.remove(path)
+
+    # Atomically replace the manifest with its compacted version
+    with open(manifest_path + partial_shard_suffix, 'w') as manifest_file:
+        for zip_file in sorted(unchanged):
+            manifest_file.write(format_entry(zip_file, unchanged[zip_file]))
+        manifest_file.flush()
+        os.fsync(manifest_file.fileno())
+    os.rename(manifest_path + partial_shard_suffix, manifest_path)
+
+    return [zip_file for zip_file in zip_files if zip_file not in unchanged]
+
+
+def shard_paths(folder=intermediate_results_folder):
+    """
+      Get the paths to the shards of intermediate output recorded in the manifest found in the given folder (ordered by
+      zip file), or None if there is no manifest there
+    """
+
+    if not os.path.exists(os.path.join(folder, os.path.basename(manifest_path))):
+        return None
+
+    manifest = read_manifest(folder)
+    return [os.path.join(folder, manifest[zip_file].shard) for zip_file in sorted(manifest)]
@@ -1,115 +1,337 @@
-from _socket import AF_INET, SOCK_DGRAM
-import math
-import socket
+from collections import deque
+import argparse
+import first_pass_collisions
+import first_pass_manifest
+import multiprocessing
+import os
+import parse_stats
+import progress_metrics
+import raw_catalog
 import subprocess
 import select
+import stage_timers
 import sys
+import zip_prefetch
 
 __author__ = 'jontedesco'
 
-total_zip_files = 1052
-total_docs = 10454961
+# The path to the input data
+data_path = 'data'
+if not os.path.exists(data_path):
+    data_path = '/mnt/fcroot/full-arnetminer/data'
 
+# The number of times a zip file is handed out before giving up on it (e.g. if it keeps crashing slaves)
+max_attempts_per_zip_file = 3
 
-def output_total_progress(slave_progress):
+# The stats of every zip file finished (including those from earlier runs) are added up here as each one finishes, and
+# written out in full once they're all done
+aggregate_stats_path = os.path.join(first_pass_manifest.intermediate_results_folder, 'stats.json')
+aggregate_stats_message_path = os.path.join(first_pass_manifest.intermediate_results_folder, 'stats.txt')
+
+
+class Slave(object):
     """
-      Output the total parsing progress, given the progress for each slave
+      A slave parser process, the zip files handed to it that it hasn't finished yet (in the order it parses them,
+      reading ahead into those after the first), and its throughput from the metrics it sends while parsing
     """
 
-    total_zip_files_processed = 0
-    total_docs_processed = 0
+    def __init__(self, slave_id, tally_venues_and_titles=True, binary_output=False, catalog_path=None,
+                 prefetch_depth=zip_prefetch.default_depth, prefetch_budget=None):
+        self.slave_id = slave_id
+        self.process = subprocess.Popen([
+            "python",
+            "first_pass_slave_parser.py",  # Call the other python file
+            '--slave',  # Parse whatever zip files are handed out on stdin
+            str(slave_id),  # Name this slave's output files
+        ] + ([] if tally_venues_and_titles else ['--no-tally']) +  # Whether to tally most common titles and venues
+            (['--binary'] if binary_output else []) + (['--catalog', catalog_path] if catalog_path else []) +
+            ['--prefetch', str(prefetch_depth)] +
+            (['--prefetch-budget', str(prefetch_budget)] if prefetch_budget is not None else []),
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True)
+        self.zip_files = deque()
+        self.zip_files_processed = 0
+        self.docs_processed = 0
+        self.throughput = progress_metrics.Throughput(stage_timers.timer())
+        self.unread_output = ''
+
+    def fileno(self):
+        return self.process.stdout.fileno()
 
-    # Estimate the percent complete for each slave
-    slave_progress_percent = []
-    for i in xrange(0, len(slave_progress)):
+    def assign(self, zip_file):
+        """
+          Hand the next zip file to this slave (which only counts as stalled once it has had work for a while)
+        """
+        if not self.zip_files:
+            self.throughput.progressed(stage_timers.timer())
+        self.zip_files.append(zip_file)
+        try:
+            self.process.stdin.write(zip_file + '\n')
+            self.process.stdin.flush()
+        except IOError:
+            pass  # The slave already died, which is handled once its output is closed
 
-        j, zip_files_processed, zip_files_to_process, docs_processed = slave_progress[i]
+    def finish(self):
+        """
+          Tell this slave there is no more work, so it outputs its stats & exits
+        """
+        try:
+            self.process.stdin.close()
+        except IOError:
+            pass
 
-        # Estimate the percent complete for this slave ...
-        zip_files_progress = float(zip_files_processed) / zip_files_to_process * 100
-        estimated_slave_docs = int(float(zip_files_to_process) / total_zip_files * total_docs)
-        docs_progress = float(docs_processed) / estimated_slave_docs * 100
-        slave_progress_percent.append(max(zip_files_progress, docs_progress))
+    def read_messages(self):
+        """
+          Read the complete messages available from this slave, or return None if the slave has exited
+        """
+        data = os.read(self.fileno(), 65536)
+        if not data:
+            return None
+        lines = (self.unread_output + data).split('\n')
+        self.unread_output = lines.pop()
+        return [line.split('\t') for line in lines if line]
 
-        # Tally progress into total
-        total_zip_files_processed += zip_files_processed
-        total_docs_processed += docs_processed
+
+def format_duration(seconds):
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def output_total_progress(slaves, zip_files_processed, total_zip_files, docs_processed, collisions=0,
+                          eta_seconds=None):
+    """
+      Output the total parsing progress & throughput (over the last few seconds), given the progress for each slave
+    """
 
     # Output aggregate progress
-    total_docs_processed_percent = float(total_docs_processed) / total_docs * 100
-    total_zip_files_processed_percent = float(total_zip_files_processed) / total_zip_files * 100
-    sys.stdout.write("\rAggregate Progress: %d / %d docs (%2.2f%%), %d / %d files (%2.2f%%);  " %
-                     (total_docs_processed, total_docs, total_docs_processed_percent, total_zip_files_processed,
-                      total_zip_files, total_zip_files_processed_percent))
+    now = stage_timers.timer()
+    total_zip_files_processed_percent = float(zip_files_processed) / max(total_zip_files, 1) * 100
+    sys.stdout.write("\rAggregate Progress: %d docs, %d / %d files (%2.2f%%), %d id collisions;  " % (
+        docs_processed, zip_files_processed, total_zip_files, total_zip_files_processed_percent, collisions
+    ))
+    sys.stdout.write("%.0f docs/sec, %.2f MB/sec, %.1f errors/sec, ETA %s;  " % (
+        sum([slave.throughput.rate('documents', now) for slave in slaves]),
+        sum([slave.throughput.rate('bytes', now) for slave in slaves]) / 1024 / 1024,
+        sum([slave.throughput.rate('errors', now) for slave in slaves]),
+        format_duration(eta_seconds) if eta_seconds is not None else '?'
+    ))
 
     # Output individual slave progress
     slaves_output_data = []
-    for i in xrange(0, len(slave_progress_percent)):
-        slaves_output_data.append('Slave %d: (%2.2f%%)' % (i + 1, slave_progress_percent[i]))
+    for slave in sorted(slaves, key=lambda s: s.slave_id):
+        slaves_output_data.append('Slave %d: %d files, %.0f docs/sec, %d queued%s' % (
+            slave.slave_id + 1, slave.zip_files_processed, slave.throughput.rate('documents', now),
+            len(slave.zip_files), ' (stalled)' if slave.throughput.stalled else ''
+        ))
     sys.stdout.write("Slave Progress: " + ', '.join(slaves_output_data))
+    sys.stdout.flush()
 
 
-if __name__ == '__main__':
+def zip_file_size(zip_file):
+    try:
+        return os.path.getsize(os.path.join(data_path, zip_file))
+    except OSError:
+        return 0
+
+
+def parse_zip_files(zip_files, number_of_slaves, tally_venues_and_titles=True, binary_output=False,
+                    collision_detector=None, catalog_path=None, prefetch_depth=zip_prefetch.default_depth,
+                    prefetch_budget=None, stats=None, stall_seconds=progress_metrics.default_stall_seconds,
+                    tallies=None):
+    """
+      Parse the given zip files on a pool of slave processes, each of which pulls the next zip file from a shared queue
+      as soon as it finishes one, keeping enough zip files in flight for it to read ahead (up to the prefetch depth).
+      Slaves that die are replaced, and the zip files they hadn't finished requeued. The paper ids of each zip file are
+      checked for collisions with those of all others as soon as it is finished, and its stats added to the given
+      stats (rewriting the aggregate stats file, so it's up to date while parsing). Slaves send metrics while they
+      parse, for live throughput, and are reported as soon as they stall. The ETA is estimated from the (compressed)
+      bytes of zip files finished so far. The tallies of titles & venues of each zip file (sent along with its
+      stats) are merged into the given tallies.
+    """
 
-    # Calculate number of slaves to spawn
-    files_per_slave = 351
-    number_of_slaves = int(math.ceil(float(total_zip_files) / files_per_slave))
+    new_slave = lambda slave_id: Slave(
+        slave_id, tally_venues_and_titles, binary_output, catalog_path, prefetch_depth, prefetch_budget
+    )
+    zip_files_in_flight = max(1, prefetch_depth)
 
-    # Map of slave ids to progress data
-    slave_progress = {}
+    zip_files_to_process = deque(zip_files)
+    attempts = dict((zip_file, 0) for zip_file in zip_files)
+    zip_files_processed = 0
+    docs_processed = 0
+    zip_file_sizes = dict((zip_file, zip_file_size(zip_file)) for zip_file in zip_files)
+    total_bytes = sum(zip_file_sizes.itervalues())
+    bytes_processed = 0
+    start_time = stage_timers.timer()
 
     # Spawn all child processes
-    files_remaining = total_zip_files
-    child_pids = []
-    for i in range(0, number_of_slaves):
-        start_num = str(1 + (files_per_slave * i))
-        num_to_process = str(min(files_per_slave, files_remaining))
-        child_pid = subprocess.Popen([
-            "python",
-            "first_pass_slave_parser.py",  # Call the other python file
-            start_num,  # Specify the start file
-            num_to_process,  # Number of files to process
-            'n',  # Output to file, rather than standard output
-            'n'  # Do not tally most common titles or perform profiling
-        ])
-        child_pids.append(child_pid)
-        files_remaining -= files_per_slave
-
-        # Initialize child processes progress
-        slave_progress[i] = (i, 0, int(num_to_process), 0)
-
-    # Start progress server
-    server_address = ('localhost', 6005)
-    server_socket = socket.socket(AF_INET, SOCK_DGRAM)
-    server_socket.bind(server_address)
-    server_socket.setblocking(0)
-
-    # Keep listening until most slaves have neared completion
-    not_ready_iterations = 0
-    while True:
-
-        # Assume children have finished if this happens enough times
-        ready = select.select([server_socket], [], [], 1)
-        if not ready[0]:
-            not_ready_iterations += 1
-            if not_ready_iterations > 3600:  # If we've been waiting for one hour...
-                print "\nNo messages received from children, assuming complete..."
-                break
-        else:
-
-            # Record the progress update
-            received_data, client_address = server_socket.recvfrom(2048)
-            start_i, zip_files_processed, zip_files_to_process, docs_processed = received_data.split()
-            i = int(start_i) / files_per_slave
-            new_data = (i, int(zip_files_processed), int(zip_files_to_process), int(docs_processed))
-
-            # Check to make sure this was a NEW update (not out of order)
-            in_order = all([new >= old for new, old in zip(new_data, slave_progress[i])])
-            if in_order:
-                slave_progress[i] = new_data
-                output_total_progress(slave_progress)
-
-    # Wait for all children to complete
-    print "\nWaiting for children processes to exit..."
-    for pid in child_pids:
-        pid.wait()
+    next_slave_id = 0
+    slaves = []
+    for i in xrange(0, min(number_of_slaves, len(zip_files_to_process))):
+        slaves.append(new_slave(next_slave_id))
+        next_slave_id += 1
+
+    while slaves:
+
+        # Keep each slave's zip files in flight topped up, or let it exit once it's finished & there's nothing left
+        for slave in slaves:
+            if slave.process.stdin.closed:
+                continue
+            while zip_files_to_process and len(slave.zip_files) < zip_files_in_flight:
+                zip_file = zip_files_to_process.popleft()
+                attempts[zip_file] += 1
+                slave.assign(zip_file)
+            if not slave.zip_files:
+                slave.finish()
+
+        readable, _, _ = select.select(slaves, [], [], 1)
+        for slave in readable:
+            messages = slave.read_messages()
+
+            # The slave exited, so requeue the zip files it hadn't finished (only counting an attempt at the one it was
+            # parsing), and replace it while there's work left
+            if messages is None:
+                slaves.remove(slave)
+                slave.process.wait()
+                if slave.zip_files:
+                    zip_file = slave.zip_files.popleft()
+                    for unstarted_zip_file in reversed(slave.zip_files):
+                        attempts[unstarted_zip_file] -= 1
+                        zip_files_to_process.appendleft(unstarted_zip_file)
+                    if attempts[zip_file] < max_attempts_per_zip_file:
+                        print "\nSlave %d died parsing '%s', requeueing it..." % (slave.slave_id + 1, zip_file)
+                        zip_files_to_process.appendleft(zip_file)
+                    else:
+                        print "\nSlave %d died parsing '%s', giving up on it after %d attempts" % (
+                            slave.slave_id + 1, zip_file, attempts[zip_file]
+                        )
+                if zip_files_to_process:
+                    slaves.append(new_slave(next_slave_id))
+                    next_slave_id += 1
+                continue
+
+            # Record the zip files this slave finished, and its latest metrics
+            now = stage_timers.timer()
+            for message in messages:
+                if message[0] == 'metrics':
+                    slave.throughput.add(now, progress_metrics.parse_message(message))
+                if message[0] != 'done':
+                    continue
+                slave.throughput.progressed(now)
+                slave.zip_files.remove(message[1])
+                bytes_processed += zip_file_sizes[message[1]]
+                slave.zip_files_processed += 1
+                slave.docs_processed += int(message[2])
+                zip_files_processed += 1
+                docs_processed += int(message[2])
+
+                # Check this zip file's paper ids against those of every zip file finished so far
+                if collision_detector is not None:
+                    paper_ids = first_pass_collisions.read_id_run(message[1])
+                    if paper_ids is not None:
+                        collision_detector.add_run(message[1], paper_ids)
+
+                # Add up the stats & tallies of the zip file (sent along with it if its shard was committed)
+                if stats is not None and len(message) > 3:
+                    parse_stats.write_stats_file(aggregate_stats_path, stats.merge(
+                        parse_stats.ParseStats.from_json(message[3])
+                    ))
+                if tallies is not None and len(message) > 4:
+                    tallies.merge(parse_stats.Tallies.from_json(message[4]))
+
+        # Report slaves that have had zip files to parse, but made no progress, for too long
+        now = stage_timers.timer()
+        for slave in slaves:
+            if slave.zip_files and not slave.throughput.stalled and slave.throughput.is_stalled(now, stall_seconds):
+                slave.throughput.stalled = True
+                print "\nSlave %d stalled: no progress for %ds, parsing '%s'" % (
+                    slave.slave_id + 1, now - slave.throughput.last_progress, slave.zip_files[0]
+                )
+
+        elapsed = now - start_time
+        eta_seconds = (total_bytes - bytes_processed) * elapsed / bytes_processed if bytes_processed else None
+        output_total_progress(slaves, zip_files_processed, len(attempts), docs_processed,
+                              collision_detector.collisions if collision_detector is not None else 0, eta_seconds)
+
+    elapsed = stage_timers.timer() - start_time
+    print "\nParsed %d / %d ZIP files, %d papers in %s (%.1f papers/sec, %.2f MB/sec of ZIP files)" % (
+        zip_files_processed, len(attempts), docs_processed, format_duration(elapsed),
+        docs_processed / elapsed if elapsed else 0, bytes_processed / elapsed / 1024 / 1024 if elapsed else 0
+    )
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Parse the raw Arnetminer data on a pool of slave processes')
+    parser.add_argument('-n', '--slaves', type=int, default=multiprocessing.cpu_count(),
+                        help='the number of slave processes to run (defaults to the number of CPUs)')
+    parser.add_argument('--no-tally', dest='tally', action='store_false',
+                        help="don't tally the most common titles and venues (tallied by default)")
+    parser.add_argument('--binary', action='store_true', help='write intermediate output in the binary record format')
+    parser.add_argument('--catalog', help='read zip files through this catalog of the raw data (see raw_catalog.py), '
+                                          'parsing the biggest first & only those with a selected member')
+    raw_catalog.add_selection_arguments(parser)
+    parser.add_argument('--prefetch', type=int, default=zip_prefetch.default_depth,
+                        help='how many zip files each slave reads ahead, counting the one it is parsing (0 to not read '
+                             'ahead, defaults to %d)' % zip_prefetch.default_depth)
+    parser.add_argument('--prefetch-budget', type=int, metavar='MB',
+                        help='the most decompressed data each slave reads ahead at once (defaults to %d MB)' % (
+                            zip_prefetch.default_byte_budget / 1024 / 1024))
+    parser.add_argument('--stall-seconds', type=float, default=progress_metrics.default_stall_seconds,
+                        help='report slaves that make no progress for this many seconds (defaults to %d)' %
+                             progress_metrics.default_stall_seconds)
+    args = parser.parse_args()
+
+    # Only parse the zip files that were added or changed since an earlier run (dropping shards of deleted zip files)
+    all_zip_files = sorted(os.listdir(data_path))
+    zip_files = first_pass_manifest.reconcile(data_path, all_zip_files)
+    if len(zip_files) < len(all_zip_files):
+        print "Skipping %d ZIP files unchanged since an earlier run" % (len(all_zip_files) - len(zip_files))
+
+    # Check for paper ids shared across the whole corpus, starting from the zip files finished by an earlier run
+    # (and add up the stats & tallies of the whole corpus, starting from theirs too)
+    collision_detector = first_pass_collisions.CollisionDetector()
+    stats = parse_stats.ParseStats()
+    tallies = parse_stats.Tallies() if args.tally else None
+    zip_files_to_parse = set(zip_files)
+    for zip_file in all_zip_files:
+        if zip_file not in zip_files_to_parse:
+            paper_ids = first_pass_collisions.read_id_run(zip_file)
+            if paper_ids is not None:
+                collision_detector.add_run(zip_file, paper_ids)
+            zip_file_stats = parse_stats.read_zip_file_stats(zip_file)
+            if zip_file_stats is not None:
+                stats.merge(zip_file_stats)
+            zip_file_tallies = parse_stats.read_zip_file_tallies(zip_file) if tallies is not None else None
+            if zip_file_tallies is not None:
+                tallies.merge(zip_file_tallies)
+
+    # Only parse the zip files with a member selected from the catalog, biggest first (so the last zip files handed out
+    # are small ones, and slaves finish at about the same time)
+    if args.catalog:
+        catalog = raw_catalog.Catalog(args.catalog)
+        if args.aggregation_types or args.years or args.max_size is not None:
+            selected = raw_catalog.members_by_zip_file(catalog.members(
+                aggregation_types=args.aggregation_types, years=args.years, max_size=args.max_size
+            ))
+            selected_zip_files = [zip_file for zip_file in zip_files if zip_file in selected]
+            print "Selected %d / %d ZIP files from the catalog" % (len(selected_zip_files), len(zip_files))
+            zip_files = selected_zip_files
+        zip_file_sizes = catalog.zip_file_sizes()
+        catalog.close()
+        zip_files = sorted(zip_files, key=lambda zip_file: zip_file_sizes.get(zip_file, 0), reverse=True)
+
+    parse_zip_files(zip_files, args.slaves, args.tally, args.binary, collision_detector, args.catalog, args.prefetch,
+                    args.prefetch_budget, stats, args.stall_seconds, tallies)
+
+    collision_detector.close()
+    print "Found %d papers with an id already taken (%d distinct ids, in %d / %d ZIP files checked), see '%s'" % (
+        collision_detector.collisions, len(collision_detector.colliding_ids), collision_detector.runs_checked,
+        len(all_zip_files), first_pass_collisions.collision_report_path
+    )
+
+    # Output the stats of the whole corpus
+    parse_stats.write_stats_file(aggregate_stats_path, stats)
+    stats_message = parse_stats.build_stats_message(stats)
+    if tallies is not None:
+        stats_message += parse_stats.build_title_and_venue_tallies_message(tallies)
+    with open(aggregate_stats_message_path, 'w') as stats_file:
+        stats_file.write(stats_message)
+    print stats_message
@@ -1,61 +1,38 @@
 from Stemmer import Stemmer
 import cProfile
+import first_pass_manifest
+import fingerprints
+import intermediate_records
 import json
 import os
+import parse_stats
+import progress_metrics
+import raw_catalog
 import re
-import socket
-import string
+import slave_log
+import stage_timers
 import zipfile
 import sys
-import hashlib
-import operator
-import traceback
-from collections import defaultdict
+import zip_prefetch
 from xml.etree import cElementTree
-from _socket import AF_INET, SOCK_DGRAM
+from text_normalization import ascii_printable, collapse_whitespace, printable
 
 # The path to the input data
 data_path = 'data'
 if not os.path.exists(data_path):
     data_path = '/mnt/fcroot/full-arnetminer/data'
-intermediate_results_folder = 'intermediate_output'
-
-# Counts of papers with particular issues
-documents_found = 0
-documents_processed = 0
-books_skipped = 0
-documents_errors = 0
-documents_missing_authors = 0
-documents_missing_venue = 0
-documents_missing_title = 0
-documents_fb_non_chapter = 0
-documents_missing_authors_fb_non_chapter = 0
-empty_xml_files = 0
-documents_skipped_from_title = 0
-docs_missing_printable_data = 0
-document_types = defaultdict(int)
-
-# Counts of papers with particular reference issues
-references_in_unexpected_format = 0
-references_in_plaintext = 0
-references_without_titles = 0
-references_without_authors = 0
-references_without_date = 0
-references_with_invalid_date = 0
-references_attempted = 0
-references_succeeded = 0
-docs_missing_references = 0
-docs_with_few_references = 0
-
-# Count hash collisions
-hashes_seen = set()
-hash_collision_count = 0
-hash_collisions = set()
-check_hash_collisions = False
-
-# Shortcut for filtering a string to printable characters
-printable = lambda s: filter(lambda x: x in string.printable, s)
-ascii_printable = lambda s: filter(lambda x: x in string.letters, s)
+intermediate_results_folder = first_pass_manifest.intermediate_results_folder
+
+# Counts of papers with particular (document or reference) issues in the zip file being parsed, which are committed
+# alongside its shard & sent to the master once it's finished, then added to the total for this slave. Hash collisions
+# are counted within each shard (collisions across shards are found by the master, from each shard's run of paper ids).
+stats = parse_stats.ParseStats()
+total_stats = parse_stats.ParseStats()
+
+# Optionally check that no two different keys (of documents or references) got the same id (memory hungry)
+audit_fingerprint_collisions = False
+fingerprint_audit = fingerprints.CollisionAudit()
+
 
 # Total counts
 total_zip_files = 1052
@@ -69,13 +46,55 @@ year_regex = re.compile(r'\D(\d{4})\D')
 # Flag for output mode
 output_to_standard_out = True
 
-# Data for localhost progress UDP server
-server_address = ('localhost', 40404)
-client_socket = socket.socket(AF_INET, SOCK_DGRAM)
-
-# Inefficient tallies
-title_counts = defaultdict(int)
-venue_counts = defaultdict(int)
+# Flag for writing intermediate output in the binary record format (rather than plain text)
+binary_intermediate_output = False
+
+# Flag for incrementally parsing paper XML (dropping full text bodies as they stream past) rather than reading the
+# whole file & building the full tree
+stream_documents = True
+
+# The catalog of the raw data to read zip files through (seeking straight to each member from its local header, rather
+# than reading the central directory), if given
+catalog = None
+
+# How many zip files to read ahead of the one being parsed (counting it, or 0 to read each member as it's parsed), and
+# how many bytes of decompressed members to hold at once, when reading & decompressing on a background thread
+prefetch_depth = zip_prefetch.default_depth
+prefetch_byte_budget = zip_prefetch.default_byte_budget
+
+# Tags of the elements that hold the full text of a paper
+raw_text_tag = '{http://www.elsevier.com/xml/common/doc-properties/schema}raw-text'
+bib_reference_tag = '{http://www.elsevier.com/xml/common/schema}bib-reference'
+
+# Tags of the elements read from each paper with '*/*/...' paths (any others at that depth are cleared once parsed)
+metadata_tags = {
+    '{http://purl.org/dc/elements/1.1/}title',
+    '{http://www.elsevier.com/xml/common/schema}author',
+    '{http://www.elsevier.com/xml/common/schema}author-group',
+    '{http://www.elsevier.com/xml/common/schema}copyright',
+    '{http://www.elsevier.com/xml/common/schema}bibliography',
+    '{http://www.elsevier.com/xml/common/schema}further-reading-sec',
+    '{http://www.elsevier.com/xml/cja/schema}jid',
+    '{http://prismstandard.org/namespaces/basic/2.0/}aggregationType',
+    '{http://prismstandard.org/namespaces/basic/2.0/}publicationName',
+    '{http://prismstandard.org/namespaces/basic/2.0/}coverDisplayDate',
+}
+
+# The prefetcher reading zip files ahead of parsing, if any, and where to send metrics of parsing progress (to the
+# master, when run as its slave)
+prefetcher = None
+metrics_reporter = None
+
+# The log of each slave (by the number it names its output files with), opened when first written to
+slave_logs = {}
+
+# Timers for each stage of parsing a document (always on, unlike profiling)
+timers = stage_timers.StageTimers()
+
+# Tallies of the most frequent titles & venues (in bounded memory, so they're cheap enough to leave on), of the zip file
+# being parsed & of all zip files committed by this process
+tallies = parse_stats.Tallies()
+total_tallies = parse_stats.Tallies()
 
 # Get the stop words set & stemmer for text analysis
 stop_words = None
@@ -83,6 +102,11 @@ with open('stopWords.json') as stop_words_file:
     stop_words = set(json.load(stop_words_file))
 stemmer = Stemmer('english')
 
+# Memo of the (ascii) term each lowercased word reduces to once stop words are dropped & it's stemmed, which is emptied
+# whenever it fills up
+stem_cache = {}
+max_stem_cache_size = 1000000
+
 
 class DBLPParseError(Exception):
     pass
@@ -140,14 +164,14 @@ def author_surname_from_element(author_element):
     surname_el = author_element.find('{http://www.elsevier.com/xml/common/schema}surname')
     if (surname_el is None) or (surname_el.text is None) or (not len(surname_el.text.split())):
         return None
-    return str(printable(surname_el.text.split()[-1]))
+    return printable(surname_el.text.split()[-1])
 
 
 def author_given_name_from_element(author_element):
     given_name_el = author_element.find('{http://www.elsevier.com/xml/common/schema}given-name')
     if (given_name_el is None) or (given_name_el.text is None) or (not len(given_name_el.text.split())):
         return None
-    return str(printable(given_name_el.text.split()[-1]))
+    return printable(given_name_el.text.split()[-1])
 
 
 def full_authors_string_from_elements(author_elements):
@@ -170,7 +194,7 @@ def clean_string_from_element(element):
     """
 
     raw_text = element.text
-    clean_text = re.sub(r'\s+', ' ', raw_text.strip()) if raw_text is not None else None
+    clean_text = collapse_whitespace(raw_text) if raw_text is not None else None
     return clean_text
 
 
@@ -188,10 +212,26 @@ def ascii_stemmed_terms_from_element(element):
       Get the text of the terms from an element, after removing stop words and stemming
     """
 
-    words = str(element.text).split()
-    terms = [ascii_printable(stemmer.stemWord(word.lower())) for word in words if word.lower() not in stop_words]
-    terms = [str(term) for term in terms if term is not None]
-    return ''.join(terms)
+    timers.start('stem_hash')
+    words = str(element.text).lower().split()
+
+    # Stem the words we haven't seen before in one batch
+    new_words = set([word for word in words if word not in stem_cache])
+    if new_words:
+        if len(stem_cache) + len(new_words) > max_stem_cache_size:
+            stem_cache.clear()
+        words_to_stem = [word for word in new_words if word not in stop_words]
+        for word, stemmed_word in zip(words_to_stem, stemmer.stemWords(words_to_stem)):
+            stem_cache[word] = ascii_printable(stemmed_word)
+        for word in new_words.intersection(stop_words):
+            stem_cache[word] = ''
+
+    new_word_count = sum([1 for word in words if word in new_words])
+    stats.stem_cache_misses += new_word_count
+    stats.stem_cache_hits += len(words) - new_word_count
+    terms = ''.join([stem_cache[word] for word in words])
+    timers.stop()
+    return terms
 
 
 def ascii_text_from_element(element):
@@ -200,28 +240,72 @@ def ascii_text_from_element(element):
     """
 
     raw_text = element.text
-    clean_text = str(ascii_printable(raw_text.strip())) if raw_text is not None else None
+    clean_text = ascii_printable(raw_text.strip()) if raw_text is not None else None
     return clean_text
 
 
 def hash_document_data(title, authors_string):
     """
-      Calculate MD5 hash based on uniquely identifying doc data, stripping all non-ascii text out of key
+      Calculate the id (fingerprint) based on uniquely identifying doc data, stripping all non-ascii text out of key
     """
-    data_string = str(ascii_printable('%s%s' % (title.strip().lower(), authors_string.strip().lower())))
-    data_hash = int(hashlib.sha1(data_string.encode('utf-8')).hexdigest(), 16)
+    timers.start('stem_hash')
+    data_string = ascii_printable('%s%s' % (title.strip().lower(), authors_string.strip().lower()))
+    data_hash = fingerprints.fingerprint(data_string)
+    if audit_fingerprint_collisions:
+        fingerprint_audit.check(data_hash, data_string)
+    timers.stop()
     return data_hash
 
 
+def stream_document_root(xml_file):
+    """
+      Incrementally parse paper XML from a file-like object, keeping only the elements read from each paper. The
+      raw text of the paper is dropped as soon as its end tag streams past, as are elements at the depth of the paper's
+      metadata that hold none of its metadata or references.
+    """
+
+    doc_root = None
+    open_elements = []
+    raw_text_depth = 0
+    has_bib_reference = False
+
+    for event, element in cElementTree.iterparse(xml_file, events=('start', 'end')):
+
+        if event == 'start':
+            if doc_root is None:
+                doc_root = element
+            if raw_text_depth or element.tag == raw_text_tag:
+                raw_text_depth += 1
+            elif element.tag == bib_reference_tag:
+                has_bib_reference = True
+            open_elements.append(element)
+            continue
+
+        open_elements.pop()
+
+        # Drop the full text body, without waiting for the rest of the paper
+        if raw_text_depth:
+            raw_text_depth -= 1
+            element.clear()
+            if not raw_text_depth:
+                open_elements[-1].remove(element)
+            continue
+
+        # Drop elements at the depth of the paper's metadata that we never read, once they have been consumed
+        if len(open_elements) == 3:
+            if element.tag not in metadata_tags and not has_bib_reference:
+                element.clear()
+                open_elements[-1].remove(element)
+            has_bib_reference = False
+
+    return doc_root
+
+
 def parse_references(doc_root, aggregation_type):
     """
       Find the hashes of documents referenced by the document, given the document's root element and doc type
     """
 
-    global references_attempted, references_without_titles, references_without_authors, references_without_date, \
-        references_in_unexpected_format, references_with_invalid_date, references_succeeded, docs_missing_references,\
-        docs_with_few_references, references_in_plaintext
-
     reference_elements = []
 
     # Explicitly handle references for a book differently than for other formats
@@ -251,7 +335,7 @@ def parse_references(doc_root, aggregation_type):
     for reference_element in reference_elements:
 
         contains_any_ref = True
-        references_attempted += 1
+        stats.references_attempted += 1
 
         # Find both sections of reference
         contribution = reference_element.find('{http://www.elsevier.com/xml/common/struct-bib/schema}contribution')
@@ -265,12 +349,12 @@ def parse_references(doc_root, aggregation_type):
             if text_ref_element is not None:
 
                 # Ignore text references (un-parsed / unstructured refs)
-                references_in_plaintext += 1
+                stats.references_in_plaintext += 1
                 continue
 
             else:
 
-                references_in_unexpected_format += 1
+                stats.references_in_unexpected_format += 1
                 continue
 
         # Get title
@@ -286,7 +370,7 @@ def parse_references(doc_root, aggregation_type):
 
         # Handle missing or invalid titles
         if title is None:
-            references_without_titles += 1
+            stats.references_without_titles += 1
             continue
 
         # Get authors strings
@@ -298,17 +382,17 @@ def parse_references(doc_root, aggregation_type):
             reference_ids.append(hash_document_data(title, first_author_surname))
 
         else:
-            references_without_authors += 1
+            stats.references_without_authors += 1
             continue
 
         # Assume only one of this batch of references will succeed
-        references_succeeded += 1
+        stats.references_succeeded += 1
 
     # Record cases with few or no references
     if not contains_any_ref:
-        docs_missing_references += 1
+        stats.docs_missing_references += 1
     elif len(reference_ids) < 3:
-        docs_with_few_references += 1
+        stats.docs_with_few_references += 1
 
     # Check for invalid reference ids
     if not (len(reference_ids) == 0 or min(reference_ids)):
@@ -322,41 +406,74 @@ def gen_documents_from_file(zipped_file):
       Generator that yields the next paper contents from a zipped file containing many XML files
     """
 
-    # Import global counts
-    global books_skipped, documents_found, documents_processed, documents_missing_authors, documents_missing_title, \
-        documents_fb_non_chapter, documents_missing_authors_fb_non_chapter, \
-        documents_skipped_from_title, references_attempted, references_without_titles, references_without_authors, \
-        references_without_date, should_output_path, hash_collision_count, hash_collisions, documents_missing_venue, \
-        documents_errors
-
     for name in zipped_file.namelist():
 
-        documents_found += 1
+        # Count the time spent on each stage of the last document, and send the metrics of progress so far (if due)
+        timers.end_document()
+        if metrics_reporter is not None:
+            metrics_reporter.tick()
+
+        stats.documents_found += 1
 
         # Skip non-xml files
         if not name.endswith('xml'):
-            log(num_to_skip, "Skipping non-xml file in archive: '%s'" % name)
+            log(num_to_skip, "Skipping non-xml file in archive: '%s'" % name, signature='non-xml file', document=name)
             continue
 
         try:
 
-            # Parse paper XML
-            xml_content = zipped_file.read(name)
-            doc_root = cElementTree.fromstring(xml_content)
+            if stream_documents:
+
+                # Skip & log empty XML files
+                file_size = zipped_file.getinfo(name).file_size
+                stats.bytes_parsed += file_size
+                if not file_size:
+                    stats.empty_xml_files += 1
+                    continue
+
+                # Parse paper XML straight from the archive, dropping the main content of the paper as it's read (which
+                # also decompresses it, unless it was prefetched)
+                timers.start('xml_parse')
+                xml_file = zipped_file.open(name)
+                try:
+                    doc_root = stream_document_root(xml_file)
+                except SyntaxError:
+
+                    # Skip & log XML files of nothing but white space, like empty ones (only reading the file again when
+                    # it fails to parse)
+                    if not zipped_file.read(name).strip():
+                        stats.empty_xml_files += 1
+                        continue
+                    raise
+                finally:
+                    xml_file.close()
+                timers.stop()
 
-            # Remove main content of paper, if possible
-            for el in doc_root.getchildren():
-                raw_text = el.find('{http://www.elsevier.com/xml/common/doc-properties/schema}raw-text')
-                if raw_text is not None:
-                    el.remove(raw_text)
+            else:
 
-            # Skip & log empty XML files
-            if not len(xml_content.strip()):
-                global empty_xml_files
-                empty_xml_files += 1
-                continue
+                # Parse paper XML
+                timers.start('decompress')
+                xml_content = zipped_file.read(name)
+                stats.bytes_parsed += len(xml_content)
+                timers.stop()
+
+                # Skip & log empty XML files (or those of nothing but white space)
+                if not len(xml_content.strip()):
+                    stats.empty_xml_files += 1
+                    continue
+
+                timers.start('xml_parse')
+                doc_root = cElementTree.fromstring(xml_content)
+
+                # Remove main content of paper, if possible
+                for el in doc_root.getchildren():
+                    raw_text = el.find(raw_text_tag)
+                    if raw_text is not None:
+                        el.remove(raw_text)
+                timers.stop()
 
             # Authors
+            timers.start('metadata')
             author_elements = doc_root.findall('*/*/{http://www.elsevier.com/xml/common/schema}author')  # Book authors
 
             # Look in alternate location for authors, if not found above
@@ -375,12 +492,12 @@ def gen_documents_from_file(zipped_file):
 
             # Skip this document if title is missing or empty
             if title is None or not len(title.strip()):
-                documents_missing_title += 1
+                stats.documents_missing_title += 1
                 continue
 
             # Skip this document if we can / should based on the title
             if is_useless_doc(title):
-                documents_skipped_from_title += 1
+                stats.documents_skipped_from_title += 1
                 continue
 
             # Add the authors, if found
@@ -388,13 +505,13 @@ def gen_documents_from_file(zipped_file):
                 first_author_surname = author_surname_from_element(author_elements[0])
                 authors_string = full_authors_string_from_elements(author_elements)
             else:
-                documents_missing_authors += 1
+                stats.documents_missing_authors += 1
                 continue
 
             # If this document is a 'non-chapter', means we can skip it
             fb_non_chapter = doc_root.find('{http://www.elsevier.com/xml/bk/schema}fb-non-chapter')
             if fb_non_chapter is not None:
-                documents_fb_non_chapter += 1
+                stats.documents_fb_non_chapter += 1
                 continue
 
             # Increment the count of this document type
@@ -412,14 +529,14 @@ def gen_documents_from_file(zipped_file):
                 document_type = aggregation_type_element.text + ' (cja)'
             venue = clean_string_from_element(venue_element)
             if venue is None:
-                documents_missing_venue += 1
+                stats.documents_missing_venue += 1
                 continue
 
-            document_types[document_type] += 1
+            stats.document_types[document_type] += 1
 
             # Skip this paper if it's the same title as its conference
             if venue.lower() == title.lower():
-                documents_skipped_from_title += 1
+                stats.documents_skipped_from_title += 1
                 continue
 
             # Publication year
@@ -437,137 +554,40 @@ def gen_documents_from_file(zipped_file):
             # Calculate the hash (or 'index') for this document
             index = hash_document_data(hashable_title, first_author_surname)
 
-            # Ensure that this paper's index is unique & record it
-            if check_hash_collisions:
-                if index in hashes_seen:
-                    hash_collision_count += 1
-                    hash_collisions.add(index)
-                else:
-                    hashes_seen.add(index)
-
             # Parse the references for this document
+            timers.stop()
+            timers.start('references')
             reference_ids = parse_references(doc_root, aggregation_type_element.text)
 
         except:  # Handle any unforeseen errors by logging them & skipping this document
 
-            # Handle all exceptions by tallying unforeseen errors
-            log(num_to_skip, "[Unexpected Error] '%s'" % traceback.format_exc())
-            documents_errors += 1
+            # Handle all exceptions by tallying unforeseen errors (only logging the first of each kind in full)
+            log(num_to_skip, "[Unexpected Error] parsing '%s'" % name, exc_info=sys.exc_info(), document=name)
+            stats.documents_errors += 1
             continue
 
-        documents_processed += 1
-        yield title, authors_string, year, venue, index, reference_ids, name
-
-
-def build_reference_stats_message():
-    """
-      Output statistics about document references
-    """
-
-    count_and_percent = lambda a, b: (a, b, float(a) / b * 100 if b > 0 else 0)
-
-    # Output document reference errors
-    output_message = "\nDocument Reference Errors Found:\n" 
-    m = references_attempted
-    output_message += "\tReferences In Unexpected Format: %d / %d (%2.2f%%)\n" % \
-                      count_and_percent(references_in_unexpected_format, m)
-    m -= references_in_unexpected_format
-    output_message += "\tReferences in Plain Text: %d / %d (%2.2f%%)\n" % count_and_percent(references_in_plaintext, m)
-    m -= references_in_plaintext
-    output_message += "\tReferences Without Titles: %d / %d (%2.2f%%)\n" % \
-                      count_and_percent(references_without_titles, m)
-    m -= references_without_titles
-    output_message += "\tReferences Without Authors: %d / %d (%2.2f%%)\n" % \
-                      count_and_percent(references_without_authors, m)
-    m -= references_without_authors
-    output_message += "\tReferences Without Date: %d / %d (%2.2f%%)\n" % count_and_percent(references_without_date, m)
-    m -= references_without_date
-    output_message += "\tReferences With Invalid Date: %d / %d (%2.2f%%)\n" % \
-                      count_and_percent(references_with_invalid_date, m)
-    m -= references_with_invalid_date
-    output_message += "\tReferences Succeeded: %d / %d (%2.2f%%)\n" % \
-                      count_and_percent(references_succeeded, references_attempted)
-
-    # Don't raise a fatal error if counts are not as expected
-    if m != references_succeeded:
-        print "Document reference tally failed!!! m: %d, actually succeeded: %d" % (m, references_succeeded)
-
-    # Try to estimate the recall of references
-    output_message += "\nDocuments Without References: %d / %d (%2.2f%%)\n" % \
-                      count_and_percent(docs_missing_references, documents_processed)
-    output_message += "\nDocuments With Few References: %d / %d (%2.2f%%)\n" % \
-                      count_and_percent(docs_with_few_references, documents_processed)
-
-    return output_message
+        # Stop timing whichever stages were running, however this document was finished or skipped
+        finally:
+            timers.stop_all()
 
+        stats.documents_processed += 1
+        yield title, authors_string, year, venue, index, reference_ids, name, document_type
 
-def build_document_stats_message():
-    """
-      Output statistics about documents
-    """
-
-    count_and_percent = lambda a, b: (a, b, float(a) / b * 100 if b > 0 else 0)
-
-    # Fatal paper parsing errors (most likely bad data)
-    n = documents_found
-    output_message = "\nDocument Errors (Fatal):\n"
-    output_message += "\tEmpty Document Files: %d / %d (%2.2f%%)\n" % count_and_percent(empty_xml_files, n)
-    n -= empty_xml_files
-    output_message += "\tBooks Skipped: %d / %d (%2.2f%%)\n" % count_and_percent(books_skipped, n)
-    n -= books_skipped
-    output_message += "\tDocuments Missing Title: %d / %d (%2.2f%%)\n" % count_and_percent(documents_missing_title, n)
-    n -= documents_missing_title
-    output_message += "\tDocuments Skipped Based on Title: %d / %d (%2.2f%%)\n" % \
-                      count_and_percent(documents_skipped_from_title, n)
-    n -= documents_skipped_from_title
-    output_message += "\tDocuments Skipped From Non-Chapter Tag: %d / %d (%2.2f%%)\n" % \
-                      count_and_percent(documents_fb_non_chapter, n)
-    n -= documents_fb_non_chapter
-    output_message += "\tDocuments Missing Authors: %d / %d (%2.2f%%)\n" % \
-                      count_and_percent(documents_missing_authors, n)
-    n -= documents_missing_authors
-    output_message += "\tDocuments Missing Venue: %d / %d (%2.2f%%)\n" % count_and_percent(documents_missing_venue, n)
-    n -= documents_missing_venue
-    output_message += '\tDocuments Skipped (Unknown Error): %d / %d (%2.2f%%)\n' % \
-                      count_and_percent(documents_errors, n)
-    n -= documents_errors
-
-    if n != documents_processed:
-        print "Document tally failed!!! n: %d, actually succeeded: %d" % (n, documents_processed)
-
-    output_message += "\nDocuments Missing Printable Data: %d / %d/ (%2.2f%%)\n" % \
-                      count_and_percent(docs_missing_printable_data, n)
-
-    # Non-fatal document parsing errors (potentially bad data)
-    output_message += "\nDocument Errors (Ignored):\n"
-    output_message += "\tDocument Hash Collisions: %d / %d (%2.2f%%)\n" % count_and_percent(hash_collision_count, n)
-
-    # Breakdown of type of documents encountered
-    output_message += "\nDocument Types:\n"
-    for key, count in document_types.iteritems():
-        output_message += "\t%s: %d / %d (%2.2f%%)\n" % \
-                          tuple([key.title()] + list(count_and_percent(document_types[key], documents_processed)))
+    timers.end_document()
 
-    return output_message
 
-
-def build_title_and_venue_tallies_message():
+def build_timing_stats_message():
     """
-      Output tallies for the most common titles and venues
+      Output the latency of each stage of parsing documents (or zip files)
     """
 
-    k = 10
-    output_message = "\nMost Frequent Titles:\n"
-    sorted_titles = sorted(title_counts.iteritems(), key=operator.itemgetter(1))
-    sorted_titles = list(reversed(sorted_titles))
-    for i in xrange(0, k):
-        output_message += "\t%s: %d\n" % (sorted_titles[i][0], sorted_titles[i][1])
-
-    output_message += "\nMost Frequent Venues:\n"
-    sorted_venues = sorted(venue_counts.iteritems(), key=operator.itemgetter(1))
-    sorted_venues = list(reversed(sorted_venues))
-    for i in xrange(0, min(k, len(sorted_venues))):
-        output_message += "\t%s: %d\n" % (sorted_venues[i][0], sorted_venues[i][1])
+    output_message = "\nStage Timings (per document, or per zip file for opening them):\n"
+    report = timers.report()
+    for stage in sorted(report, key=lambda stage: -report[stage]['total_seconds']):
+        output_message += "\t%s: %.1fs total over %d, mean %.3fms (p50 %.3fms, p90 %.3fms, p99 %.3fms, max %.3fms)\n" % (
+            stage, report[stage]['total_seconds'], report[stage]['count'], report[stage]['mean_ms'],
+            report[stage]['p50_ms'], report[stage]['p90_ms'], report[stage]['p99_ms'], report[stage]['max_ms']
+        )
 
     return output_message
 
@@ -596,107 +616,305 @@ def output_progress(
 
     else:
 
-        # Send raw values to progress server
-        progress_data = '%d %d %d %d' % (num_to_skip, zip_files_processed, zip_files_to_process, documents_processed)
-        client_socket.sendto(progress_data, server_address)
+        # Write raw values to this slave's progress file
+        progress_path = os.path.join(intermediate_results_folder, '%d-progress.txt' % num_to_skip)
+        with open(progress_path, 'w') as progress_file:
+            progress_file.write('%d %d %d %d\n' % (
+                num_to_skip, zip_files_processed, zip_files_to_process, documents_processed
+            ))
 
 
-def log(start_num, message):
+def log(start_num, message, signature=None, exc_info=None, **fields):
     """
-      Log to the log file for this slave
+      Log to the (buffered) log file for this slave, as a JSON record with any other fields given. Messages with a
+      signature, and errors being handled (given by sys.exc_info()), are only logged the first time each kind is seen.
     """
 
-    log_path = os.path.join(intermediate_results_folder, '%d-log.txt' % start_num)
-    file_mode = 'a' if os.path.exists(log_path) else 'w'
-    with open(log_path, file_mode) as log_file:
-        log_file.write(message + '\n')
-
+    if start_num not in slave_logs:
+        slave_logs[start_num] = slave_log.BufferedLog(
+            os.path.join(intermediate_results_folder, '%d-log.jsonl' % start_num)
+        )
+    if exc_info is not None:
+        slave_logs[start_num].error(message, exc_info, **fields)
+    else:
+        slave_logs[start_num].info(message, signature, **fields)
 
-def main(output_path, num_to_skip, num_to_process, tally_venues_and_titles=False):
 
-    global zip_files_processed, docs_missing_printable_data
+def flush_logs():
+    for each_log in slave_logs.itervalues():
+        each_log.flush()
 
-    # Estimate the max documents & files to process
-    estimated_total_documents = int(float(num_to_process) / total_zip_files * total_papers)
 
-    # Open output file
-    output_file = open(output_path, 'w')
+def parse_zip_file(filename, output_file, num_to_skip, tally_venues_and_titles=True, report_progress=None,
+                   paper_ids=None, prefetched=None):
+    """
+      Parse the papers from one zip file of the input data into the output file, returning the number of papers written
+      (or None if the zip file couldn't be opened), and adding the id of each paper written to the given list. The zip
+      file may already have been opened by the prefetcher, given as (zip file, error opening it).
+    """
 
-    file_num = 0
-    for filename in os.listdir(data_path):
-        full_file_path = os.path.join(data_path, filename)
+    full_file_path = os.path.join(data_path, filename)
 
-        # Skip this file if we should
-        file_num += 1
-        if file_num <= num_to_skip + 1:
-            continue
+    # Open zip file, or skip if invalid
+    try:
+        if prefetched is not None:
+            zipped_file, error = prefetched
+            if error is not None:
+                raise error
+        else:
+            zip_open_start = stage_timers.timer()
+            zipped_file = raw_catalog.open_zip_file(full_file_path, catalog)
+            timers.record('zip_open', stage_timers.timer() - zip_open_start)
+    except zipfile.BadZipfile, e:
+        log(num_to_skip, "Skipping '%s', error opening zip file: '%s'" % (full_file_path, e.message), zip_file=filename)
+        return None
+    except AssertionError, e:
+        log(num_to_skip, "Skipping '%s', assertion error: '%s'" % (full_file_path, e.message), zip_file=filename)
+        return None
+    except IOError, e:
+        log(num_to_skip, "Skipping '%s', I/O error: '%s'" % (full_file_path, e.message), zip_file=filename)
+        return None
 
-        # Stop once we've parsed as many as we were told to
-        if zip_files_processed >= num_to_process:
-            break
+    papers_written = 0
+    for title, authors, year, venue, index, reference_ids, orig_filename, document_type in \
+            gen_documents_from_file(zipped_file):
+
+        # Tally the most frequent titles & venues
+        if tally_venues_and_titles:
+            tallies.add(title, venue, year, document_type)
+
+        # Output paper data to output file (just remove non-ascii characters)
+        timers.start('output')
+        title, printable_authors, printable_venue = \
+            printable(title.strip()), printable(authors.strip()), printable(venue.strip())
+        if len(printable_authors) and len(printable_venue) and binary_intermediate_output:
+            intermediate_records.write_record(
+                output_file, title, printable_authors, year, printable_venue, index, reference_ids,
+                '%s:%s' % (filename, orig_filename)
+            )
+            papers_written += 1
+        elif len(printable_authors) and len(printable_venue):
+            output_file.write('#*%s\n' % title)
+            output_file.write('#@%s\n' % printable_authors)
+            output_file.write('#year%d\n' % year)
+            output_file.write('#conf%s\n' % printable_venue)
+            output_file.write('#index%d\n' % index)
+            output_file.write('#path%s:%s\n' % (filename, orig_filename))
+            output_file.write(''.join(['#%%%d\n' % ref_id for ref_id in reference_ids]) + '\n')
+            papers_written += 1
+        else:
+            stats.docs_missing_printable_data += 1
+        timers.stop()
 
-        # Open zip file, or skip if invalid
-        try:
-            zipped_file = zipfile.ZipFile(full_file_path, "r")
-        except zipfile.BadZipfile, e:
-            log(num_to_skip, "Skipping '%s', error opening zip file: '%s'" % (full_file_path, e.message))
-            continue
-        except AssertionError, e:
-            log(num_to_skip, "Skipping '%s', assertion error: '%s'" % (full_file_path, e.message))
-            continue
-        except IOError, e:
-            log(num_to_skip, "Skipping '%s', I/O error: '%s'" % (full_file_path, e.message))
-            continue
+        # Record the id of each paper written
+        if paper_ids is not None and len(printable_authors) and len(printable_venue):
+            paper_ids.append(index)
 
-        for title, authors, year, venue, index, reference_ids, orig_filename in gen_documents_from_file(zipped_file):
-
-            # Inefficient tallies
-            if tally_venues_and_titles:
-                title_counts[title] += 1
-                venue_counts[venue] += 1
-
-            # Output paper data to output file (just remove non-ascii characters)
-            title, printable_authors, printable_venue = \
-                printable(title.strip()), printable(authors.strip()), printable(venue.strip())
-            if len(printable_authors) and len(printable_venue):
-                output_file.write('#*%s\n' % title)
-                output_file.write('#@%s\n' % printable_authors)
-                output_file.write('#year%d\n' % year)
-                output_file.write('#conf%s\n' % printable_venue)
-                output_file.write('#index%d\n' % index)
-                output_file.write('#path%s:%s\n' % (filename, orig_filename))
-                output_file.write(''.join(['#%%%d\n' % ref_id for ref_id in reference_ids]) + '\n')
-            else:
-                docs_missing_printable_data += 1
+        # Write the current progress to stdout (intermittently)
+        if report_progress is not None and stats.documents_processed % 100 == 0:
+            report_progress()
 
-            # Write the current progress to stdout (intermittently)
-            if documents_processed % 100 == 0:
-                output_progress(
-                    num_to_skip, estimated_total_documents, num_to_process, zip_files_processed, documents_processed
-                )
+    # Cleanup
+    zipped_file.close()
 
-        # Output parsing progress
-        zip_files_processed += 1
+    return papers_written
 
-        # Cleanup
-        zipped_file.close()
 
-        # Update the progress
-        output_progress(
-            num_to_skip, estimated_total_documents, num_to_process, zip_files_processed, documents_processed, flush=True
-        )
+def output_stats(num_to_skip, tally_venues_and_titles=True):
+    """
+      Output document & reference statistics for this slave
+    """
 
-    # Output document & reference statistics
-    output_message = build_document_stats_message()
-    output_message += build_reference_stats_message()
+    output_message = parse_stats.build_stats_message(
+        total_stats, fingerprint_audit if audit_fingerprint_collisions else None
+    )
+    output_message += build_timing_stats_message()
     if tally_venues_and_titles:
-        output_message += build_title_and_venue_tallies_message()
+        output_message += parse_stats.build_title_and_venue_tallies_message(total_tallies)
     if output_to_standard_out:
         print output_message
     else:
         with open(os.path.join(intermediate_results_folder, '%d-stats.txt') % num_to_skip, 'w') as output_file:
             output_file.write(output_message)
 
+    # Write the stage timings in a machine-readable form too, with their histograms
+    with open(os.path.join(intermediate_results_folder, '%d-timings.json' % num_to_skip), 'w') as timings_file:
+        json.dump({'slave': num_to_skip, 'stages': timers.report()}, timings_file, sort_keys=True)
+
+
+def parse_zip_file_to_shard(filename, num_to_skip, tally_venues_and_titles=True, report_progress=None,
+                            prefetched=None):
+    """
+      Parse one zip file into its own shard of intermediate output, which is only committed (and the zip file recorded
+      as complete) once the whole zip file has been parsed. Zip files that can't be opened are left to be retried.
+      Returns the number of papers written, and the stats & tallies of parsing the zip file (or None if it wasn't
+      committed, or wasn't tallied).
+    """
+
+    global stats, tallies
+    stats = parse_stats.ParseStats()
+    tallies = parse_stats.Tallies()
+
+    zip_file_path = os.path.join(data_path, filename)
+    try:
+        zip_file_stat = os.stat(zip_file_path)
+    except OSError, e:
+        log(num_to_skip, "Skipping '%s', I/O error: '%s'" % (zip_file_path, e.strerror), zip_file=filename)
+        if prefetched is not None and prefetched[0] is not None:
+            prefetched[0].close()
+        return 0, None, None
+
+    # Collect the ids of the papers written, to commit as a sorted run alongside the shard (if they fit in 64 bits)
+    paper_ids = [] if fingerprints.compact_fingerprints else None
+
+    shard_file = first_pass_manifest.open_shard(filename, binary_intermediate_output)
+    try:
+        papers_written = parse_zip_file(
+            filename, shard_file, num_to_skip, tally_venues_and_titles, report_progress, paper_ids, prefetched
+        )
+    except:
+        first_pass_manifest.discard_shard(shard_file)
+        raise
+
+    if papers_written is None:
+        first_pass_manifest.discard_shard(shard_file)
+        return 0, None, None
+
+    if paper_ids is not None:
+        stats.hash_collision_count += len(paper_ids) - len(set(paper_ids))
+    zip_file_tallies = tallies if tally_venues_and_titles else None
+    first_pass_manifest.commit_shard(
+        filename, zip_file_path, zip_file_stat, shard_file, paper_ids, stats, zip_file_tallies
+    )
+
+    # Add the zip file's stats & tallies to the totals, counting the next zip file's from scratch
+    zip_file_stats = stats
+    total_stats.merge(zip_file_stats)
+    stats = parse_stats.ParseStats()
+    if zip_file_tallies is not None:
+        total_tallies.merge(zip_file_tallies)
+    tallies = parse_stats.Tallies()
+    return papers_written, zip_file_stats, zip_file_tallies
+
+
+def prefetch_zip_files(filenames):
+    """
+      Generator over the given zip files, as (filename, prefetched zip file), reading their members ahead of parsing on
+      a background thread (or just the file names, with nothing prefetched, if prefetching is off)
+    """
+
+    global prefetcher
+
+    if not prefetch_depth:
+        for filename in filenames:
+            yield filename, None
+        return
+
+    prefetcher = zip_prefetch.ZipPrefetcher(
+        filenames, lambda filename: raw_catalog.open_zip_file(os.path.join(data_path, filename), catalog),
+        prefetch_depth, prefetch_byte_budget, lambda name: name.endswith('xml'), timers
+    )
+    for filename, zipped_file, error in prefetcher:
+        yield filename, (zipped_file, error)
+
+
+def main(num_to_skip, num_to_process, tally_venues_and_titles=True):
+
+    global zip_files_processed
+
+    # Estimate the max documents & files to process
+    estimated_total_documents = int(float(num_to_process) / total_zip_files * total_papers)
+    report_progress = lambda flush=False: output_progress(
+        num_to_skip, estimated_total_documents, num_to_process, zip_files_processed,
+        total_stats.documents_processed + stats.documents_processed, flush=flush
+    )
+
+    # Resume after the zip files finished by an earlier run (that haven't changed since)
+    manifest = first_pass_manifest.read_manifest()
+
+    zip_files = os.listdir(data_path)[num_to_skip + 1:num_to_skip + 1 + num_to_process]
+    zip_files_to_parse = []
+    for filename in zip_files:
+        unchanged = filename in manifest and \
+            first_pass_manifest.is_unchanged(manifest[filename], os.path.join(data_path, filename)) is not None
+        if unchanged:
+            zip_files_processed += 1
+        else:
+            zip_files_to_parse.append(filename)
+
+    for filename, prefetched in prefetch_zip_files(zip_files_to_parse):
+        parse_zip_file_to_shard(filename, num_to_skip, tally_venues_and_titles, report_progress, prefetched)
+
+        # Output parsing progress (and anything logged while parsing)
+        zip_files_processed += 1
+        report_progress(flush=True)
+        flush_logs()
+
+    output_stats(num_to_skip, tally_venues_and_titles)
+
+
+def collect_metrics():
+    """
+      Get the metrics of this slave's progress so far: cumulative counts of documents & bytes parsed and errors, and how
+      much is read ahead of parsing
+    """
+
+    metrics = {
+        'documents': total_stats.documents_found + stats.documents_found,
+        'bytes': total_stats.bytes_parsed + stats.bytes_parsed,
+        'errors': total_stats.documents_errors + stats.documents_errors,
+        'zip_files': zip_files_processed,
+    }
+    if prefetcher is not None:
+        metrics['prefetched_members'] = len(prefetcher.items)
+        metrics['prefetched_bytes'] = prefetcher.buffered_bytes
+        metrics['prefetch_stalls'] = prefetcher.stall_count
+    return metrics
+
+
+def work(slave_id, tally_venues_and_titles=True):
+    """
+      Parse zip files handed out by the master (one file name per line on stdin) until stdin is closed, reporting each
+      finished zip file, and metrics of progress while parsing, back to the master on stdout
+    """
+
+    global zip_files_processed, metrics_reporter
+
+    # Keep stdout for messages to the master, and send anything else printed to stderr
+    master_channel = os.fdopen(os.dup(sys.stdout.fileno()), 'w', 1)
+    sys.stdout = sys.stderr
+    metrics_reporter = progress_metrics.MetricsReporter(master_channel, collect_metrics)
+
+    filenames = (line.rstrip('\n') for line in iter(sys.stdin.readline, '') if line.rstrip('\n'))
+    for filename, prefetched in prefetch_zip_files(filenames):
+        papers_written, zip_file_stats, zip_file_tallies = parse_zip_file_to_shard(
+            filename, slave_id, tally_venues_and_titles, prefetched=prefetched
+        )
+        zip_files_processed += 1
+        flush_logs()
+
+        # Send the zip file's stats & tallies along with it (if it was committed), for the master to add up
+        summaries = [summary.to_json() for summary in [zip_file_stats, zip_file_tallies] if summary is not None]
+        master_channel.write('done\t%s\n' % '\t'.join([filename, str(papers_written)] + summaries))
+
+    output_stats(slave_id, tally_venues_and_titles)
+    master_channel.close()
+
+
+def pop_option(name, default=None):
+    """
+      Remove an option & its value from anywhere in the arguments, returning the value (or the default if not given)
+    """
+
+    if name not in sys.argv:
+        return default
+    option_index = sys.argv.index(name)
+    if option_index + 1 >= len(sys.argv):
+        output_usage(0)
+    value = sys.argv[option_index + 1]
+    del sys.argv[option_index:option_index + 2]
+    return value
+
 
 def output_usage(num_to_skip):
     """
@@ -705,10 +923,17 @@ def output_usage(num_to_skip):
 
     log(num_to_skip,
         "USAGE: \033[1m first_pass_slave_parser.py <start> <num> <progress on stdout> [<debug>]\033[0m\n" +
+        "       \033[1m first_pass_slave_parser.py --slave <slave id>\033[0m\n" +
         "\t\033[1m<start>\033[0m: the number of zip file to parse first (numbered from 1)\n" +
         "\t\033[1m<num>\033[0m: the number of files following to parse\n" +
         "\t\033[1m<progress on stdout>\033[0m: whether to show progress on standard out ('y') or in file ('n')\n" +
-        "\t\033[1m<debug>\033[0m: whether or not ('y' / 'n') to profile or tally titles and venues during parsing")
+        "\t\033[1m--slave <slave id>\033[0m: parse the zip files named on stdin, as handed out by the master\n" +
+        "\t\033[1m--binary\033[0m: write intermediate output in the binary record format (anywhere in the arguments)\n" +
+        "\t\033[1m--catalog <path>\033[0m: read zip files through this raw data catalog (anywhere in the arguments)\n" +
+        "\t\033[1m--prefetch <depth>\033[0m: read zip files this far ahead of parsing them (0 to not read ahead)\n" +
+        "\t\033[1m--prefetch-budget <MB>\033[0m: the most decompressed data to read ahead at once\n" +
+        "\t\033[1m--no-tally\033[0m: don't tally the most frequent titles and venues (anywhere in the arguments)\n" +
+        "\t\033[1m<debug>\033[0m: whether or not ('y' / 'n') to profile parsing")
     sys.exit()
 
 
@@ -717,6 +942,42 @@ if __name__ == "__main__":
     max_num_args = 5
     min_num_args = 4
 
+    # Write intermediate output in the binary record format, if asked (which needs fixed-width paper ids)
+    if '--binary' in sys.argv:
+        sys.argv.remove('--binary')
+        if not fingerprints.compact_fingerprints:
+            output_usage(0)
+        binary_intermediate_output = True
+
+    # Tally the most frequent titles & venues, unless asked not to
+    tally_venues_and_titles = '--no-tally' not in sys.argv
+    if not tally_venues_and_titles:
+        sys.argv.remove('--no-tally')
+
+    # Read zip files through the catalog of the raw data, if given
+    catalog_path = pop_option('--catalog')
+    if catalog_path is not None:
+        catalog = raw_catalog.Catalog(catalog_path)
+
+    # Read ahead this many zip files, or hold at most this many MB of decompressed members, if given
+    try:
+        prefetch_depth = int(pop_option('--prefetch', prefetch_depth))
+        prefetch_byte_budget = int(pop_option('--prefetch-budget', prefetch_byte_budget / 1024 / 1024)) * 1024 * 1024
+    except ValueError:
+        output_usage(0)
+
+    # Run as one of the master's slaves, parsing whichever zip files it hands out
+    if len(sys.argv) > 1 and sys.argv[1] == '--slave':
+        if len(sys.argv) != 3:
+            output_usage(0)
+        try:
+            num_to_skip = int(sys.argv[2])
+        except ValueError:
+            output_usage(0)
+        output_to_standard_out = False
+        work(num_to_skip, tally_venues_and_titles)
+        sys.exit()
+
     # Verify correct number of arguments
     if len(sys.argv) < min_num_args or len(sys.argv) > max_num_args:
         output_usage(0)
@@ -731,9 +992,6 @@ if __name__ == "__main__":
     except ValueError:
         output_usage(num_to_skip)
 
-    # Based the output path off of the starting file
-    output_path = os.path.join(intermediate_results_folder, '%d-intermediate_output.txt' % num_to_skip)
-
     # Parse whether or not progress should be output to standard out (rather than static file)
     if sys.argv[3][0] not in {'y', 'n', 'Y', 'N'}:
         output_usage(num_to_skip)
@@ -746,8 +1004,8 @@ if __name__ == "__main__":
     should_profile = len(sys.argv) > min_num_args and sys.argv[min_num_args][0] in {'y', 'Y'}
 
     if should_profile:
-        cProfile.run("main('%s', %d, %d, tally_venues_and_titles=%r)" % (
-            output_path, num_to_skip, num_to_process, should_profile
+        cProfile.run("main(%d, %d, tally_venues_and_titles=%r)" % (
+            num_to_skip, num_to_process, tally_venues_and_titles
         ))
     else:
-        main(output_path, num_to_skip, num_to_process, tally_venues_and_titles=should_profile)
+        main(num_to_skip, num_to_process, tally_venues_and_titles)
@@ -0,0 +1,56 @@
+import numpy
+
+__author__ = 'jontedesco'
+
+
+def id_array(ids):
+    """
+      Pack paper ids into a contiguous int64 array (or an array of objects, for full 160-bit ids)
+    """
+
+    try:
+        return numpy.array(ids, dtype=numpy.int64)
+    except OverflowError:
+        return numpy.array(ids, dtype=object)
+
+
+def concatenate(arrays):
+    """
+      Join arrays of paper ids into one array
+    """
+
+    if not len(arrays):
+        return numpy.zeros(0, dtype=numpy.int64)
+    return numpy.concatenate(arrays)
+
+
+def find_collisions(ids):
+    """
+      Sort & deduplicate an array of paper ids with a single sort, returning the sorted unique ids, the sorted ids found
+      more than once, and the number of repeated ids
+    """
+
+    unique_ids, counts = numpy.unique(ids, return_counts=True)
+    return unique_ids, unique_ids[counts > 1], int((counts - 1).sum())
+
+
+def in_sorted(sorted_ids, ids):
+    """
+      Test which of an array of paper ids are found in a sorted array of paper ids, with one binary search per id
+    """
+
+    if not len(sorted_ids):
+        return numpy.zeros(len(ids), dtype=bool)
+
+    positions = numpy.searchsorted(sorted_ids, ids)
+    positions[positions == len(sorted_ids)] = 0
+    return sorted_ids[positions] == ids
+
+
+def ordinals(sorted_ids, ids):
+    """
+      Get the position of each of an array of paper ids in a sorted array of unique paper ids (which must contain them
+      all), as dense ordinals from 0 to the number of papers
+    """
+
+    return numpy.searchsorted(sorted_ids, ids).astype(numpy.uint32)
@@ -0,0 +1,92 @@
+import mmap
+import os
+import struct
+
+__author__ = 'jontedesco'
+
+# Binary intermediate output holds one record per paper:
+#   record length (uint32, including this header) | index (int64) | year (uint16) | number of references (uint32)
+#   | title, authors, venue & path (each a uint32 length, then the string)
+#   | reference ids (int64 each)
+# All little-endian, so papers can be read straight out of a memory-mapped file without parsing any text.
+record_header = struct.Struct('<IqHI')
+index_header = struct.Struct('<Iq')
+string_length = struct.Struct('<I')
+binary_suffix = 'intermediate_output.bin'
+
+
+def write_record(output_file, title, authors, year, venue, index, reference_ids, path):
+    """
+      Write one paper to a binary intermediate output file
+    """
+
+    strings = ''.join([string_length.pack(len(s)) + s for s in (title, authors, venue, path)])
+    references = struct.pack('<%dq' % len(reference_ids), *reference_ids)
+    record_length = record_header.size + len(strings) + len(references)
+    output_file.write(record_header.pack(record_length, index, year, len(reference_ids)) + strings + references)
+
+
+def map_file(input_file_path):
+    """
+      Memory-map a binary intermediate output file, or return None if it's empty
+    """
+
+    if not os.path.getsize(input_file_path):
+        return None
+    with open(input_file_path, 'rb') as input_file:
+        return mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def read_indices(input_file_path):
+    """
+      Generator over the index of each paper in a binary intermediate output file, skipping the rest of each record
+    """
+
+    data = map_file(input_file_path)
+    if data is None:
+        return
+
+    offset = 0
+    end = len(data)
+    while offset < end:
+        record_length, index = index_header.unpack_from(data, offset)
+        yield index
+        offset += record_length
+    data.close()
+
+
+def read_records(input_file_path):
+    """
+      Generator over the papers in a binary intermediate output file, as (title, authors, year, venue, index,
+      reference ids, path) tuples, without copying any of their data out of the memory-mapped file: strings are
+      read-only buffer views of it (Python 2 memory maps don't support memoryview) & reference ids an int64 array over
+      it. The map stays open as long as any of them are still referenced.
+    """
+
+    # NumPy is only needed to read records (slaves write them without it)
+    import numpy
+
+    data = map_file(input_file_path)
+    if data is None:
+        return
+
+    offset = 0
+    end = len(data)
+    while offset < end:
+        record_length, index, year, reference_count = record_header.unpack_from(data, offset)
+        position = offset + record_header.size
+
+        # Read the length-prefixed strings
+        strings = []
+        for i in xrange(0, 4):
+            length, = string_length.unpack_from(data, position)
+            position += string_length.size
+            strings.append(buffer(data, position, length))
+            position += length
+        title, authors, venue, path = strings
+
+        # Read the packed reference ids
+        reference_ids = numpy.frombuffer(data, dtype='<i8', count=reference_count, offset=position)
+
+        yield title, authors, year, venue, index, reference_ids, path
+        offset += record_length
@@ -0,0 +1,328 @@
+from collections import defaultdict
+import first_pass_manifest
+import json
+import os
+import top_k
+from text_normalization import printable
+
+__author__ = 'jontedesco'
+
+# The counts kept while parsing: of documents found (and their bytes), processed & skipped for each reason, of
+# references parsed & skipped for each reason, of hash collisions within each shard, and of stem cache lookups
+counter_names = [
+    'documents_found',
+    'bytes_parsed',
+    'documents_processed',
+    'books_skipped',
+    'documents_errors',
+    'documents_missing_authors',
+    'documents_missing_venue',
+    'documents_missing_title',
+    'documents_fb_non_chapter',
+    'documents_missing_authors_fb_non_chapter',
+    'empty_xml_files',
+    'documents_skipped_from_title',
+    'docs_missing_printable_data',
+    'references_in_unexpected_format',
+    'references_in_plaintext',
+    'references_without_titles',
+    'references_without_authors',
+    'references_without_date',
+    'references_with_invalid_date',
+    'references_attempted',
+    'references_succeeded',
+    'docs_missing_references',
+    'docs_with_few_references',
+    'hash_collision_count',
+    'stem_cache_hits',
+    'stem_cache_misses',
+]
+
+# How many titles & venues to keep counts for when tallying them, in all and within each year & document type
+tally_capacity = top_k.default_capacity
+group_tally_capacity = 100
+
+
+class ParseStats(object):
+    """
+      Counts of what was found while parsing some zip files, along with the count of each type of document processed.
+      Counts are merged by adding them up, so the stats of zip files can be merged in any order or grouping (per slave,
+      or across the whole corpus) with the same result.
+    """
+
+    __slots__ = counter_names + ['document_types']
+
+    def __init__(self):
+        for name in counter_names:
+            setattr(self, name, 0)
+        self.document_types = defaultdict(int)
+
+    def merge(self, other):
+        """
+          Add the counts of other stats to these, returning these stats
+        """
+
+        for name in counter_names:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        for document_type, count in other.document_types.iteritems():
+            self.document_types[document_type] += count
+        return self
+
+    def to_json(self):
+        counts = dict((name, getattr(self, name)) for name in counter_names)
+        counts['document_types'] = self.document_types
+        return json.dumps(counts, sort_keys=True)
+
+    @staticmethod
+    def from_json(data):
+        """
+          Read stats serialized with to_json (counts missing from it, e.g. those added since it was written, are 0)
+        """
+
+        counts = json.loads(data)
+        stats = ParseStats()
+        for name in counter_names:
+            setattr(stats, name, counts.get(name, 0))
+        for document_type, count in counts.get('document_types', {}).iteritems():
+            stats.document_types[document_type] += count
+        return stats
+
+
+def read_stats(path):
+    """
+      Read the stats written to a file, or None if there are none
+    """
+
+    if not os.path.exists(path):
+        return None
+    with open(path) as stats_file:
+        return ParseStats.from_json(stats_file.read())
+
+
+def read_zip_file_stats(zip_file, folder=first_pass_manifest.intermediate_results_folder):
+    """
+      Read the stats committed alongside a zip file's shard, or None if there are none (e.g. the shard was written
+      before stats were kept per zip file)
+    """
+
+    return read_stats(os.path.join(folder, first_pass_manifest.stats_name(zip_file)))
+
+
+def write_stats_file(path, stats):
+    """
+      Atomically (re)write stats to a file, so it can be read while it's being updated
+    """
+
+    with open(path + first_pass_manifest.partial_shard_suffix, 'w') as stats_file:
+        stats_file.write(stats.to_json())
+    os.rename(path + first_pass_manifest.partial_shard_suffix, path)
+
+
+count_and_percent = lambda a, b: (a, b, float(a) / b * 100 if b > 0 else 0)
+
+
+def build_reference_stats_message(stats):
+    """
+      Output statistics about document references
+    """
+
+    # Output document reference errors
+    output_message = "\nDocument Reference Errors Found:\n"
+    m = stats.references_attempted
+    output_message += "\tReferences In Unexpected Format: %d / %d (%2.2f%%)\n" % \
+                      count_and_percent(stats.references_in_unexpected_format, m)
+    m -= stats.references_in_unexpected_format
+    output_message += "\tReferences in Plain Text: %d / %d (%2.2f%%)\n" % \
+                      count_and_percent(stats.references_in_plaintext, m)
+    m -= stats.references_in_plaintext
+    output_message += "\tReferences Without Titles: %d / %d (%2.2f%%)\n" % \
+                      count_and_percent(stats.references_without_titles, m)
+    m -= stats.references_without_titles
+    output_message += "\tReferences Without Authors: %d / %d (%2.2f%%)\n" % \
+                      count_and_percent(stats.references_without_authors, m)
+    m -= stats.references_without_authors
+    output_message += "\tReferences Without Date: %d / %d (%2.2f%%)\n" % \
+                      count_and_percent(stats.references_without_date, m)
+    m -= stats.references_without_date
+    output_message += "\tReferences With Invalid Date: %d / %d (%2.2f%%)\n" % \
+                      count_and_percent(stats.references_with_invalid_date, m)
+    m -= stats.references_with_invalid_date
+    output_message += "\tReferences Succeeded: %d / %d (%2.2f%%)\n" % \
+                      count_and_percent(stats.references_succeeded, stats.references_attempted)
+
+    # Don't raise a fatal error if counts are not as expected
+    if m != stats.references_succeeded:
+        print "Document reference tally failed!!! m: %d, actually succeeded: %d" % (m, stats.references_succeeded)
+
+    # Try to estimate the recall of references
+    output_message += "\nDocuments Without References: %d / %d (%2.2f%%)\n" % \
+                      count_and_percent(stats.docs_missing_references, stats.documents_processed)
+    output_message += "\nDocuments With Few References: %d / %d (%2.2f%%)\n" % \
+                      count_and_percent(stats.docs_with_few_references, stats.documents_processed)
+
+    return output_message
+
+
+def build_document_stats_message(stats, fingerprint_audit=None):
+    """
+      Output statistics about documents (and about fingerprint collisions, if they were audited)
+    """
+
+    # Fatal paper parsing errors (most likely bad data)
+    n = stats.documents_found
+    output_message = "\nDocument Errors (Fatal):\n"
+    output_message += "\tEmpty Document Files: %d / %d (%2.2f%%)\n" % count_and_percent(stats.empty_xml_files, n)
+    n -= stats.empty_xml_files
+    output_message += "\tBooks Skipped: %d / %d (%2.2f%%)\n" % count_and_percent(stats.books_skipped, n)
+    n -= stats.books_skipped
+    output_message += "\tDocuments Missing Title: %d / %d (%2.2f%%)\n" % \
+                      count_and_percent(stats.documents_missing_title, n)
+    n -= stats.documents_missing_title
+    output_message += "\tDocuments Skipped Based on Title: %d / %d (%2.2f%%)\n" % \
+                      count_and_percent(stats.documents_skipped_from_title, n)
+    n -= stats.documents_skipped_from_title
+    output_message += "\tDocuments Skipped From Non-Chapter Tag: %d / %d (%2.2f%%)\n" % \
+                      count_and_percent(stats.documents_fb_non_chapter, n)
+    n -= stats.documents_fb_non_chapter
+    output_message += "\tDocuments Missing Authors: %d / %d (%2.2f%%)\n" % \
+                      count_and_percent(stats.documents_missing_authors, n)
+    n -= stats.documents_missing_authors
+    output_message += "\tDocuments Missing Venue: %d / %d (%2.2f%%)\n" % \
+                      count_and_percent(stats.documents_missing_venue, n)
+    n -= stats.documents_missing_venue
+    output_message += '\tDocuments Skipped (Unknown Error): %d / %d (%2.2f%%)\n' % \
+                      count_and_percent(stats.documents_errors, n)
+    n -= stats.documents_errors
+
+    if n != stats.documents_processed:
+        print "Document tally failed!!! n: %d, actually succeeded: %d" % (n, stats.documents_processed)
+
+    output_message += "\nDocuments Missing Printable Data: %d / %d/ (%2.2f%%)\n" % \
+                      count_and_percent(stats.docs_missing_printable_data, n)
+
+    # Non-fatal document parsing errors (potentially bad data)
+    output_message += "\nDocument Errors (Ignored):\n"
+    output_message += "\tDocument Hash Collisions: %d / %d (%2.2f%%)\n" % \
+                      count_and_percent(stats.hash_collision_count, n)
+    if fingerprint_audit is not None:
+        output_message += "\tFingerprint Collisions (Different Keys): %d / %d (%2.2f%%)\n" % \
+                          count_and_percent(fingerprint_audit.collisions, fingerprint_audit.ids_checked)
+
+    # Breakdown of type of documents encountered
+    output_message += "\nDocument Types:\n"
+    for key, count in stats.document_types.iteritems():
+        output_message += "\t%s: %d / %d (%2.2f%%)\n" % \
+                          tuple([key.title()] + list(count_and_percent(count, stats.documents_processed)))
+
+    return output_message
+
+
+def build_stem_cache_stats_message(stats):
+    """
+      Output statistics about the cache of stemmed terms
+    """
+
+    lookups = stats.stem_cache_hits + stats.stem_cache_misses
+    output_message = "\nStem Cache:\n"
+    output_message += "\tStem Cache Hits: %d / %d (%2.2f%%)\n" % count_and_percent(stats.stem_cache_hits, lookups)
+    output_message += "\tStem Cache Misses: %d / %d (%2.2f%%)\n" % count_and_percent(stats.stem_cache_misses, lookups)
+
+    return output_message
+
+
+def build_stats_message(stats, fingerprint_audit=None):
+    """
+      Output all document, reference & stem cache statistics
+    """
+
+    return build_document_stats_message(stats, fingerprint_audit) + build_reference_stats_message(stats) + \
+        build_stem_cache_stats_message(stats)
+
+
+class Tallies(object):
+    """
+      The most frequent titles & venues, overall and (for titles) within each year & document type, in bounded memory
+      (see top_k.py), so they can be tallied across the whole corpus & merged across slaves
+    """
+
+    def __init__(self, capacity=tally_capacity, group_capacity=group_tally_capacity):
+        self.titles = top_k.SpaceSaving(capacity)
+        self.venues = top_k.SpaceSaving(capacity)
+        self.titles_by_year = top_k.GroupedSpaceSaving(group_capacity)
+        self.titles_by_document_type = top_k.GroupedSpaceSaving(group_capacity)
+
+    def add(self, title, venue, year, document_type):
+        self.titles.add(title)
+        self.venues.add(venue)
+        self.titles_by_year.add(year, title)
+        self.titles_by_document_type.add(document_type, title)
+
+    def merge(self, other):
+        self.titles.merge(other.titles)
+        self.venues.merge(other.venues)
+        self.titles_by_year.merge(other.titles_by_year)
+        self.titles_by_document_type.merge(other.titles_by_document_type)
+        return self
+
+    def to_json(self):
+        return json.dumps({
+            'titles': self.titles.to_object(),
+            'venues': self.venues.to_object(),
+            'titles_by_year': self.titles_by_year.to_object(),
+            'titles_by_document_type': self.titles_by_document_type.to_object(),
+        }, sort_keys=True)
+
+    @staticmethod
+    def from_json(data):
+        data = json.loads(data)
+        tallies = Tallies()
+        tallies.titles = top_k.SpaceSaving.from_object(data['titles'])
+        tallies.venues = top_k.SpaceSaving.from_object(data['venues'])
+        tallies.titles_by_year = top_k.GroupedSpaceSaving.from_object(data['titles_by_year'])
+        tallies.titles_by_document_type = top_k.GroupedSpaceSaving.from_object(data['titles_by_document_type'])
+        return tallies
+
+
+def read_zip_file_tallies(zip_file, folder=first_pass_manifest.intermediate_results_folder):
+    """
+      Read the tallies committed alongside a zip file's shard, or None if there are none (e.g. it wasn't tallied)
+    """
+
+    path = os.path.join(folder, first_pass_manifest.tallies_name(zip_file))
+    if not os.path.exists(path):
+        return None
+    with open(path) as tallies_file:
+        return Tallies.from_json(tallies_file.read())
+
+
+def format_tally(item, count, error):
+    return "\t%s: %d%s\n" % (printable(item), count, ' (may be over by %d)' % error if error else '')
+
+
+def build_title_and_venue_tallies_message(tallies, k=10, group_k=3):
+    """
+      Output tallies for the most common titles and venues (and titles in each document type & year), with the most
+      each count could be over by, if it's approximate
+    """
+
+    output_message = "\nMost Frequent Titles (of %d):\n" % tallies.titles.total
+    for item, count, error in tallies.titles.top(k):
+        output_message += format_tally(item, count, error)
+
+    output_message += "\nMost Frequent Venues (of %d):\n" % tallies.venues.total
+    for item, count, error in tallies.venues.top(k):
+        output_message += format_tally(item, count, error)
+
+    output_message += "\nMost Frequent Titles by Document Type:\n"
+    for document_type in sorted(tallies.titles_by_document_type.groups):
+        output_message += "  %s:\n" % printable(document_type).title()
+        for item, count, error in tallies.titles_by_document_type.top(document_type, group_k):
+            output_message += format_tally(item, count, error)
+
+    output_message += "\nMost Frequent Titles by Year:\n"
+    for year in sorted(tallies.titles_by_year.groups):
+        output_message += "  %d:\n" % year
+        for item, count, error in tallies.titles_by_year.top(year, group_k):
+            output_message += format_tally(item, count, error)
+
+    return output_message
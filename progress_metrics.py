@@ -0,0 +1,106 @@
+from collections import deque
+import json
+import stage_timers
+
+__author__ = 'jontedesco'
+
+# How often each slave sends its metrics to the master (at most, since they're only sent between documents)
+default_interval = 1.0
+
+# The number of seconds of recent metrics rates are measured over
+rate_window = 10.0
+
+# A slave with zip files to parse that makes no progress for this many seconds is reported as stalled
+default_stall_seconds = 30.0
+
+# The cumulative counts in each metrics message, whose rates are tracked (other metrics, e.g. queue depths, are just
+# the latest value)
+counted_metrics = ['documents', 'bytes', 'errors']
+
+
+def format_message(metrics):
+    """
+      Frame metrics as one message on a slave's channel to the master (a single line, like the master's other messages)
+    """
+
+    return 'metrics\t%s\n' % json.dumps(metrics, sort_keys=True)
+
+
+def parse_message(message):
+    """
+      Read the metrics from a message on a slave's channel, already split into its tab-separated fields
+    """
+
+    return json.loads(message[1])
+
+
+class MetricsReporter(object):
+    """
+      Sends a slave's metrics to the master, at most once per interval. The metrics are collected by the given function
+      (only when they're due), with cumulative counts of documents & bytes parsed and errors, and current queue depths.
+    """
+
+    def __init__(self, channel, collect_metrics, interval=default_interval):
+        self.channel = channel
+        self.collect_metrics = collect_metrics
+        self.interval = interval
+        self.last_sent = None
+
+    def tick(self):
+        """
+          Send the metrics, if they're due
+        """
+
+        now = stage_timers.timer()
+        if self.last_sent is not None and now - self.last_sent < self.interval:
+            return
+        self.last_sent = now
+        self.channel.write(format_message(self.collect_metrics()))
+        self.channel.flush()
+
+
+class Throughput(object):
+    """
+      The rates of a slave's cumulative counts, over the metrics it sent in the last rate window (timed by when they
+      arrived, so slaves' clocks don't matter), and when it last made progress
+    """
+
+    def __init__(self, now):
+        self.samples = deque()
+        self.latest = {}
+        self.last_progress = now
+        self.stalled = False
+
+    def add(self, now, metrics):
+        """
+          Record the metrics just received from the slave
+        """
+
+        if self.samples and metrics.get('documents', 0) != self.samples[-1][1].get('documents', 0):
+            self.progressed(now)
+        self.samples.append((now, metrics))
+        self.latest = metrics
+        while len(self.samples) > 2 and now - self.samples[1][0] >= rate_window:
+            self.samples.popleft()
+
+    def progressed(self, now):
+        self.last_progress = now
+        self.stalled = False
+
+    def rate(self, name, now):
+        """
+          Get the rate per second of a cumulative count over the rate window up to now, so the rate falls away when the
+          slave stops sending metrics (counts restarting, e.g. when a zip file is retried, don't count as negative
+          progress)
+        """
+
+        if len(self.samples) < 2:
+            return 0.0
+        (first_time, first), (last_time, last) = self.samples[0], self.samples[-1]
+        now = max(now, last_time)
+        if now <= first_time:
+            return 0.0
+        return max(0, last.get(name, 0) - first.get(name, 0)) / (now - first_time)
+
+    def is_stalled(self, now, stall_seconds=default_stall_seconds):
+        return now - self.last_progress >= stall_seconds
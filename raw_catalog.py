@@ -0,0 +1,328 @@
+import argparse
+from collections import namedtuple, OrderedDict
+from cStringIO import StringIO
+import multiprocessing
+import os
+import re
+import sqlite3
+import struct
+import sys
+import zipfile
+import zlib
+
+__author__ = 'jontedesco'
+
+# The path to the input data
+data_path = 'data'
+if not os.path.exists(data_path):
+    data_path = '/mnt/fcroot/full-arnetminer/data'
+
+# The catalog of every member of every zip file of the input data, kept in a local SQLite database
+catalog_path = 'raw_catalog.sqlite'
+
+# What the catalog records about each member: where it is in its zip file (so it can be read straight from its local
+# header), and metadata sniffed from the start of its XML (None if not found there)
+Member = namedtuple('Member', [
+    'zip_file', 'name', 'compressed_size', 'file_size', 'crc', 'header_offset', 'compress_type', 'aggregation_type',
+    'year'
+])
+
+# The fixed-size part of a zip file's local file header, followed by the member's name & extra field
+local_header = struct.Struct('<IHHHHHIIIHH')
+local_header_signature = 0x04034b50
+
+# How much of the start of each member to decompress, to sniff its metadata
+sniff_size = 16 * 1024
+aggregation_type_regex = re.compile(r'<(?:\w+:)?aggregationType>([^<]*)<')
+cover_date_regex = re.compile(r'<(?:\w+:)?coverDisplayDate>[^<]*?(\d{4})')
+copyright_year_regex = re.compile(r'<(?:\w+:)?copyright[^>]*year="(\d{4})"')
+
+schema = [
+    'CREATE TABLE IF NOT EXISTS zip_files (zip_file TEXT PRIMARY KEY, size INTEGER, mtime INTEGER)',
+    'CREATE TABLE IF NOT EXISTS members (zip_file TEXT, name TEXT, compressed_size INTEGER, file_size INTEGER, '
+    'crc INTEGER, header_offset INTEGER, compress_type INTEGER, aggregation_type TEXT, year INTEGER, '
+    'PRIMARY KEY (zip_file, name))',
+    'CREATE INDEX IF NOT EXISTS members_by_type ON members (aggregation_type, year)',
+    'CREATE INDEX IF NOT EXISTS members_by_year ON members (year)',
+]
+
+
+def member_data_offset(raw_file, member):
+    """
+      Find where a member's data starts in its (open) zip file, from its local header
+    """
+
+    raw_file.seek(member.header_offset)
+    header = local_header.unpack(raw_file.read(local_header.size))
+    if header[0] != local_header_signature:
+        raise zipfile.BadZipfile("Bad local header for '%s' in '%s'" % (member.name, member.zip_file))
+    return member.header_offset + local_header.size + header[-2] + header[-1]
+
+
+def read_member(raw_file, member):
+    """
+      Read & decompress a member straight from its local header in its (open) zip file, checking its CRC
+    """
+
+    raw_file.seek(member_data_offset(raw_file, member))
+    data = raw_file.read(member.compressed_size)
+    if member.compress_type == zipfile.ZIP_DEFLATED:
+        data = zlib.decompress(data, -15)
+    elif member.compress_type != zipfile.ZIP_STORED:
+        raise zipfile.BadZipfile("Unsupported compression for '%s' in '%s'" % (member.name, member.zip_file))
+
+    if zlib.crc32(data) & 0xffffffff != member.crc:
+        raise zipfile.BadZipfile("Bad CRC for '%s' in '%s'" % (member.name, member.zip_file))
+    return data
+
+
+def sniff_member(raw_file, member):
+    """
+      Get the aggregation type & year of a member, from just the start of its XML
+    """
+
+    raw_file.seek(member_data_offset(raw_file, member))
+    data = raw_file.read(min(member.compressed_size, sniff_size))
+    if member.compress_type == zipfile.ZIP_DEFLATED:
+        data = zlib.decompressobj(-15).decompress(data)
+    elif member.compress_type != zipfile.ZIP_STORED:
+        return None, None
+
+    aggregation_type = aggregation_type_regex.search(data)
+    year = cover_date_regex.search(data) or copyright_year_regex.search(data)
+    return aggregation_type.group(1).strip() if aggregation_type else None, int(year.group(1)) if year else None
+
+
+def catalog_zip_file(zip_file):
+    """
+      List the members of a zip file of the input data, sniffing the metadata of each. Returns the zip file's size &
+      modification time along with its members, or an error if it couldn't be read.
+    """
+
+    zip_file_path = os.path.join(data_path, zip_file)
+    try:
+        zip_file_stat = os.stat(zip_file_path)
+        zipped_file = zipfile.ZipFile(zip_file_path, 'r')
+        infos = zipped_file.infolist()
+        zipped_file.close()
+
+        members = []
+        with open(zip_file_path, 'rb') as raw_file:
+            for info in infos:
+                member = Member(zip_file, info.filename, info.compress_size, info.file_size, info.CRC & 0xffffffff,
+                                info.header_offset, info.compress_type, None, None)
+                try:
+                    aggregation_type, year = sniff_member(raw_file, member)
+                    member = member._replace(aggregation_type=aggregation_type, year=year)
+                except (zipfile.BadZipfile, zlib.error, struct.error):
+                    pass
+                members.append(member)
+    except (zipfile.BadZipfile, IOError, OSError), e:
+        return zip_file, None, None, None, "Skipping '%s': '%s'" % (zip_file_path, e)
+
+    return zip_file, zip_file_stat.st_size, int(zip_file_stat.st_mtime), members, None
+
+
+class Catalog(object):
+    """
+      The catalog of the members of the zip files of the input data
+    """
+
+    def __init__(self, path=catalog_path):
+
+        # Zip files may be opened through the catalog on a prefetching thread (though only one thread at a time)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.text_factory = str
+        for statement in schema:
+            self.connection.execute(statement)
+
+    def zip_file_entries(self):
+        """
+          Get the size & modification time of each zip file cataloged, when it was cataloged
+        """
+
+        return dict((zip_file, (size, mtime)) for zip_file, size, mtime in
+                    self.connection.execute('SELECT zip_file, size, mtime FROM zip_files'))
+
+    def is_current(self, zip_file, zip_file_path):
+        """
+          Check whether a zip file is unchanged since it was cataloged
+        """
+
+        entry = self.connection.execute('SELECT size, mtime FROM zip_files WHERE zip_file = ?', (zip_file,)).fetchone()
+        if entry is None:
+            return False
+        try:
+            zip_file_stat = os.stat(zip_file_path)
+        except OSError:
+            return False
+        return entry == (zip_file_stat.st_size, int(zip_file_stat.st_mtime))
+
+    def add_zip_file(self, zip_file, size, mtime, members):
+        """
+          Replace the catalog of a zip file
+        """
+
+        with self.connection:
+            self.remove_zip_file(zip_file)
+            self.connection.execute('INSERT INTO zip_files VALUES (?, ?, ?)', (zip_file, size, mtime))
+            self.connection.executemany('INSERT INTO members VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', members)
+
+    def remove_zip_file(self, zip_file):
+        self.connection.execute('DELETE FROM members WHERE zip_file = ?', (zip_file,))
+        self.connection.execute('DELETE FROM zip_files WHERE zip_file = ?', (zip_file,))
+
+    def members(self, zip_files=None, aggregation_types=None, years=None, max_size=None):
+        """
+          Select the members cataloged, optionally just those in the given zip files, of the given aggregation types
+          (case insensitive), published in the given (inclusive) range of years, or at most the given (uncompressed)
+          size. Members are ordered by zip file, then by where they are in their zip file.
+        """
+
+        conditions = []
+        parameters = []
+        for column, values in [('zip_file', zip_files), ('LOWER(aggregation_type)', aggregation_types)]:
+            if values is not None:
+                values = list(values) if column == 'zip_file' else [value.lower() for value in values]
+                conditions.append('%s IN (%s)' % (column, ', '.join(['?'] * len(values))))
+                parameters.extend(values)
+        if years is not None:
+            conditions.append('year BETWEEN ? AND ?')
+            parameters.extend(years)
+        if max_size is not None:
+            conditions.append('file_size <= ?')
+            parameters.append(max_size)
+
+        query = 'SELECT * FROM members'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY zip_file, header_offset'
+        return [Member(*row) for row in self.connection.execute(query, parameters)]
+
+    def zip_file_sizes(self):
+        """
+          Get the total (uncompressed) size of the members of each zip file cataloged
+        """
+
+        return dict(self.connection.execute('SELECT zip_file, SUM(file_size) FROM members GROUP BY zip_file'))
+
+    def close(self):
+        self.connection.close()
+
+
+def members_by_zip_file(members):
+    """
+      Group selected members by zip file, keeping their order
+    """
+
+    grouped = OrderedDict()
+    for member in members:
+        grouped.setdefault(member.zip_file, []).append(member)
+    return grouped
+
+
+class CatalogZipFile(object):
+    """
+      Reads the cataloged members of a zip file straight from their local headers, without reading its central
+      directory (standing in for a read-only zipfile.ZipFile)
+    """
+
+    def __init__(self, zip_file_path, members):
+        self.raw_file = open(zip_file_path, 'rb')
+        self.members = OrderedDict((member.name, member) for member in members)
+
+    def namelist(self):
+        return list(self.members)
+
+    def getinfo(self, name):
+        return self.members[name]
+
+    def read(self, name):
+        return read_member(self.raw_file, self.members[name])
+
+    def open(self, name):
+        return StringIO(self.read(name))
+
+    def close(self):
+        self.raw_file.close()
+
+
+def open_zip_file(zip_file_path, catalog=None):
+    """
+      Open a zip file of the input data, through the catalog if it's cataloged & unchanged since
+    """
+
+    zip_file = os.path.basename(zip_file_path)
+    if catalog is not None and catalog.is_current(zip_file, zip_file_path):
+        return CatalogZipFile(zip_file_path, catalog.members(zip_files=[zip_file]))
+    return zipfile.ZipFile(zip_file_path, 'r')
+
+
+def build_catalog(catalog, zip_files, number_of_workers):
+    """
+      Catalog the given zip files of the input data on a pool of processes, skipping those unchanged since they were
+      last cataloged, and dropping zip files no longer in the input data
+    """
+
+    cataloged = catalog.zip_file_entries()
+    for zip_file in set(cataloged).difference(zip_files):
+        with catalog.connection:
+            catalog.remove_zip_file(zip_file)
+    zip_files_to_catalog = [zip_file for zip_file in zip_files
+                            if not catalog.is_current(zip_file, os.path.join(data_path, zip_file))]
+
+    members_cataloged = 0
+    zip_files_cataloged = 0
+    pool = multiprocessing.Pool(number_of_workers)
+    for zip_file, size, mtime, members, error in pool.imap_unordered(catalog_zip_file, zip_files_to_catalog):
+        if error is not None:
+            print "\n%s" % error
+            continue
+        catalog.add_zip_file(zip_file, size, mtime, members)
+        zip_files_cataloged += 1
+        members_cataloged += len(members)
+        sys.stdout.write("\rCataloged %d / %d ZIP files, %d members..." % (
+            zip_files_cataloged, len(zip_files_to_catalog), members_cataloged
+        ))
+        sys.stdout.flush()
+    pool.close()
+    pool.join()
+
+    print "\nCataloged %d ZIP files (%d unchanged since they were last cataloged)" % (
+        zip_files_cataloged, len(zip_files) - len(zip_files_to_catalog)
+    )
+
+
+def add_selection_arguments(parser):
+    """
+      Add the arguments to select cataloged members by to a command line parser
+    """
+
+    parser.add_argument('--type', action='append', dest='aggregation_types',
+                        help='select members of this aggregation type (any of them, if given more than once)')
+    parser.add_argument('--years', type=int, nargs=2, metavar=('FROM', 'TO'),
+                        help='select members published in this range of years')
+    parser.add_argument('--max-size', type=int, help='select members of at most this many (uncompressed) bytes')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Catalog the members of the zip files of the raw data')
+    parser.add_argument('--catalog', default=catalog_path, help='the catalog database (defaults to %s)' % catalog_path)
+    parser.add_argument('-n', '--workers', type=int, default=multiprocessing.cpu_count(),
+                        help='the number of processes to catalog zip files on (defaults to the number of CPUs)')
+    parser.add_argument('--select', action='store_true', help='count the members selected, rather than cataloging')
+    add_selection_arguments(parser)
+    args = parser.parse_args()
+
+    catalog = Catalog(args.catalog)
+    if args.select:
+        selected = members_by_zip_file(catalog.members(
+            aggregation_types=args.aggregation_types, years=args.years, max_size=args.max_size
+        ))
+        print "Selected %d members (%d bytes) from %d ZIP files" % (
+            sum(map(len, selected.itervalues())),
+            sum([member.file_size for members in selected.itervalues() for member in members]), len(selected)
+        )
+    else:
+        build_catalog(catalog, sorted(os.listdir(data_path)), args.workers)
+    catalog.close()
@@ -1,31 +1,23 @@
-import os
-from collections import defaultdict
-
-counts_dir = defaultdict(int)
-totals_dir = defaultdict(int)
-
-keys_order = []
-
-folder = "intermediate_output"
-for filename in os.listdir(folder):
-    if not filename.endswith('-stats.txt'):
-        continue
-    input_file = open(os.path.join(folder, filename))
-    for line in input_file:
-        if not line.startswith('\t'):
-            continue
-
-        tokens = line.strip().split()
-        count = int(tokens[-4])
-        total = int(tokens[-2])
-
-        label = line[:line.find(':')].strip()
-        keys_order.append(label)
-
-        counts_dir[label] += count
-        totals_dir[label] += total
-
-count_and_percent = lambda a, b: (a, b, float(a) / b * 100)
-
-for key in keys_order[:18]:
-    print '%s: %d / %d (%2.2f%%)' % tuple((key,) + count_and_percent(counts_dir[key], totals_dir[key]))
+import first_pass_manifest
+import parse_stats
+
+# Add up the stats (and tallies) committed alongside each shard listed in the manifest
+stats = parse_stats.ParseStats()
+tallies = None
+zip_files_without_stats = 0
+for zip_file in sorted(first_pass_manifest.read_manifest()):
+    zip_file_stats = parse_stats.read_zip_file_stats(zip_file)
+    if zip_file_stats is None:
+        zip_files_without_stats += 1
+    else:
+        stats.merge(zip_file_stats)
+    zip_file_tallies = parse_stats.read_zip_file_tallies(zip_file)
+    if zip_file_tallies is not None:
+        tallies = zip_file_tallies if tallies is None else tallies.merge(zip_file_tallies)
+
+print parse_stats.build_stats_message(stats)
+if tallies is not None:
+    print parse_stats.build_title_and_venue_tallies_message(tallies)
+if zip_files_without_stats:
+    print "(%d ZIP files have no stats, since their shards were written before stats were kept per ZIP file)" % \
+        zip_files_without_stats
@@ -1,43 +1,57 @@
+import argparse
+import array
+from collections import Counter
 import cProfile
-from collections import defaultdict
+import external_sort
+import final_output_index
+import first_pass_manifest
+import id_arrays
+import intermediate_records
+import itertools
+import multiprocessing
+import numpy
 import os
-import traceback
-
-__author__ = 'jontedesco'
-
 import re
+import shutil
 import sys
+import tempfile
+import traceback
+from text_normalization import control_bytes, remove_control_chars
 
 __author__ = 'jontedesco'
 
-# Global stats
+# Global stats (tallied by each process, and taken after each task)
 invalid_papers = 0
 references_attempted = 0
 references_succeeded = 0
 dangling_references = 0
 collision_references = 0
+stat_names = ['invalid_papers', 'references_attempted', 'references_succeeded', 'dangling_references',
+              'collision_references']
 
-# Regular expressions for stripping non-visible characters
-control_chars = ''.join(map(unichr, list(range(0, 32)) + list(range(127, 160))))
-control_chars_regex = re.compile('[%s]' % re.escape(control_chars))
-non_ascii_regex = re.compile('\W')
+# The final output file
+output_folder_path = 'final_output'
+output_file_name = 'final_output.txt'
 
-# The dictionary of citation counts for each paper
-citation_counts = defaultdict(int)
+# The data shared by every task of the current stage of the second pass (in each worker process)
+shared_data = {}
 
+# The entries of each intermediate output file are read & checked in blocks of this many, so only one block of them is
+# held in memory at a time
+entries_per_block = 10000
 
-def __remove_control_chars(string):
-    string = string.strip('\xef\xbb\xbf')
-    return control_chars_regex.sub('', string)
+# Binary intermediate output only holds printable ascii, so its titles & venues are non-empty once normalized if they
+# hold a visible character (other than '.', for titles), which can be checked without copying them out of their file
+visible_title_regex = re.compile('[^%s.]' % re.escape(control_bytes))
+visible_regex = re.compile('[^%s]' % re.escape(control_bytes))
 
 
-def __papers_from_file(input_file, index_collisions, paper_indices):
+def __records_from_text_file(input_file):
     """
-      Generator function over papers (gets data from the next entry)
+      Generator function over the entries of a plain text intermediate output file, as (title, authors, year,
+      conference, index, citation indices, path) tuples (gets data from the next entry)
     """
 
-    global invalid_papers, dangling_references, collision_references, references_attempted, references_succeeded
-
     # Tokens for parsing
     title_token = '#*'
     author_token = '#@'
@@ -47,7 +61,6 @@ def __papers_from_file(input_file, index_collisions, paper_indices):
     path_token = '#path'
     citation_token = '#%'
 
-    # Predicates for error checking
     # Next entry data
     title = None
     authors = None
@@ -55,7 +68,7 @@ def __papers_from_file(input_file, index_collisions, paper_indices):
     conference = None
     index = None
     path = None
-    references = []
+    citation_indices = []
 
     this_line_empty = False
 
@@ -68,50 +81,29 @@ def __papers_from_file(input_file, index_collisions, paper_indices):
         try:
             # Parse entry, asserting that entries appear in title -> authors -> conference order
             if line.startswith(title_token):
-                title = line[len(title_token):].strip('.')
+                title = remove_control_chars(line[len(title_token):]).strip('.')
             elif line.startswith(author_token):
-                authors = [author.strip() for author in line[len(author_token):].split(',')]
+                authors = [author.strip() for author in remove_control_chars(line[len(author_token):]).split(',')]
             elif line.startswith(year_token):
                 year = int(line[len(year_token):].strip())
             elif line.startswith(conf_token):
-                conference = line[len(conf_token):]
+                conference = remove_control_chars(line[len(conf_token):])
             elif line.startswith(index_token):
                 index = int(line[len(index_token):])
             elif line.startswith(path_token):
                 path = line[len(path_token):]
             elif line.startswith(citation_token):
-                citation_index = int(line[len(citation_token):].strip())
-                references_attempted += 1
-
-                # Add reference if (1) not a collision and (2) links to a paper found
-                if citation_index in index_collisions:
-                    collision_references += 1
-                    continue
-                if citation_index not in paper_indices:
-                    dangling_references += 1
-                    continue
-
-                references_succeeded += 1
-                references.append(citation_index)
-                citation_counts[citation_index] += 1
+                citation_indices.append(int(line[len(citation_token):].strip()))
 
             # We've reached the end of the entry
             elif len(line) == 0:
 
                 if last_line_was_empty:
                     continue
+                if all([item is None for item in [conference, index, title, authors]]):
+                    continue
 
-                # Only output if:
-                #   (1) data is all not None
-                #   (2) title, authors, and conference are valid (non-empty)
-                #   (3) index index was found (do not enforce citation count)
-                if all((title, authors, conference)) and index is not None:
-                    if index not in index_collisions:
-                        yield title, authors, year, conference, citation_counts[index], index, references, path
-                else:
-                    if all([item is None for item in [conference, index, title, authors]]):
-                        continue
-                    invalid_papers += 1
+                yield title, authors, year, conference, index, citation_indices, path
 
                 # Reset for the next paper
                 title = None
@@ -120,7 +112,7 @@ def __papers_from_file(input_file, index_collisions, paper_indices):
                 conference = None
                 index = None
                 path = None
-                references = []
+                citation_indices = []
         except:
 
             # Handle all exceptions by tallying unforeseen errors
@@ -128,151 +120,497 @@ def __papers_from_file(input_file, index_collisions, paper_indices):
             continue
 
 
-def parse_intermediate_arnetminer_dataset():
+def __normalize_binary_strings(title, authors, conference, path):
     """
-        Parse the intermediate full arnet miner dataset (in pseudo-arnetminer format), and output the full arnetminer
-        plaintext format.
+      Normalize the strings of an entry of a binary intermediate output file (views of the memory-mapped file) like
+      those of plain text entries, copying them out of the file
     """
 
-    # Find intermediate output data
-    laptop_input_path = 'somepaththatdoesntexist'
-    generic_input_path = 'intermediate_output'
-    input_folder_path = laptop_input_path if os.path.exists(laptop_input_path) else generic_input_path
+    title = remove_control_chars(str(title)).strip('.')
+    authors = [author.strip() for author in remove_control_chars(str(authors)).split(',')]
+    return title, authors, remove_control_chars(str(conference)), str(path)
 
-    # Counts for statistics
-    TOTAL_PAPERS = 10454961
-    VALID_PAPERS = 0.9 * TOTAL_PAPERS  # Estimate 90% validity
 
-    # Holds all paper indices found
-    paper_indices = []
-    papers_processed = 0
+def __records_from_file(input_file_path):
+    """
+      Generator function over the entries of an intermediate output file (in either plain text or binary format). The
+      strings of binary entries are left in their memory-mapped file (and their citation indices are arrays over it),
+      and are only normalized for the papers written.
+    """
 
+    if input_file_path.endswith(intermediate_records.binary_suffix):
+        return intermediate_records.read_records(input_file_path)
+    return __records_from_text_file(open(input_file_path))
 
-    for input_file_name in os.listdir(input_folder_path):
 
-        try:
+def __record_blocks(input_file_path):
+    """
+      Generator function over the entries of an intermediate output file, in lists of up to entries_per_block entries
+    """
 
-            # Only look at intermediate results files
-            if not input_file_name.endswith('intermediate_output.txt'):
-                continue
-            input_file = open(os.path.join(input_folder_path, input_file_name))
+    records = __records_from_file(input_file_path)
+    while True:
+        block = list(itertools.islice(records, entries_per_block))
+        if not block:
+            return
+        yield block
 
-            # Build the citation counts for all papers
-            for line in input_file:
 
-                # Just look at index lines
-                if not line.startswith('#index'):
-                    continue
+def __resolve_references(citation_indices, index_collisions, paper_indices):
+    """
+      Find which references link to a paper found (and not to an index collision), with one batch of binary searches
+      over the sorted paper indices, tallying the rest
+    """
 
-                paper_index = int(line[len('#index'):].strip())
-                paper_indices.append(paper_index)
+    global dangling_references, collision_references, references_attempted, references_succeeded
 
-                # Record progress
-                papers_processed += 1
-                if papers_processed % 100 == 0:
-                    sys.stdout.write("\r (%2.2f%%) Recorded %d / %d paper indices..." % (
-                        (float(papers_processed) / VALID_PAPERS) * 100, papers_processed, VALID_PAPERS
-                    ))
+    # Add reference if (1) not a collision and (2) links to a paper found
+    is_collision = id_arrays.in_sorted(index_collisions, citation_indices)
+    is_found = id_arrays.in_sorted(paper_indices, citation_indices)
+    is_resolved = is_found & ~is_collision
 
-        except:
+    references_attempted += len(citation_indices)
+    collision_references += int(is_collision.sum())
+    dangling_references += int((~is_found).sum())
+    references_succeeded += int(is_resolved.sum())
 
-            # Handle all exceptions by tallying unforeseen errors
-            print "[Unexpected Error Parsing Indices] '%s'" % traceback.format_exc()
-            continue
+    return is_resolved
 
-    # Sort the indices (likely slow, with about 10 million papers)
-    paper_indices.sort()
 
-    # Stores information about duplicate paper indices
-    index_collisions = set()
-    index_collisions_count = 0
+def __has_valid_strings(title, authors, conference):
+    """
+      Check that an entry's title, authors, and conference are all non-empty (once normalized, for binary entries, whose
+      authors are never empty once split)
+    """
 
-    # Look for duplicates in the indices (index collisions)
-    last_index = 0
-    for paper_index in paper_indices:
+    if isinstance(title, buffer):
+        return visible_title_regex.search(title) and visible_regex.search(conference)
+    return all((title, authors, conference))
 
-        # Tally this collision
-        if paper_index == last_index:
-            index_collisions.add(paper_index)
-            index_collisions_count += 1
 
-        last_index = paper_index
+def __citation_array(records):
+    """
+      Get the citation indices of a block of entries as one array (those of binary entries are already arrays)
+    """
+
+    if len(records) and isinstance(records[0][5], numpy.ndarray):
+        return id_arrays.concatenate([record[5] for record in records])
+    return id_arrays.id_array([citation for record in records for citation in record[5]])
+
+
+def __papers_to_output(records, index_collisions):
+    """
+      Find which of a block of papers are valid, and which of those will be output (the valid papers whose index isn't a
+      collision), returning both masks along with the indices of the papers
+    """
+
+    # Only output if:
+    #   (1) data is all not None
+    #   (2) title, authors, and conference are valid (non-empty, once normalized)
+    #   (3) index index was found (do not enforce citation count)
+    is_valid = numpy.array([bool(__has_valid_strings(title, authors, conference) and index is not None)
+                            for title, authors, year, conference, index, citation_indices, path in records], dtype=bool)
+    indices = id_arrays.id_array([record[4] if record[4] is not None else 0 for record in records])
+    is_output = is_valid & ~id_arrays.in_sorted(index_collisions, indices)
+
+    return is_valid, is_output, indices
+
+
+def __citations_from_file(input_file_path, index_collisions, paper_indices):
+    """
+      Get the resolved references made by the papers in an intermediate output file that will be output, as arrays of
+      (citing, cited) paper ordinals in file order
+    """
+
+    citing = [numpy.zeros(0, dtype=numpy.uint32)]
+    cited = [numpy.zeros(0, dtype=numpy.uint32)]
+    for records in __record_blocks(input_file_path):
+        is_valid, is_output, indices = __papers_to_output(records, index_collisions)
+
+        # Resolve the references of every paper in the block together
+        citation_indices = __citation_array(records)
+        is_resolved = __resolve_references(citation_indices, index_collisions, paper_indices)
+
+        # Only count references made by papers that will be output
+        citing_papers = numpy.repeat(numpy.arange(len(records)), [len(record[5]) for record in records])
+        is_edge = is_resolved & is_output[citing_papers]
+
+        citing.append(id_arrays.ordinals(paper_indices, indices[citing_papers[is_edge]]))
+        cited.append(id_arrays.ordinals(paper_indices, citation_indices[is_edge]))
+
+    return numpy.concatenate(citing), numpy.concatenate(cited)
+
+
+def __papers_from_file(input_file_path, index_collisions, paper_indices, cited, reference_counts, citation_counts,
+                       edge_offset):
+    """
+      Generator function over the papers to output from an intermediate output file, reading their references & citation
+      counts from the collected citations (starting from this file's first edge), along with each paper's ordinal
+    """
+
+    global invalid_papers
+
+    for records in __record_blocks(input_file_path):
+        is_valid, is_output, indices = __papers_to_output(records, index_collisions)
+        invalid_papers += int((~is_valid).sum())
+
+        # Look up the references & citation counts of the block's papers to output, all at once
+        paper_ordinals = id_arrays.ordinals(paper_indices, indices[is_output])
+        paper_reference_counts = reference_counts[paper_ordinals]
+        block_edges = int(paper_reference_counts.sum())
+        reference_ends = numpy.cumsum(paper_reference_counts).tolist()
+        references = paper_indices[cited[edge_offset:edge_offset + block_edges]].tolist()
+        paper_citation_counts = citation_counts[paper_ordinals].tolist()
+        paper_ordinals = paper_ordinals.tolist()
+        edge_offset += block_edges
+
+        output_index = 0
+        references_start = 0
+        for i in numpy.flatnonzero(is_output).tolist():
+            title, authors, year, conference, index, citation_indices, path = records[i]
+            references_end = reference_ends[output_index]
+            yield title, authors, year, conference, paper_citation_counts[output_index], index, \
+                references[references_start:references_end], path, paper_ordinals[output_index]
+
+            output_index += 1
+            references_start = references_end
 
-    # Output index collisions
-    print "\n\nSkipped %d / %d (%2.2f%%) papers due to index collisions" % (
-        index_collisions_count, papers_processed, (float(index_collisions_count) / papers_processed * 100)
-    )
 
-    # Reference counts for these papers
-    total_reference_count = 0
-    papers_with_references = 0
-    total_citation_count = 0
-    papers_with_citations = 0
+def __indices_from_file(input_file_path):
+    """
+      Generator function over the index of each paper in an intermediate output file
+    """
+
+    if input_file_path.endswith(intermediate_records.binary_suffix):
+        for paper_index in intermediate_records.read_indices(input_file_path):
+            yield paper_index
+        return
+
+    for line in open(input_file_path):
+
+        # Just look at index lines
+        if line.startswith('#index'):
+            yield int(line[len('#index'):].strip())
+
+
+def __take_stats():
+    """
+      Get the global stats tallied by this process since they were last taken, resetting them
+    """
 
-    # Take paper indices as a set (to use to check dangling references)
-    paper_indices = set(paper_indices)
+    stats = Counter(dict((name, globals()[name]) for name in stat_names))
+    globals().update(dict.fromkeys(stat_names, 0))
+    return stats
 
+
+def __share_data(data):
+    """
+      Set the data shared by every task of the current stage of the second pass
+    """
+
+    global shared_data
+    shared_data = data
+
+
+def __map_stage(task, tasks, number_of_workers, data):
+    """
+      Generator function over the results of a stage of the second pass, in the order of its tasks, running the tasks in
+      this process or on a pool of worker processes (handing each worker the data shared by the stage's tasks). Each
+      worker takes contiguous runs of tasks, so consecutive intermediate output files are read by the same process.
+    """
+
+    __share_data(data)
+    if number_of_workers == 1:
+        for result in itertools.imap(task, tasks):
+            yield result
+        return
+
+    pool = multiprocessing.Pool(number_of_workers, __share_data, (data,))
+    try:
+        chunk_size = max(1, len(tasks) // (number_of_workers * 4))
+        for result in pool.imap(task, tasks, chunk_size):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def __indices_task(input_file_path):
+    """
+      Get the index of each paper in an intermediate output file, as an array
+    """
+
+    try:
+        return id_arrays.id_array(list(__indices_from_file(input_file_path)))
+    except:
+
+        # Handle all exceptions by tallying unforeseen errors
+        print "[Unexpected Error Parsing Indices] '%s'" % traceback.format_exc()
+        return id_arrays.id_array([])
+
+
+def __citations_task(input_file_path):
+    """
+      Get the (citing, cited) edges made by the papers to output from an intermediate output file, along with the stats
+      tallied collecting them
+    """
+
+    try:
+        citing, cited = __citations_from_file(
+            input_file_path, shared_data['index_collisions'], shared_data['paper_indices']
+        )
+    except:
+
+        # Handle all exceptions by tallying unforeseen errors
+        print "[Unexpected Error Collecting References] '%s'" % traceback.format_exc()
+        citing = cited = numpy.zeros(0, dtype=numpy.uint32)
+
+    return citing, cited, __take_stats()
+
+
+def __write_papers(input_file_path, edge_offset, output_file):
+    """
+      Write the papers to output from an intermediate output file (whose first edge is at the given offset), returning
+      the stats tallied writing them, along with the ordinal & record length of each paper written (to index the output)
+    """
+
+    stats = Counter()
+    written_ordinals = array.array('I')
+    record_lengths = array.array('I')
+    for title, authors, year, conference, citation_count, index, references, path, ordinal in __papers_from_file(
+            input_file_path, shared_data['index_collisions'], shared_data['paper_indices'], shared_data['cited'],
+            shared_data['reference_counts'], shared_data['citation_counts'], edge_offset
+    ):
+        if isinstance(title, buffer):
+            title, authors, conference, path = __normalize_binary_strings(title, authors, conference, path)
+
+        # Output this paper to the final output file
+        record = '#*%s\n#@%s\n#year%d\n#conf%s\n#citation%d\n#index%d\n#path%s\n%s\n' % (
+            title, ','.join(authors), year, conference, citation_count, index, path,
+            ''.join(['#%%%d\n' % ref_id for ref_id in references])
+        )
+        output_file.write(record)
+        written_ordinals.append(ordinal)
+        record_lengths.append(len(record))
+
+        # Tally number of references and citations associated with this paper
+        stats['papers_processed'] += 1
+        if len(references):
+            stats['papers_with_references'] += 1
+        stats['total_reference_count'] += len(references)
+        if citation_count:
+            stats['papers_with_citations'] += 1
+        stats['total_citation_count'] += citation_count
+
+    stats.update(__take_stats())
+    return stats, numpy.array(written_ordinals, dtype=numpy.uint32), numpy.array(record_lengths, dtype=numpy.uint32)
+
+
+def __output_task(task):
+    """
+      Write the papers to output from an intermediate output file to their own slice of the final output, returning the
+      path to the slice along with the stats & index entries from writing it
+    """
+
+    slice_number, input_file_path, edge_offset = task
+    slice_path = os.path.join(output_folder_path, '%s.%d.partial' % (output_file_name, slice_number))
+    with open(slice_path, 'w') as slice_file:
+        stats, written_ordinals, record_lengths = __write_papers(input_file_path, edge_offset, slice_file)
+    return slice_path, stats, written_ordinals, record_lengths
+
+
+def parse_intermediate_arnetminer_dataset(number_of_workers=1, memory_budget=None):
+    """
+        Parse the intermediate full arnet miner dataset (in pseudo-arnetminer format), and output the full arnetminer
+        plaintext format. Each stage is split across the given number of worker processes, by intermediate output file.
+        If given a memory budget (in bytes), paper indices & references are spilled to disk rather than held in memory,
+        and indices are sorted with an external merge sort.
+    """
+
+    # Find intermediate output data
+    laptop_input_path = 'somepaththatdoesntexist'
+    generic_input_path = 'intermediate_output'
+    input_folder_path = laptop_input_path if os.path.exists(laptop_input_path) else generic_input_path
+
+    # Use the shards recorded in the first pass manifest, or any intermediate results files if there is no manifest
+    input_file_paths = first_pass_manifest.shard_paths(input_folder_path)
+    if input_file_paths is None:
+        input_file_paths = [os.path.join(input_folder_path, input_file_name)
+                            for input_file_name in sorted(os.listdir(input_folder_path))
+                            if input_file_name.endswith('intermediate_output.txt') or
+                            input_file_name.endswith(intermediate_records.binary_suffix)]
+
+    # Counts for statistics
+    TOTAL_PAPERS = 10454961
+    VALID_PAPERS = 0.9 * TOTAL_PAPERS  # Estimate 90% validity
+    stats = Counter()
+
+    # Holds all paper indices found (one contiguous array per file, or sorted runs of them spilled to disk)
+    paper_indices = []
     papers_processed = 0
-    output_file = open(os.path.join('final_output', 'final_output.txt'), 'w')
-    for input_file_name in os.listdir(input_folder_path):
+    if memory_budget is not None:
+        spill_folder_path = tempfile.mkdtemp(prefix='spilled-', dir=output_folder_path)
+        ids_in_memory = external_sort.ids_for_budget(memory_budget)
+        index_runs = external_sort.RunWriter(spill_folder_path, ids_in_memory)
+
+    # Build the citation counts for all papers
+    for file_paper_indices in __map_stage(__indices_task, input_file_paths, number_of_workers, {}):
+        if memory_budget is None:
+            paper_indices.append(file_paper_indices)
+        else:
+            index_runs.add(file_paper_indices)
+
+        # Record progress
+        papers_processed += len(file_paper_indices)
+        sys.stdout.write("\r (%2.2f%%) Recorded %d / %d paper indices..." % (
+            (float(papers_processed) / VALID_PAPERS) * 100, papers_processed, VALID_PAPERS
+        ))
+
+    # Sort the indices & look for duplicates in them (index collisions), keeping the sorted unique indices to check
+    # dangling references against (merging the runs on disk into memory mapped files, with a block of each run in
+    # memory at a time, if they were spilled)
+    if memory_budget is None:
+        paper_indices, index_collisions, index_collisions_count = \
+            id_arrays.find_collisions(id_arrays.concatenate(paper_indices))
+    else:
+        run_paths = index_runs.close()
+        paper_indices, index_collisions, index_collisions_count = external_sort.find_collisions(
+            run_paths, spill_folder_path, max(1, ids_in_memory // max(1, len(run_paths)))
+        )
+        for run_path in run_paths:
+            os.remove(run_path)
 
-        # Only look at intermediate results files
-        if not input_file_name.endswith('intermediate_output.txt'):
-            continue
-        input_file = open(os.path.join(input_folder_path, input_file_name))
-
-        # Add each paper to graph (adding missing associated terms, authors, and conferences)
-        for title, authors, year, conference, citation_count, index, references, path in \
-                __papers_from_file(input_file, index_collisions, paper_indices):
-
-            # Output this paper to the final output file
-            output_file.write('#*%s\n' % title)
-            output_file.write('#@%s\n' % ','.join(authors))
-            output_file.write('#year%d\n' % year)
-            output_file.write('#conf%s\n' % conference)
-            output_file.write('#citation%d\n' % citation_count)
-            output_file.write('#index%d\n' % index)
-            output_file.write('#path%s\n' % path)
-            output_file.write(''.join(['#%%%d\n' % ref_id for ref_id in references]) + '\n')
-
-            # Output progress
-            papers_processed += 1
-            if papers_processed % 10 == 0:
-                sys.stdout.write("\r (%2.2f%%) Processed %d / %d papers..." % (
-                    float(papers_processed)/ VALID_PAPERS * 100, papers_processed, VALID_PAPERS)
-                )
-
-            # Tally number of references and citations associated with this paper
-            if len(references):
-                papers_with_references += 1
-            total_reference_count += len(references)
-            if citation_count:
-                papers_with_citations += 1
-            total_citation_count += citation_count
+    # Output index collisions
+    print "\n\nSkipped %d / %d (%2.2f%%) papers due to index collisions" % (
+        index_collisions_count, papers_processed, (float(index_collisions_count) / papers_processed * 100)
+    )
+
+    # Count the citations of every paper before writing any of them, collecting every resolved reference as a packed
+    # (citing, cited) edge between paper ordinals, and counting the references made by & citations of each paper from
+    # those edges all at once
+    data = {'index_collisions': index_collisions, 'paper_indices': paper_indices}
+    citing = []
+    cited = []
+    edge_offsets = []
+    edges_collected = 0
+    if memory_budget is not None:
+        citing_file = open(os.path.join(spill_folder_path, 'citing.ordinals'), 'wb')
+        cited_file = open(os.path.join(spill_folder_path, 'cited.ordinals'), 'wb')
+    for file_citing, file_cited, file_stats in __map_stage(__citations_task, input_file_paths, number_of_workers, data):
+        if memory_budget is None:
+            citing.append(file_citing)
+            cited.append(file_cited)
+        else:
+            file_citing.tofile(citing_file)
+            file_cited.tofile(cited_file)
+        edge_offsets.append(edges_collected)
+        edges_collected += len(file_cited)
+        stats.update(file_stats)
+
+        # Record progress
+        sys.stdout.write("\r Collected %d references..." % edges_collected)
+
+    if memory_budget is None:
+        citing = id_arrays.concatenate(citing)
+        data['cited'] = id_arrays.concatenate(cited)
+        data['reference_counts'] = numpy.bincount(citing, minlength=len(paper_indices))
+        data['citation_counts'] = numpy.bincount(data['cited'], minlength=len(paper_indices))
+    else:
+        citing_file.close()
+        cited_file.close()
+        citing = external_sort.map_ids(citing_file.name, numpy.uint32)
+        data['cited'] = external_sort.map_ids(cited_file.name, numpy.uint32)
+        data['reference_counts'] = external_sort.bincount(
+            citing, len(paper_indices), ids_in_memory, os.path.join(spill_folder_path, 'reference.counts')
+        )
+        data['citation_counts'] = external_sort.bincount(
+            data['cited'], len(paper_indices), ids_in_memory, os.path.join(spill_folder_path, 'citation.counts')
+        )
+    del citing, cited
+
+    # Add each paper to graph (adding missing associated terms, authors, and conferences), writing each file's papers
+    # to its own slice of the final output in parallel, and concatenating the slices in order
+    output_file = open(os.path.join(output_folder_path, output_file_name), 'w')
+    if number_of_workers == 1:
+        __share_data(data)
+        output_results = ((None,) + __write_papers(input_file_path, edge_offset, output_file)
+                          for input_file_path, edge_offset in zip(input_file_paths, edge_offsets))
+    else:
+        output_tasks = [(slice_number, input_file_path, edge_offset) for slice_number, (input_file_path, edge_offset)
+                        in enumerate(zip(input_file_paths, edge_offsets))]
+        output_results = __map_stage(__output_task, output_tasks, number_of_workers, data)
+
+    # Index the final output by paper index as each file's papers are added to it, so any paper can be found without
+    # scanning the whole file (full 160-bit indices can't be indexed)
+    if paper_indices.dtype == object:
+        index_writer = None
+    elif memory_budget is None:
+        index_writer = final_output_index.IndexWriter(output_file.name, paper_indices)
+    else:
+        index_writer = final_output_index.IndexWriter(output_file.name, paper_indices, spill_folder_path, ids_in_memory)
+
+    for slice_path, file_stats, written_ordinals, record_lengths in output_results:
+        stats.update(file_stats)
+        if index_writer is not None:
+            index_writer.add(written_ordinals, record_lengths)
+        if slice_path is not None:
+            with open(slice_path) as slice_file:
+                shutil.copyfileobj(slice_file, output_file)
+            os.remove(slice_path)
+
+        # Output progress
+        sys.stdout.write("\r (%2.2f%%) Processed %d / %d papers..." % (
+            float(stats['papers_processed']) / VALID_PAPERS * 100, stats['papers_processed'], VALID_PAPERS)
+        )
+    output_file.close()
+    if index_writer is not None:
+        index_writer.close()
+    del index_writer
+    if memory_budget is not None:
+        shutil.rmtree(spill_folder_path)
 
     count_and_percent = lambda a, b: (a, b, float(a) / b * 100)
 
     # Output paper reference stats
-    total_found = papers_processed + invalid_papers
+    papers_processed = stats['papers_processed']
+    papers_with_references = stats['papers_with_references']
+    papers_with_citations = stats['papers_with_citations']
+    total_found = papers_processed + stats['invalid_papers']
     print "\n\nTotal Processed Papers: %d / %d (%2.2f%%)" % count_and_percent(papers_processed, total_found)
-    print "  Invalid Papers Skipped: %d / %d (%2.2f%%)" % count_and_percent(invalid_papers, total_found)
+    print "  Invalid Papers Skipped: %d / %d (%2.2f%%)" % count_and_percent(stats['invalid_papers'], total_found)
     print "  References to Collisions: %d / %d (%2.2f%%)" % \
-          count_and_percent(collision_references, references_attempted)
-    print "  Dangling References: %d / %d (%2.2f%%)" % count_and_percent(dangling_references, references_attempted)
+          count_and_percent(stats['collision_references'], stats['references_attempted'])
+    print "  Dangling References: %d / %d (%2.2f%%)" % \
+          count_and_percent(stats['dangling_references'], stats['references_attempted'])
     print "  Papers with References: %d / %d (%2.2f%%)" % count_and_percent(papers_with_references, papers_processed)
-    print "  Average Number of References (Overall): %2.2f" % (float(total_reference_count) / papers_processed)
+    print "  Average Number of References (Overall): %2.2f" % (
+        float(stats['total_reference_count']) / papers_processed
+    )
     print "  Average Number of References (For Papers with References): %2.2f" % (
-        float(total_reference_count) / papers_with_references
+        float(stats['total_reference_count']) / papers_with_references
     )
     print "  Papers with Citations: %d / %d (%2.2f%%)" % count_and_percent(papers_with_citations, papers_processed)
-    print "  Average Number of Citations (Overall): %2.2f" % (float(total_citation_count) / papers_processed)
+    print "  Average Number of Citations (Overall): %2.2f" % (float(stats['total_citation_count']) / papers_processed)
     print "  Average Number of Citations (For Papers with Citations): %2.2f" % (
-        float(total_citation_count) / papers_with_citations
+        float(stats['total_citation_count']) / papers_with_citations
     )
 
 if __name__ == '__main__':
-    should_profile = len(sys.argv) > 1
-    if should_profile:
-        cProfile.run('parse_intermediate_arnetminer_dataset()')
+    parser = argparse.ArgumentParser(description='Check & combine the intermediate output of the first pass')
+    parser.add_argument('-n', '--workers', type=int, default=1,
+                        help='the number of worker processes to split the intermediate output between (defaults to 1, '
+                             'parsing it all in this process)')
+    parser.add_argument('--memory-budget', type=int, metavar='MB',
+                        help='spill paper indices & references to disk, sorting indices in runs of about this many '
+                             'megabytes (for nodes without the memory to hold them all)')
+    parser.add_argument('--profile', action='store_true', help='profile the second pass (in this process)')
+    args = parser.parse_args()
+    memory_budget = args.memory_budget * 1024 * 1024 if args.memory_budget is not None else None
+
+    if args.profile:
+        cProfile.run('parse_intermediate_arnetminer_dataset(args.workers, memory_budget)')
     else:
-        parse_intermediate_arnetminer_dataset()
+        parse_intermediate_arnetminer_dataset(args.workers, memory_budget)
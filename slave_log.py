@@ -0,0 +1,106 @@
+import atexit
+import json
+import os
+import stage_timers
+import time
+import traceback
+
+__author__ = 'jontedesco'
+
+# Records are buffered & appended to the log file at most this often (or once this many are buffered), rather than
+# opening it for every message
+default_flush_interval = 5.0
+max_buffered_records = 1000
+
+
+def error_signature(exc_info):
+    """
+      Identify an error by its type & where it was raised, so repeats of the same error (with different details, e.g. in
+      different documents) share a signature
+    """
+
+    error_type, error, error_traceback = exc_info
+    frames = traceback.extract_tb(error_traceback)
+    if not frames:
+        return error_type.__name__
+    filename, line_number, function, _ = frames[-1]
+    return '%s at %s:%d in %s' % (error_type.__name__, os.path.basename(filename), line_number, function)
+
+
+class BufferedLog(object):
+    """
+      A slave's log, written as one JSON record per line: {'time', 'level', 'message', ...}. Records are buffered &
+      appended to the file periodically. Messages & errors given a signature are only written the first time it's
+      seen (errors with their traceback, which is only formatted then), and counted after that; the count of each
+      repeated signature is written in a 'repeated' record when the log is closed (which also happens at exit).
+    """
+
+    def __init__(self, path, flush_interval=default_flush_interval):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.records = []
+        self.last_flush = stage_timers.timer()
+        self.signature_counts = {}
+        self.first_records = {}
+        atexit.register(self.close)
+
+    def write(self, level, message, signature=None, **fields):
+        """
+          Log a message (only the first time its signature is seen, if it has one)
+        """
+
+        if signature is not None:
+            self.signature_counts[signature] = self.signature_counts.get(signature, 0) + 1
+            if self.signature_counts[signature] > 1:
+                return
+
+        record = dict(fields, time=time.time(), level=level, message=message)
+        if signature is not None:
+            record['signature'] = signature
+            self.first_records[signature] = record
+        self.records.append(record)
+
+        if len(self.records) >= max_buffered_records or \
+                stage_timers.timer() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def info(self, message, signature=None, **fields):
+        self.write('info', message, signature, **fields)
+
+    def error(self, message, exc_info, **fields):
+        """
+          Log an error being handled (given by sys.exc_info()), with its traceback the first time its signature is seen
+        """
+
+        signature = error_signature(exc_info)
+        if signature in self.signature_counts:
+            self.signature_counts[signature] += 1
+            return
+        self.write('error', message, signature, traceback=''.join(traceback.format_exception(*exc_info)), **fields)
+
+    def flush(self):
+        """
+          Append the buffered records to the log file
+        """
+
+        self.last_flush = stage_timers.timer()
+        if not self.records:
+            return
+        with open(self.path, 'a') as log_file:
+            log_file.write(''.join([json.dumps(record, sort_keys=True) + '\n' for record in self.records]))
+        self.records = []
+
+    def close(self):
+        """
+          Write how many times each repeated message or error was seen, and flush the log
+        """
+
+        for signature, count in sorted(self.signature_counts.iteritems()):
+            if count > 1:
+                first_record = self.first_records[signature]
+                self.records.append({
+                    'time': time.time(), 'level': 'repeated', 'signature': signature, 'count': count,
+                    'message': first_record['message'], 'first_time': first_record['time']
+                })
+        self.signature_counts.clear()
+        self.flush()
@@ -0,0 +1,128 @@
+from collections import defaultdict
+import math
+import threading
+import timeit
+
+__author__ = 'jontedesco'
+
+# The clock stages are timed with (the most precise wall clock on this platform)
+timer = timeit.default_timer
+
+# Latencies are counted in log-scaled buckets, several per doubling, from a microsecond up, so each histogram is small
+# & fixed-size however many documents are timed, and percentiles are accurate to within a bucket (about 19%)
+buckets_per_doubling = 4
+min_latency = 1e-6
+
+
+def bucket_for(seconds):
+    if seconds <= min_latency:
+        return 0
+    return int(math.log(seconds / min_latency, 2) * buckets_per_doubling) + 1
+
+
+def bucket_upper_bound(bucket):
+    """
+      Get the longest latency counted in a bucket, in seconds
+    """
+
+    return min_latency * 2 ** (float(bucket) / buckets_per_doubling)
+
+
+class StageTimers(object):
+    """
+      Always-on timers for the stages of parsing each document, each keeping a histogram of per-document latencies.
+      Stages of a document are started & stopped around the code they time, and may nest (a stage's time excludes that
+      of the stages nested in it) or run several times per document; their times are counted once the document is
+      finished. Stages timed once per zip file, or from another thread, are recorded directly.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = defaultdict(lambda: defaultdict(int))
+        self.totals = defaultdict(float)
+        self.maxima = defaultdict(float)
+        self.document_times = defaultdict(float)
+        self.running_stages = []
+        self.last_switch = 0.0
+
+    def start(self, stage):
+        """
+          Start timing a stage of the current document, pausing the stage it's nested in
+        """
+
+        now = timer()
+        if self.running_stages:
+            self.document_times[self.running_stages[-1]] += now - self.last_switch
+        self.running_stages.append(stage)
+        self.last_switch = now
+
+    def stop(self):
+        """
+          Stop timing the innermost stage running, resuming the stage it's nested in
+        """
+
+        now = timer()
+        self.document_times[self.running_stages.pop()] += now - self.last_switch
+        self.last_switch = now
+
+    def stop_all(self):
+        """
+          Stop timing every stage running (e.g. once a document is skipped part way through)
+        """
+
+        while self.running_stages:
+            self.stop()
+
+    def end_document(self):
+        """
+          Count the time spent in each stage of parsing the current document
+        """
+
+        self.stop_all()
+        for stage, seconds in self.document_times.iteritems():
+            self.record(stage, seconds)
+        self.document_times.clear()
+
+    def record(self, stage, seconds):
+        """
+          Count one latency of a stage
+        """
+
+        with self.lock:
+            self.histograms[stage][bucket_for(seconds)] += 1
+            self.totals[stage] += seconds
+            self.maxima[stage] = max(self.maxima[stage], seconds)
+
+    def percentile(self, stage, percent):
+        """
+          Estimate a percentile of the latencies of a stage (in seconds), as the upper bound of the bucket it falls in
+        """
+
+        histogram = self.histograms[stage]
+        target = percent / 100.0 * sum(histogram.itervalues())
+        seen = 0
+        for bucket in sorted(histogram):
+            seen += histogram[bucket]
+            if seen >= target:
+                return min(bucket_upper_bound(bucket), self.maxima[stage])
+        return 0.0
+
+    def report(self):
+        """
+          Summarize each stage (latencies in milliseconds), with its histogram as [upper bound, count] pairs
+        """
+
+        stages = {}
+        for stage, histogram in self.histograms.iteritems():
+            count = sum(histogram.itervalues())
+            stages[stage] = {
+                'count': count,
+                'total_seconds': self.totals[stage],
+                'mean_ms': 1000 * self.totals[stage] / count,
+                'max_ms': 1000 * self.maxima[stage],
+                'p50_ms': 1000 * self.percentile(stage, 50),
+                'p90_ms': 1000 * self.percentile(stage, 90),
+                'p99_ms': 1000 * self.percentile(stage, 99),
+                'histogram': [[1000 * bucket_upper_bound(bucket), histogram[bucket]] for bucket in sorted(histogram)],
+            }
+        return stages
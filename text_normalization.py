@@ -0,0 +1,62 @@
+import re
+import string
+
+__author__ = 'jontedesco'
+
+# Tables of the bytes to delete when filtering a string down to printable characters (or just letters)
+all_bytes = ''.join(map(chr, range(0, 256)))
+non_printable_bytes = ''.join([c for c in all_bytes if c not in string.printable])
+non_letter_bytes = ''.join([c for c in all_bytes if c not in string.letters])
+
+# Tables of the non-visible characters to delete from a string
+control_chars = ''.join(map(unichr, list(range(0, 32)) + list(range(127, 160))))
+control_chars_table = dict.fromkeys(map(ord, control_chars))
+control_bytes = ''.join(map(chr, list(range(0, 32)) + list(range(127, 160))))
+
+# Byte order mark left at the start of some lines
+byte_order_mark = '\xef\xbb\xbf'
+
+# Pre-compile whitespace regex
+whitespace_regex = re.compile(r'\s+')
+
+
+def to_ascii(s):
+    """
+      Drop any non-ascii characters from a unicode string, so it can be filtered with the byte tables
+    """
+
+    return s.encode('ascii', 'ignore') if isinstance(s, unicode) else s
+
+
+def printable(s):
+    """
+      Filter a string to its printable ascii characters
+    """
+
+    return to_ascii(s).translate(None, non_printable_bytes)
+
+
+def ascii_printable(s):
+    """
+      Filter a string to its ascii letters
+    """
+
+    return to_ascii(s).translate(None, non_letter_bytes)
+
+
+def collapse_whitespace(s):
+    """
+      Strip a string, and replace each run of white space inside it with a single space
+    """
+
+    return whitespace_regex.sub(' ', s.strip())
+
+
+def remove_control_chars(s):
+    """
+      Strip any byte order mark from a string, and delete its non-visible characters
+    """
+
+    if isinstance(s, unicode):
+        return s.strip(u'\ufeff').translate(control_chars_table)
+    return s.strip(byte_order_mark).translate(None, control_bytes)
@@ -0,0 +1,160 @@
+import heapq
+
+__author__ = 'jontedesco'
+
+# By default, keep counters for this many items (the count of any item is then overestimated by at most 1 / capacity of
+# the items counted)
+default_capacity = 1000
+
+
+class SpaceSaving(object):
+    """
+      Counts of the most frequent items in a stream, in bounded memory (the Space-Saving algorithm): counters are kept
+      for at most 'capacity' items, and a new item takes over the counter of the least frequent one (inheriting its
+      count as its possible error). Each count is an upper bound, over by at most its error, which is at most the total
+      counted / capacity. Summaries with the same capacity can be merged, keeping the same bounds.
+    """
+
+    def __init__(self, capacity=default_capacity):
+        self.capacity = capacity
+        self.total = 0
+        self.counts = {}
+        self.errors = {}
+
+        # A min-heap of (count, item), with one entry per item counted, whose counts are only brought up to date when
+        # they reach the top (so counting an item already tracked is just a dictionary update)
+        self.heap = []
+
+    def add(self, item, count=1):
+        """
+          Count an item
+        """
+
+        self.total += count
+        if item in self.counts:
+            self.counts[item] += count
+            return
+        if len(self.counts) < self.capacity:
+            self.counts[item] = count
+            self.errors[item] = 0
+            heapq.heappush(self.heap, (count, item))
+            return
+
+        # Find the least frequent item, refreshing heap entries whose counts are out of date
+        while True:
+            min_count, min_item = self.heap[0]
+            if self.counts[min_item] == min_count:
+                break
+            heapq.heapreplace(self.heap, (self.counts[min_item], min_item))
+
+        # Replace it with the new item
+        del self.counts[min_item]
+        del self.errors[min_item]
+        self.counts[item] = min_count + count
+        self.errors[item] = min_count
+        heapq.heapreplace(self.heap, (min_count + count, item))
+
+    def floor(self):
+        """
+          Get the most any item not tracked could have been counted (the smallest count, once every counter is taken)
+        """
+
+        if len(self.counts) < self.capacity:
+            return 0
+        return min(self.counts.itervalues())
+
+    def merge(self, other):
+        """
+          Add the counts of another summary to this one (an item missing from either summary could have been counted up
+          to its floor there), keeping the most frequent items. Returns this summary.
+        """
+
+        own_floor, other_floor = self.floor(), other.floor()
+        counts = {}
+        errors = {}
+        for item in set(self.counts).union(other.counts):
+            counts[item] = self.counts.get(item, own_floor) + other.counts.get(item, other_floor)
+            errors[item] = self.errors.get(item, own_floor) + other.errors.get(item, other_floor)
+
+        items_kept = heapq.nlargest(self.capacity, counts, key=counts.get)
+        self.counts = dict((item, counts[item]) for item in items_kept)
+        self.errors = dict((item, errors[item]) for item in items_kept)
+        self.heap = [(count, item) for item, count in self.counts.iteritems()]
+        heapq.heapify(self.heap)
+        self.total += other.total
+        return self
+
+    def top(self, k):
+        """
+          Get the k most frequent items, as (item, count, error), where the item was counted between count - error and
+          count times
+        """
+
+        return [(item, self.counts[item], self.errors[item])
+                for item in heapq.nlargest(k, self.counts, key=lambda item: (self.counts[item], item))]
+
+    def to_object(self):
+        """
+          Get the summary as an object that can be serialized as JSON
+        """
+
+        return {
+            'capacity': self.capacity,
+            'total': self.total,
+            'items': [[item, count, self.errors[item]] for item, count in self.counts.iteritems()],
+        }
+
+    @staticmethod
+    def from_object(data):
+        summary = SpaceSaving(data['capacity'])
+        summary.total = data['total']
+        for item, count, error in data['items']:
+            summary.counts[item] = count
+            summary.errors[item] = error
+        summary.heap = [(count, item) for item, count in summary.counts.iteritems()]
+        heapq.heapify(summary.heap)
+        return summary
+
+
+class GroupedSpaceSaving(object):
+    """
+      A Space-Saving summary for each group of a stream (e.g. each year), so the most frequent items can be found within
+      any group
+    """
+
+    def __init__(self, capacity=default_capacity):
+        self.capacity = capacity
+        self.groups = {}
+
+    def add(self, group, item, count=1):
+        summary = self.groups.get(group)
+        if summary is None:
+            summary = self.groups[group] = SpaceSaving(self.capacity)
+        summary.add(item, count)
+
+    def merge(self, other):
+        for group, summary in other.groups.iteritems():
+            if group in self.groups:
+                self.groups[group].merge(summary)
+            else:
+                self.groups[group] = SpaceSaving(self.capacity).merge(summary)
+        return self
+
+    def top(self, group, k):
+        if group not in self.groups:
+            return []
+        return self.groups[group].top(k)
+
+    def to_object(self):
+        # Groups are listed as [group, summary] pairs, since groups needn't be strings
+        return {
+            'capacity': self.capacity,
+            'groups': [[group, summary.to_object()] for group, summary in self.groups.iteritems()],
+        }
+
+    @staticmethod
+    def from_object(data):
+        grouped = GroupedSpaceSaving(data['capacity'])
+        for group, summary in data['groups']:
+            grouped.groups[group] = SpaceSaving.from_object(summary)
+        return grouped
@@ -0,0 +1,221 @@
+import argparse
+import datetime
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import generate_synthetic_corpus
+
+__author__ = 'jontedesco'
+
+repository_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Each benchmark run is appended to this file (one JSON object per line), so regressions can be tracked over time
+results_path = 'benchmark_results.jsonl'
+
+
+def set_up_work_folder(work_path, corpus_path):
+    """
+      Lay out a folder to run the pipeline in, like the repository's own (the scripts find their data, output folders &
+      each other relative to the working directory)
+    """
+
+    for path in glob.glob(os.path.join(repository_path, '*.py')) + [os.path.join(repository_path, 'stopWords.json')]:
+        os.symlink(os.path.abspath(path), os.path.join(work_path, os.path.basename(path)))
+    os.symlink(os.path.abspath(os.path.join(repository_path, 'utilities')), os.path.join(work_path, 'utilities'))
+    os.symlink(os.path.abspath(corpus_path), os.path.join(work_path, 'data'))
+    os.mkdir(os.path.join(work_path, 'intermediate_output'))
+    os.mkdir(os.path.join(work_path, 'final_output'))
+
+
+def run_stage(name, arguments, work_path, documents, bytes_read):
+    """
+      Run one stage of the pipeline in the work folder, measuring its wall time, and the peak resident memory of its
+      biggest process (counting the slaves or workers it waits for)
+    """
+
+    with open(os.path.join(work_path, '%s.log' % name), 'w') as log_file:
+        start_time = time.time()
+        process = subprocess.Popen([sys.executable] + arguments, cwd=work_path, stdout=log_file,
+                                   stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+        seconds = time.time() - start_time
+
+    # The peak resident set size is in kilobytes on Linux (but bytes on OS X)
+    peak_rss_mb = usage.ru_maxrss / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0)
+    return {
+        'stage': name,
+        'exit_status': os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status),
+        'seconds': seconds,
+        'documents': documents,
+        'bytes': bytes_read,
+        'documents_per_second': documents / seconds if seconds else 0,
+        'bytes_per_second': bytes_read / seconds if seconds else 0,
+        'peak_rss_mb': peak_rss_mb,
+    }
+
+
+def papers_output(work_path):
+    """
+      Count the papers in the final output, from its index
+    """
+
+    import final_output_index
+    index = final_output_index.OutputIndex(os.path.join(work_path, 'final_output', 'final_output.txt'))
+    paper_count = len(index)
+    index.close()
+    return paper_count
+
+
+def run_benchmarks(work_path, documents, corpus_bytes, workers, binary=False):
+    """
+      Run each stage of the pipeline, and the search utilities on its output, in turn
+    """
+
+    stages = [run_stage(
+        'first_pass', ['first_pass_master_parser.py', '-n', str(workers)] + (['--binary'] if binary else []),
+        work_path, documents, corpus_bytes
+    )]
+
+    intermediate_bytes = sum([os.path.getsize(path) for path in glob.glob(
+        os.path.join(work_path, 'intermediate_output', '*-intermediate_output.*')
+    )])
+    second_pass = run_stage('second_pass', ['second_pass_parser.py', '-n', str(workers)], work_path, 0,
+                            intermediate_bytes)
+    stages.append(second_pass)
+
+    # Count the second pass (and searches) by the papers output, rather than the documents in the corpus
+    output_path = os.path.join('final_output', 'final_output.txt')
+    papers = papers_output(work_path) if os.path.exists(os.path.join(work_path, output_path)) else 0
+    second_pass['documents'] = papers
+    second_pass['documents_per_second'] = papers / second_pass['seconds'] if second_pass['seconds'] else 0
+    output_bytes = os.path.getsize(os.path.join(work_path, output_path)) if papers else 0
+    stages.append(run_stage(
+        'search_build', ['utilities/search_arnetminer.py', '--data', output_path, '--rebuild', '-k', 'graph'],
+        work_path, papers, output_bytes
+    ))
+    stages.append(run_stage(
+        'search_query', ['utilities/search_arnetminer.py', '--data', output_path, '-k', 'learning', '-k', 'mining',
+                         '-c', 'information'], work_path, papers, output_bytes
+    ))
+    stages.append(run_stage(
+        'find_in_raw_data', ['utilities/find_in_raw_data.py', '-n', str(workers), '--scope', 'all', '--data', 'data'],
+        work_path, documents, corpus_bytes
+    ))
+    return stages
+
+
+def corpus_size(corpus_path):
+    """
+      Count the documents in a corpus, and their total (uncompressed) size
+    """
+
+    documents = 0
+    corpus_bytes = 0
+    for zip_file in os.listdir(corpus_path):
+        zipped_file = zipfile.ZipFile(os.path.join(corpus_path, zip_file))
+        for info in zipped_file.infolist():
+            if info.filename.endswith('xml'):
+                documents += 1
+                corpus_bytes += info.file_size
+        zipped_file.close()
+    return documents, corpus_bytes
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=repository_path,
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def previous_result(results, result):
+    """
+      Find the last result recorded for the same corpus & options, to compare against
+    """
+
+    for previous in reversed(results):
+        if all([previous[key] == result[key] for key in ['corpus', 'workers', 'binary']]):
+            return previous
+    return None
+
+
+def output_results(result, previous):
+    print "\n%-18s %6s %10s %12s %10s %13s %14s" % (
+        'Stage', 'Status', 'Seconds', 'Docs/sec', 'MB/sec', 'Peak RSS (MB)', 'Docs/sec change'
+    )
+    previous_stages = dict((stage['stage'], stage) for stage in previous['stages']) if previous else {}
+    for stage in result['stages']:
+        change = ''
+        previous_stage = previous_stages.get(stage['stage'])
+        if previous_stage is not None and previous_stage['documents_per_second']:
+            change = '%+.1f%%' % (
+                100 * (stage['documents_per_second'] / previous_stage['documents_per_second'] - 1)
+            )
+        print "%-18s %6d %10.2f %12.1f %10.2f %13.1f %14s" % (
+            stage['stage'], stage['exit_status'], stage['seconds'], stage['documents_per_second'],
+            stage['bytes_per_second'] / 1024 / 1024, stage['peak_rss_mb'], change
+        )
+    if previous is not None:
+        print "\n(Compared to the run at %s, commit %s)" % (previous['time'], previous['commit'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the whole pipeline on a synthetic corpus')
+    parser.add_argument('-z', '--zip-files', type=int, default=10, help='the number of zip files to generate')
+    parser.add_argument('-d', '--documents', type=int, default=1000, help='the number of documents per zip file')
+    parser.add_argument('--seed', type=int, default=0, help='the random seed of the corpus')
+    parser.add_argument('--raw-text-size', type=int, default=20000,
+                        help='the approximate size in bytes of the full text body of each document')
+    parser.add_argument('-n', '--workers', type=int, default=2,
+                        help='the number of slaves / workers each stage runs on (defaults to 2)')
+    parser.add_argument('--binary', action='store_true', help='write intermediate output in the binary record format')
+    parser.add_argument('--corpus', help='reuse the corpus already generated in this folder (with the same options)')
+    parser.add_argument('--results', default=results_path,
+                        help='the file to record results in & compare them against (defaults to %s)' % results_path)
+    parser.add_argument('--label', help='a note to record with the results')
+    parser.add_argument('--keep', action='store_true', help='keep the work folder (with each stage\'s output & log)')
+    args = parser.parse_args()
+
+    work_path = tempfile.mkdtemp(prefix='arnetminer-benchmark-')
+    corpus_path = args.corpus or os.path.join(work_path, 'corpus')
+    if args.corpus is None:
+        generate_synthetic_corpus.generate_corpus(
+            corpus_path, args.zip_files, args.documents, args.seed, args.raw_text_size
+        )
+    documents, corpus_bytes = corpus_size(corpus_path)
+
+    set_up_work_folder(work_path, corpus_path)
+    result = {
+        'time': datetime.datetime.now().isoformat(),
+        'commit': current_commit(),
+        'label': args.label,
+        'corpus': {
+            'zip_files': args.zip_files, 'documents': args.documents, 'seed': args.seed,
+            'raw_text_size': args.raw_text_size
+        },
+        'workers': args.workers,
+        'binary': args.binary,
+        'stages': run_benchmarks(work_path, documents, corpus_bytes, args.workers, args.binary),
+    }
+
+    results = []
+    if os.path.exists(args.results):
+        with open(args.results) as results_file:
+            results = [json.loads(line) for line in results_file if line.strip()]
+    output_results(result, previous_result(results, result))
+    with open(args.results, 'a') as results_file:
+        results_file.write(json.dumps(result, sort_keys=True) + '\n')
+
+    if args.keep:
+        print "\nKept the work folder, '%s'" % work_path
+    else:
+        shutil.rmtree(work_path)
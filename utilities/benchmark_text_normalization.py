@@ -0,0 +1,64 @@
+import os
+import re
+import string
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import text_normalization
+
+__author__ = 'jontedesco'
+
+# The filters the parsers used before the translate tables
+old_printable = lambda s: filter(lambda x: x in string.printable, s)
+old_ascii_printable = lambda s: filter(lambda x: x in string.letters, s)
+old_collapse_whitespace = lambda s: re.sub(r'\s+', ' ', s.strip())
+old_control_chars = ''.join(map(unichr, list(range(0, 32)) + list(range(127, 160))))
+old_control_chars_regex = re.compile('[%s]' % re.escape(old_control_chars))
+old_remove_control_chars = lambda s: old_control_chars_regex.sub('', s.strip('\xef\xbb\xbf'))
+
+# Strings shaped like the titles, author names & venues found in the data
+sample_strings = {
+    'ascii title': 'Efficient  Query Processing over\tLarge Spatial Data Structures (Extended Abstract)',
+    'unicode title': u'R\xe9sum\xe9 of na\xefve B\xe9zier \u2013 curve fitting for \u03b1-shapes',
+    'author name': 'Hanan Samet',
+    'venue': 'Journal of Computer and System Sciences',
+}
+
+# Each old filter, paired with its replacement
+filters = [
+    ('printable', old_printable, text_normalization.printable),
+    ('ascii_printable', old_ascii_printable, text_normalization.ascii_printable),
+    ('collapse_whitespace', old_collapse_whitespace, text_normalization.collapse_whitespace),
+    ('remove_control_chars', old_remove_control_chars, text_normalization.remove_control_chars),
+]
+
+
+def strings_per_second(function, s, repeat=3, number=20000):
+    """
+      Measure how many times per second the given function can normalize the given string (best of several runs)
+    """
+
+    best_time = min(timeit.repeat(lambda: function(s), repeat=repeat, number=number))
+    return number / best_time
+
+
+if __name__ == '__main__':
+
+    print "%-22s %-15s %15s %15s %9s" % ('Filter', 'String', 'Old (str/sec)', 'New (str/sec)', 'Speedup')
+    for name, old_function, new_function in filters:
+        for sample_name in sorted(sample_strings):
+            s = sample_strings[sample_name]
+
+            # Make sure the replacement gives the same text (skipping strings the old filter couldn't handle)
+            try:
+                old_result = old_function(s)
+            except UnicodeError:
+                print "%-22s %-15s %15s %15d" % (name, sample_name, 'n/a', strings_per_second(new_function, s))
+                continue
+            if old_result != new_function(s):
+                print "Mismatch for %s on %s: %r != %r" % (name, sample_name, old_result, new_function(s))
+
+            old_rate = strings_per_second(old_function, s)
+            new_rate = strings_per_second(new_function, s)
+            print "%-22s %-15s %15d %15d %8.1fx" % (name, sample_name, old_rate, new_rate, new_rate / old_rate)
@@ -1,10 +1,13 @@
+import argparse
 from collections import defaultdict
+import multiprocessing
 import os
-import re
-import subprocess
 import zipfile
 import sys
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import raw_catalog
+
 __author__ = 'jontedesco'
 
 # The path to the input data (check several locations, for convenience)
@@ -23,79 +26,216 @@ strings_to_find = {
     ]
 }
 
-# Matched documents for each keyword group
+# Matched documents for each keyword group, and where to extract them to
 matches = defaultdict(list)
+inspect_dir = 'to_inspect'
+
+# Where the raw content of docs starts & ends
+raw_text_start = '<dp:raw-text'
+raw_text_end = '</dp:raw-text>'
+
+# The strings of each keyword group (lowercased when ignoring case), whether to ignore case, and whether to only search
+# the metadata of each document (set in each worker process)
+group_strings = None
+case_insensitive = False
+metadata_only = True
+
+
+def build_group_strings(strings_to_find, ignore_case=False):
+    """
+      Get the strings of each keyword group as a list of (keyword group, strings), lowercasing them when ignoring case
+      (so each document can just be lowercased once, rather than matched case-insensitively). Each group is searched
+      for on its own, so a match of one group can't hide an overlapping match of another (e.g. 'kdd' in 'kdd cup').
+    """
+
+    return [(string_group, [string_to_find.lower() if ignore_case else string_to_find
+                            for string_to_find in strings_to_find[string_group]])
+            for string_group in sorted(strings_to_find)]
+
+
+def init_worker(strings, ignore_case, search_metadata_only):
+    global group_strings, case_insensitive, metadata_only
+    group_strings = build_group_strings(strings, ignore_case)
+    case_insensitive = ignore_case
+    metadata_only = search_metadata_only
+
+
+def strip_raw_text(xml_content):
+    """
+      Remove main content of paper, if possible
+    """
+
+    start = xml_content.find(raw_text_start)
+    if start < 0:
+        return xml_content
+    end = xml_content.find(raw_text_end, start)
+    if end < 0:
+        return xml_content[:start]
+    return xml_content[:start] + xml_content[end + len(raw_text_end):]
+
+
+def extract_documents(task):
+    """
+      Extract the matched documents from one zip file into the inspection folder of their keyword group, opening the
+      zip file just once, and returning the number of documents extracted along with any errors
+    """
+
+    filename, documents = task
+    full_file_path = os.path.join(data_path, filename)
+    try:
+        zipped_file = zipfile.ZipFile(full_file_path, "r")
+    except (zipfile.BadZipfile, IOError), e:
+        return filename, 0, ["Failed to extract from '%s': '%s'" % (full_file_path, e)]
+
+    documents_extracted = 0
+    errors = []
+    for string_group, xml_file_name in documents:
+        try:
+            zipped_file.extract(xml_file_name, os.path.join(inspect_dir, string_group))
+            documents_extracted += 1
+        except (KeyError, IOError, OSError), e:
+            errors.append("Failed to extract '%s' from '%s': '%s'" % (xml_file_name, full_file_path, e))
 
-# Find the raw content of docs
-raw_text_regex = re.compile('<dp:raw-text>.*</dp:raw-text>')
+    zipped_file.close()
+    return filename, documents_extracted, errors
 
-if __name__ == '__main__':
 
-    documents_found = 0
-    zip_files_processed = 0
-    zip_files_to_process = 1052
-    total_papers = 10454961
+def search_zip_file(task):
+    """
+      Search each document in a zip file (or just the members selected from it in the catalog) for all strings to find,
+      returning the number of documents found, and the (keyword group, zip file, document, string found) of each match,
+      along with any error opening the zip file
+    """
 
-    for filename in os.listdir(data_path):
-        full_file_path = os.path.join(data_path, filename)
+    filename, members = task
+    full_file_path = os.path.join(data_path, filename)
+    documents_found = 0
+    file_matches = []
 
-        # Open zip file, or skip if invalid
-        try:
+    # Open zip file (seeking straight to the selected members, if any), or skip if invalid
+    try:
+        if members is not None:
+            zipped_file = raw_catalog.CatalogZipFile(full_file_path, members)
+        else:
             zipped_file = zipfile.ZipFile(full_file_path, "r")
-        except zipfile.BadZipfile, e:
-            print "Skipping '%s', error opening zip file: '%s'" % (full_file_path, e.message)
+    except zipfile.BadZipfile, e:
+        return filename, 0, [], "Skipping '%s', error opening zip file: '%s'" % (full_file_path, e.message)
+    except AssertionError, e:
+        return filename, 0, [], "Skipping '%s', assertion error: '%s'" % (full_file_path, e.message)
+    except IOError, e:
+        return filename, 0, [], "Skipping '%s', I/O error: '%s'" % (full_file_path, e.message)
+
+    # Iterate through each file in the document
+    for xml_file_name in zipped_file.namelist():
+        documents_found += 1
+
+        # Skip non-xml files
+        if not xml_file_name.endswith('xml'):
+            print "Skipping non-xml file in archive: '%s'" % xml_file_name
             continue
-        except AssertionError, e:
-            print "Skipping '%s', assertion error: '%s'" % (full_file_path, e.message)
-            continue
-        except IOError, e:
-            print "Skipping '%s', I/O error: '%s'" % (full_file_path, e.message)
+
+        # Get paper contents
+        xml_content = zipped_file.read(xml_file_name)
+        if not len(xml_content.strip()):
             continue
+        if metadata_only:
+            xml_content = strip_raw_text(xml_content)
 
-        # Iterate through each file in the document
-        for xml_file_name in zipped_file.namelist():
-            documents_found += 1
-
-            # Skip non-xml files
-            if not xml_file_name.endswith('xml'):
-                print "Skipping non-xml file in archive: '%s'" % xml_file_name
-                continue
-
-            # Get paper contents
-            xml_content = zipped_file.read(xml_file_name)
-            if not len(xml_content.strip()):
-                continue
-
-            # Remove main content of paper, if possible
-            xml_content = re.sub(raw_text_regex, '', xml_content)
-
-            # Search for each substring
-            substring_found = None
-            for string_group in strings_to_find:
-                for string_to_find in strings_to_find[string_group]:
-                    if string_to_find in xml_content:
-                        substring_found = string_to_find
-                        matches[string_group].append((filename, xml_file_name))
-                        break
-
-            # Output progress
-            if documents_found % 10 == 0:
-                percent_complete = 100 * float(documents_found) / total_papers
-                sys.stdout.write("\r (~%2.2f%%) Processed %d / %d ZIP Files, %d / ~%d papers ... " % (
-                    percent_complete, zip_files_processed, zip_files_to_process, documents_found, total_papers)
-                )
+        # Search for each keyword group's substrings, recording the first of each group's strings found (as written in
+        # the document, since lowercasing leaves its offsets unchanged)
+        searched_content = xml_content.lower() if case_insensitive else xml_content
+        for string_group, strings in group_strings:
+            for string_to_find in strings:
+                start = searched_content.find(string_to_find)
+                if start >= 0:
+                    file_matches.append((string_group, filename, xml_file_name,
+                                         xml_content[start:start + len(string_to_find)]))
+                    break
 
-        zip_files_processed += 1
+    zipped_file.close()
+    return filename, documents_found, file_matches, None
 
-    # Extract target XML files
-    inspect_dir = 'to_inspect'
-    for string_group in matches:
-        os.mkdir(os.path.join(inspect_dir, string_group))
 
-        # Extract to inspection dir
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Find the raw documents containing any of the strings to find')
+    parser.add_argument('-n', '--workers', type=int, default=multiprocessing.cpu_count(),
+                        help='the number of processes to search zip files on (defaults to the number of CPUs)')
+    parser.add_argument('-i', '--ignore-case', action='store_true', help='match strings regardless of case')
+    parser.add_argument('--scope', choices=['metadata', 'all'], default='metadata',
+                        help="search just each document's metadata (without its raw text), or all of it")
+    parser.add_argument('--catalog', help='only search the members selected from this catalog of the raw data (see '
+                                          'raw_catalog.py), reading them straight from their local headers')
+    raw_catalog.add_selection_arguments(parser)
+    parser.add_argument('--data', default=data_path, help='the raw data to search (defaults to %s)' % data_path)
+    args = parser.parse_args()
+    data_path = args.data
+
+    documents_found = 0
+    zip_files_processed = 0
+    total_papers = 10454961
+
+    # Search every document, or just those selected from the catalog (in zip files unchanged since they were cataloged)
+    if args.catalog:
+        catalog = raw_catalog.Catalog(args.catalog)
+        selected = raw_catalog.members_by_zip_file(catalog.members(
+            aggregation_types=args.aggregation_types, years=args.years, max_size=args.max_size
+        ))
+        tasks = []
+        for filename, members in selected.iteritems():
+            if catalog.is_current(filename, os.path.join(data_path, filename)):
+                tasks.append((filename, members))
+            else:
+                print "Skipping '%s', changed since it was cataloged" % filename
+        catalog.close()
+        total_papers = sum([len(members) for filename, members in tasks])
+        print "Searching %d documents selected from %d ZIP files" % (total_papers, len(tasks))
+    else:
+        tasks = [(filename, None) for filename in sorted(os.listdir(data_path))]
+    zip_files_to_process = len(tasks)
+
+    # Search the zip files in parallel, outputting matches as each zip file is finished
+    pool = multiprocessing.Pool(
+        args.workers, init_worker, (strings_to_find, args.ignore_case, args.scope == 'metadata')
+    )
+    for filename, file_documents_found, file_matches, error in pool.imap_unordered(search_zip_file, tasks):
+        if error is not None:
+            print "\n%s" % error
+        for string_group, filename, xml_file_name, string_found in file_matches:
+            matches[string_group].append((filename, xml_file_name))
+            print "\r%s\t%s\t%s\t%s" % (string_group, filename, xml_file_name, string_found)
+
+        # Output progress
+        documents_found += file_documents_found
+        zip_files_processed += 1
+        percent_complete = 100 * float(documents_found) / total_papers
+        sys.stdout.write("\r (~%2.2f%%) Processed %d / %d ZIP Files, %d / ~%d papers ... " % (
+            percent_complete, zip_files_processed, zip_files_to_process, documents_found, total_papers)
+        )
+        sys.stdout.flush()
+
+    # Extract target XML files, grouped by zip file (so each is only opened once), on the same pool
+    documents_to_extract = defaultdict(list)
+    for string_group in matches:
         for filename, xml_file_name in matches[string_group]:
-            subprocess.Popen('unzip -d %s %s %s' % (
-                os.path.join(inspect_dir, string_group),
-                os.path.join('../data', filename),
-                xml_file_name
-            ), shell=True)
+            documents_to_extract[filename].append((string_group, xml_file_name))
+
+    documents_extracted = 0
+    extraction_errors = []
+    for filename, file_documents_extracted, file_errors in \
+            pool.imap_unordered(extract_documents, sorted(documents_to_extract.iteritems())):
+        documents_extracted += file_documents_extracted
+        extraction_errors.extend(file_errors)
+        sys.stdout.write("\rExtracted %d / %d documents..." % (
+            documents_extracted, sum(map(len, matches.itervalues()))
+        ))
+    pool.close()
+    pool.join()
+
+    # Report what was extracted
+    print "\n\nExtracted %d / %d documents from %d ZIP files into '%s'" % (
+        documents_extracted, sum(map(len, matches.itervalues())), len(documents_to_extract), inspect_dir
+    )
+    for string_group in sorted(matches):
+        print "\t%s: %d documents" % (string_group, len(matches[string_group]))
+    for error in extraction_errors:
+        print error
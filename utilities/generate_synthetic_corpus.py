@@ -0,0 +1,252 @@
+import argparse
+import os
+import random
+import sys
+import zipfile
+from xml.sax.saxutils import escape
+
+__author__ = 'jontedesco'
+
+# Where to write the synthetic zip files (named like those of the real data)
+output_path = 'synthetic_data'
+
+# Words, names & venues papers are made up from (with some non-ascii text, as in the real data, though only a few titles
+# get a non-ascii word, since the first pass fails to stem them)
+title_words = (
+    'adaptive algorithm analysis approximate bayesian clustering compression concurrent data database distributed '
+    'dynamic efficient estimation evaluation framework graph hierarchical incremental index inference knowledge '
+    'large-scale learning mining model network neural optimal parallel probabilistic query ranking retrieval robust '
+    'scalable search semantic sparse spatial stochastic stream structure system temporal web'
+).split()
+non_ascii_title_words = [u'b\xe9zier', u'r\xe9sum\xe9', u'\u03b1-shapes', u'na\xefve']
+given_names = ['Anna', 'Hanan', 'Jiawei', 'Wei', 'Maria', 'David', 'Yuki', u'J\xfcrgen', u'Fran\xe7ois', 'Priya']
+surnames = ['Samet', 'Han', 'Chen', 'Garcia', 'Smith', 'Tanaka', u'M\xfcller', u'Lef\xe8vre', 'Kumar', 'Wang', 'Lee',
+            'Brown', 'Nguyen', 'Kowalski', 'Rossi', 'Okafor']
+journals = ['Journal of Computer and System Sciences', 'Information Systems', 'Data & Knowledge Engineering',
+            'Pattern Recognition', 'Artificial Intelligence', 'Information Processing Letters']
+journal_ids = ['JCSS', 'IS', 'DATAK', 'PR', 'ARTINT', 'IPL']
+book_series = ['Handbook of Data Mining', 'Advances in Computers', 'Studies in Logic']
+
+# Filler for the full text bodies of papers
+raw_text_words = ('the of and a to in is that for it as was with be by on not this are which or from at but an have '
+                  'results method proposed figure table data section approach we show').split()
+
+# The shapes of document the first pass handles, and how often each is generated
+document_shapes = [
+    ('journal', 40),  # publicationName venue, authors at the metadata depth, structured bibliography
+    ('cja journal', 20),  # cja jid venue, author-group authors, year from the copyright
+    ('book', 10),  # further-reading-sec references
+    ('bib-reference', 10),  # references in bib-reference elements, rather than a bibliography
+    ('nested bib-reference', 5),  # bib-reference one level deeper
+    ('fb-non-chapter', 3),  # skipped as a non-chapter
+    ('missing authors', 3),
+    ('missing venue', 3),
+    ('useless title', 3),  # skipped by its title
+    ('empty', 3),  # an empty XML file
+]
+
+# The shapes of reference generated, and how often each is generated
+reference_shapes = [
+    ('structured', 70),  # title in the contribution
+    ('host title', 10),  # title only in the host
+    ('textref', 10),  # plain text reference
+    ('missing authors', 5),
+    ('missing title', 5),
+]
+
+namespaces = (
+    'xmlns:ce="http://www.elsevier.com/xml/common/schema" '
+    'xmlns:sb="http://www.elsevier.com/xml/common/struct-bib/schema" '
+    'xmlns:dp="http://www.elsevier.com/xml/common/doc-properties/schema" '
+    'xmlns:dc="http://purl.org/dc/elements/1.1/" '
+    'xmlns:prism="http://prismstandard.org/namespaces/basic/2.0/" '
+    'xmlns:cja="http://www.elsevier.com/xml/cja/schema" '
+    'xmlns:bk="http://www.elsevier.com/xml/bk/schema"'
+)
+
+
+def weighted_choice(generator, choices):
+    total = sum([weight for choice, weight in choices])
+    point = generator.uniform(0, total)
+    for choice, weight in choices:
+        point -= weight
+        if point <= 0:
+            return choice
+    return choices[-1][0]
+
+
+def make_papers(paper_count, generator):
+    """
+      Make up the title & authors of every paper up front, so references can point at papers anywhere in the corpus (a
+      few papers share a title & first author, so their ids collide)
+    """
+
+    papers = []
+    for i in xrange(paper_count):
+        if papers and generator.random() < 0.002:
+            papers.append(generator.choice(papers))
+            continue
+        words = generator.sample(title_words, generator.randint(4, 9))
+        if generator.random() < 0.001:
+            words.append(generator.choice(non_ascii_title_words))
+        title = ' '.join(words).capitalize()
+        authors = [(generator.choice(given_names), generator.choice(surnames)) for j in xrange(generator.randint(1, 4))]
+        papers.append((title, authors))
+    return papers
+
+
+def author_xml(authors, tag='ce:author'):
+    return ''.join(['<%s><ce:given-name>%s</ce:given-name><ce:surname>%s</ce:surname></%s>' % (
+        tag, escape(given_name), escape(surname), tag
+    ) for given_name, surname in authors])
+
+
+def reference_xml(paper, shape):
+    """
+      Build one reference to the given paper, in the given shape
+    """
+
+    title, authors = paper
+    if shape == 'textref':
+        return '<sb:reference><ce:other-ref><ce:textref>%s, %s</ce:textref></ce:other-ref></sb:reference>' % (
+            escape(authors[0][1]), escape(title)
+        )
+
+    contribution_authors = '' if shape == 'missing authors' else '<sb:authors>%s</sb:authors>' % author_xml(
+        authors, 'sb:author'
+    )
+    contribution_title = '<sb:title><sb:maintitle>%s</sb:maintitle></sb:title>' % escape(title)
+    host_title = ''
+    if shape == 'host title':
+        host_title = '<sb:edited-book><sb:book-series><sb:series><sb:title><sb:maintitle>%s</sb:maintitle></sb:title>' \
+                     '</sb:series></sb:book-series></sb:edited-book>' % escape(title)
+    if shape not in {'structured', 'missing authors'}:
+        contribution_title = ''
+    return '<sb:reference><sb:contribution>%s%s</sb:contribution><sb:host>%s<sb:pages><sb:first-page>1' \
+           '</sb:first-page></sb:pages></sb:host></sb:reference>' % (
+               contribution_authors, contribution_title, host_title
+           )
+
+
+def raw_text(generator, size):
+    """
+      Make up a full text body of about the given size
+    """
+
+    words = []
+    length = 0
+    while length < size:
+        word = generator.choice(raw_text_words)
+        words.append(word)
+        length += len(word) + 1
+    return ' '.join(words)
+
+
+def document_xml(papers, number, shape, generator, raw_text_size, references_per_document):
+    """
+      Build the XML of one document in the given shape
+    """
+
+    if shape == 'empty':
+        return ''
+
+    title, authors = papers[number]
+    if shape == 'useless title':
+        title = generator.choice(['Editorial board', 'Author index', 'Contents of volume 12', 'Introduction'])
+    year = generator.randint(1980, 2012)
+    references = ''.join([reference_xml(
+        generator.choice(papers), weighted_choice(generator, reference_shapes)
+    ) for i in xrange(generator.randint(0, references_per_document * 2))])
+
+    metadata = ['<dc:title>%s</dc:title>' % escape(title)]
+    if shape == 'cja journal':
+        metadata.append('<ce:author-group>%s</ce:author-group>' % author_xml(authors))
+    elif shape != 'missing authors':
+        metadata.append(author_xml(authors))
+    metadata.append('<prism:aggregationType>%s</prism:aggregationType>' % ('Book' if shape == 'book' else 'Journal'))
+
+    if shape == 'cja journal':
+        metadata.append('<cja:jid>%s</cja:jid>' % generator.choice(journal_ids))
+        metadata.append('<ce:copyright type="full-transfer" year="%d">Elsevier Science B.V.</ce:copyright>' % year)
+    else:
+        if shape != 'missing venue':
+            venue = generator.choice(book_series if shape == 'book' else journals)
+            metadata.append('<prism:publicationName>%s</prism:publicationName>' % escape(venue))
+        metadata.append('<prism:coverDisplayDate>%d</prism:coverDisplayDate>' % year)
+
+    if shape == 'book':
+        metadata.append('<ce:further-reading-sec><ce:section-title>Further reading</ce:section-title>'
+                        '<ce:bib-reference>%s</ce:bib-reference></ce:further-reading-sec>' % references)
+    elif shape == 'bib-reference':
+        metadata.append('<ce:sections><ce:bib-reference><ce:reference-list>%s</ce:reference-list></ce:bib-reference>'
+                        '</ce:sections>' % references)
+    elif shape == 'nested bib-reference':
+        metadata.append('<ce:sections><ce:section><ce:bib-reference>%s</ce:bib-reference></ce:section>'
+                        '</ce:sections>' % references)
+    elif generator.random() < 0.5:
+        metadata.append('<ce:bibliography><ce:bibliography-sec><ce:bib-reference>%s</ce:bib-reference>'
+                        '</ce:bibliography-sec></ce:bibliography>' % references)
+    else:
+        metadata.append('<ce:bibliography><ce:bib-reference>%s</ce:bib-reference></ce:bibliography>' % references)
+    metadata.append('<ce:keywords><ce:keyword><ce:text>%s</ce:text></ce:keyword></ce:keywords>' % escape(title))
+
+    document = u'<?xml version="1.0" encoding="UTF-8"?>\n<full-text-retrieval-response %s>' % namespaces
+    if shape == 'fb-non-chapter':
+        document += '<bk:fb-non-chapter/>'
+    document += '<originalText><document>%s</document><dp:raw-text>%s</dp:raw-text></originalText>' % (
+        ''.join(metadata), raw_text(generator, raw_text_size)
+    )
+    document += '</full-text-retrieval-response>'
+    return document.encode('utf-8')
+
+
+def generate_corpus(output_path, zip_file_count, documents_per_zip_file, seed=0, raw_text_size=20000,
+                    references_per_document=15):
+    """
+      Write a synthetic corpus of zip files of Elsevier-schema XML documents, covering every shape of document &
+      reference the first pass handles. Returns the number of documents written, and their total (uncompressed) size.
+    """
+
+    generator = random.Random(seed)
+    papers = make_papers(zip_file_count * documents_per_zip_file, generator)
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+
+    documents_written = 0
+    bytes_written = 0
+    for zip_file_number in xrange(zip_file_count):
+        zip_file_path = os.path.join(output_path, '%02d-%03d.ZIP' % (zip_file_number % 100, zip_file_number // 100 + 1))
+        zipped_file = zipfile.ZipFile(zip_file_path, 'w', zipfile.ZIP_DEFLATED)
+        for document_number in xrange(documents_per_zip_file):
+            paper_number = zip_file_number * documents_per_zip_file + document_number
+            document = document_xml(
+                papers, paper_number, weighted_choice(generator, document_shapes), generator, raw_text_size,
+                references_per_document
+            )
+            zipped_file.writestr('%04d/%d.xml' % (zip_file_number, paper_number), document)
+            documents_written += 1
+            bytes_written += len(document)
+
+        # Archives of the real data hold the odd non-xml file too
+        zipped_file.writestr('%04d/README.txt' % zip_file_number, 'Synthetic data, generated with seed %d\n' % seed)
+        zipped_file.close()
+
+        sys.stdout.write("\rGenerated %d / %d ZIP files..." % (zip_file_number + 1, zip_file_count))
+        sys.stdout.flush()
+
+    print "\nGenerated %d documents (%d bytes) in '%s'" % (documents_written, bytes_written, output_path)
+    return documents_written, bytes_written
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic corpus shaped like the raw Elsevier XML data')
+    parser.add_argument('-o', '--output', default=output_path, help='where to write the zip files')
+    parser.add_argument('-z', '--zip-files', type=int, default=10, help='the number of zip files to generate')
+    parser.add_argument('-d', '--documents', type=int, default=1000, help='the number of documents per zip file')
+    parser.add_argument('--seed', type=int, default=0, help='the random seed (the same seed gives the same corpus)')
+    parser.add_argument('--raw-text-size', type=int, default=20000,
+                        help='the approximate size in bytes of the full text body of each document')
+    parser.add_argument('--references', type=int, default=15, help='the average number of references per document')
+    args = parser.parse_args()
+
+    generate_corpus(args.output, args.zip_files, args.documents, args.seed, args.raw_text_size, args.references)
@@ -0,0 +1,28 @@
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import final_output_index
+
+__author__ = 'jontedesco'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Look up papers in the final output by index, through its index file')
+    parser.add_argument('paper_ids', metavar='index', type=int, nargs='+', help='the index of a paper to look up')
+    parser.add_argument('-r', '--references', action='store_true',
+                        help='look up the papers referenced by each paper, rather than the paper itself')
+    parser.add_argument('-o', '--output', default=os.path.join('final_output', 'final_output.txt'),
+                        help='the final output file to look papers up in (defaults to final_output/final_output.txt)')
+    args = parser.parse_args()
+
+    index = final_output_index.OutputIndex(args.output)
+    for paper_id in args.paper_ids:
+        records = index.references(paper_id) if args.references else [index.lookup(paper_id)]
+        if records is None or records == [None]:
+            print "Paper %d not found\n" % paper_id
+            continue
+        for record in records:
+            sys.stdout.write(record if record is not None else "(Reference not found)\n\n")
+    index.close()
@@ -1,7 +1,18 @@
+from array import array
+import argparse
+import bisect
+import json
+import numpy
+import os
 import sys
 from collections import defaultdict
 from Stemmer import Stemmer
 
+repository_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, repository_path)
+import external_sort
+from text_normalization import ascii_printable, collapse_whitespace
+
 confs = [
     'POWER',
     'AAAI',
@@ -116,35 +127,293 @@ for keyword in keywords:
     new_keywords.add(stemmer.stemWord(keyword.lower()))
 keywords = new_keywords
 
-conferences = defaultdict(int)
+# Get the same stop words the parsers use
+with open(os.path.join(repository_path, 'stopWords.json')) as stop_words_file:
+    stop_words = set(json.load(stop_words_file))
+
+# The search index is kept in its own folder alongside the data, holding:
+#   header.json: the number of documents & citations (along with the size & modification time of the data it was built
+#                from)
+#   venues.keys, terms.keys: the normalized venues & stemmed title terms, sorted & concatenated
+#   venues.table, terms.table: for each venue or term in order, the end of it in its keys file, and the position &
+#                              length of its postings (little-endian uint64, uint64 & uint32)
+#   postings.bin: the sorted document numbers of each posting list, as little-endian uint32s
+#   documents.bin: the byte offset of each document in the data, as little-endian uint64s
+# Every file but the header is memory-mapped, so a query only reads the keys it binary searches & the postings it needs.
+index_folder_suffix = '.search'
+postings_dtype = numpy.dtype('<u4')
+document_offset_dtype = numpy.dtype('<u8')
+key_table_dtype = numpy.dtype([('key_end', '<u8'), ('position', '<u8'), ('length', '<u4')])
+key_kinds = ['venues', 'terms']
+
+
+class KeyTable(object):
+    """
+      The sorted venues or title terms of the search index, memory-mapped, with the position & length of the postings
+      of each. Keys are read from the keys file as they're needed, so it can be binary searched without loading it.
+    """
+
+    def __init__(self, index_path, kind):
+        self.entries = external_sort.map_ids(os.path.join(index_path, '%s.table' % kind), key_table_dtype)
+        self.keys = external_sort.map_ids(os.path.join(index_path, '%s.keys' % kind), numpy.uint8)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, i):
+        """
+          Get the key at the given position in the table (so bisect can search the table like a sorted list)
+        """
+
+        start = int(self.entries['key_end'][i - 1]) if i else 0
+        return self.keys[start:int(self.entries['key_end'][i])].tostring()
+
+    def find(self, key):
+        """
+          Get the position & length of the postings of the given key, or None if it isn't in the table
+        """
+
+        i = bisect.bisect_left(self, key)
+        if i == len(self) or self[i] != key:
+            return None
+        return int(self.entries['position'][i]), int(self.entries['length'][i])
+
+    def iterkeys(self):
+        """
+          Generator over every key in the table, in order, reading through the keys file once
+        """
+
+        keys = self.keys.tostring()
+        start = 0
+        for end in self.entries['key_end'].tolist():
+            yield keys[start:end]
+            start = end
+
+
+def normalize_venue(venue):
+    """
+      Normalize a venue name for the index
+    """
+
+    return collapse_whitespace(venue.lower())
+
+
+def stemmed_terms(text):
+    """
+      Get the stemmed terms of some text (after removing stop words), as the first pass parser stems titles
+    """
+
+    words = [word for word in text.lower().split() if word not in stop_words]
+    return set([term for term in map(ascii_printable, stemmer.stemWords(words)) if term])
+
+
+def build_index(data_path, index_path):
+    """
+      Build the search index for the data in one pass over it
+    """
+
+    postings_by_kind = {'venues': defaultdict(lambda: array('I')), 'terms': defaultdict(lambda: array('I'))}
+    document_offsets = []
+    citations_found = 0
+
+    # Venues are indexed under the document whose title started the current entry (so a venue before any title, or in
+    # an entry without one, is skipped)
+    offset = 0
+    document_number = None
+    with open(data_path) as data_file:
+        for line in data_file:
+            if line.startswith('#*'):
+                document_number = len(document_offsets)
+                document_offsets.append(offset)
+                for term in stemmed_terms(line[len('#*'):]):
+                    postings_by_kind['terms'][term].append(document_number)
+            elif line.startswith('#conf'):
+                if document_number is not None:
+                    postings_by_kind['venues'][normalize_venue(line[len('#conf'):])].append(document_number)
+            elif line.startswith('#%'):
+                citations_found += 1
+            elif not line.strip():
+                document_number = None
+            offset += len(line)
+
+            if len(document_offsets) % 10000 == 0 and line.startswith('#*'):
+                sys.stdout.write('\rIndexed %d docs' % len(document_offsets))
+
+    data_stat = os.stat(data_path)
+    header = {
+        'size': data_stat.st_size,
+        'mtime': int(data_stat.st_mtime),
+        'docs': len(document_offsets),
+        'citations': citations_found,
+    }
+
+    # Drop the header (and any dictionary from an older index format) first, so a partly rewritten index isn't used
+    if not os.path.exists(index_path):
+        os.makedirs(index_path)
+    header_path = os.path.join(index_path, 'header.json')
+    for stale_name in ['header.json', 'dictionary.json']:
+        if os.path.exists(os.path.join(index_path, stale_name)):
+            os.remove(os.path.join(index_path, stale_name))
+
+    with open(os.path.join(index_path, 'postings.bin'), 'wb') as postings_file:
+        position = 0
+        for kind in key_kinds:
+            postings = postings_by_kind[kind]
+            keys = sorted(postings)
+            table = numpy.zeros(len(keys), dtype=key_table_dtype)
+            key_end = 0
+            with open(os.path.join(index_path, '%s.keys' % kind), 'wb') as keys_file:
+                for i, key in enumerate(keys):
+                    numpy.frombuffer(postings[key], dtype=numpy.uintc).astype(postings_dtype).tofile(postings_file)
+                    keys_file.write(key)
+                    key_end += len(key)
+                    table[i] = (key_end, position, len(postings[key]))
+                    position += len(postings[key])
+            table.tofile(os.path.join(index_path, '%s.table' % kind))
+    numpy.array(document_offsets, dtype=document_offset_dtype).tofile(
+        os.path.join(index_path, 'documents.bin')
+    )
+
+    # Write the header last, so an index is only used once it's complete
+    with open(header_path, 'w') as header_file:
+        json.dump(header, header_file)
+    print "\rIndexed %d docs, %d venues & %d title terms" % (
+        len(document_offsets), len(postings_by_kind['venues']), len(postings_by_kind['terms'])
+    )
+
+
+def load_index(data_path, index_path):
+    """
+      Open the search index for the data, (re)building it first if it's missing or older than the data. Returns the
+      dictionary (the index's header, along with the key table of each kind), and memory maps of the postings & the
+      document offsets.
+    """
+
+    header_path = os.path.join(index_path, 'header.json')
+    dictionary = None
+    if os.path.exists(header_path):
+        with open(header_path) as header_file:
+            dictionary = json.load(header_file)
+        data_stat = os.stat(data_path)
+        if (dictionary['size'], dictionary['mtime']) != (data_stat.st_size, int(data_stat.st_mtime)):
+            dictionary = None
+
+    if dictionary is None:
+        build_index(data_path, index_path)
+        with open(header_path) as header_file:
+            dictionary = json.load(header_file)
+
+    for kind in key_kinds:
+        dictionary[kind] = KeyTable(index_path, kind)
+    postings = external_sort.map_ids(os.path.join(index_path, 'postings.bin'), postings_dtype)
+    document_offsets = external_sort.map_ids(os.path.join(index_path, 'documents.bin'), document_offset_dtype)
+    return dictionary, postings, document_offsets
+
+
+def postings_for(dictionary, postings, kind, key):
+    """
+      Get the sorted document numbers of the given venue or term
+    """
+
+    postings_range = dictionary[kind].find(key)
+    if postings_range is None:
+        return numpy.zeros(0, dtype=postings_dtype)
+    position, length = postings_range
+    return postings[position:position + length]
+
+
+def match_all(posting_lists):
+    return reduce(numpy.intersect1d, posting_lists) if posting_lists else None
+
+
+def match_any(posting_lists):
+    return reduce(numpy.union1d, posting_lists) if posting_lists else None
+
+
+def venues_matching(dictionary, conf):
+    """
+      Get the venues in the index that contain the given conference name (scanning just the venues' keys)
+    """
+
+    conf = normalize_venue(conf)
+    return [venue for venue in dictionary['venues'].iterkeys() if conf in venue]
+
+
+def search(dictionary, postings, confs_to_find, terms_to_find, match_any_term=False):
+    """
+      Find the documents published in any venue matching one of the given conferences, and with all (or any) of the
+      given stemmed title terms
+    """
+
+    venue_matches = match_any([postings_for(dictionary, postings, 'venues', venue)
+                               for conf in confs_to_find for venue in venues_matching(dictionary, conf)])
+    if confs_to_find and venue_matches is None:
+        venue_matches = numpy.zeros(0, dtype=postings_dtype)
+    term_posting_lists = [postings_for(dictionary, postings, 'terms', term) for term in terms_to_find]
+    term_matches = match_any(term_posting_lists) if match_any_term else match_all(term_posting_lists)
+
+    matches = match_all([m for m in [venue_matches, term_matches] if m is not None])
+    return matches if matches is not None else numpy.zeros(0, dtype=postings_dtype)
+
+
+def read_document(data_file, document_offsets, document_number):
+    """
+      Read the lines of a document in the data, given its number
+    """
+
+    data_file.seek(int(document_offsets[document_number]))
+    lines = []
+    for line in data_file:
+        if not line.strip():
+            break
+        lines.append(line)
+    return ''.join(lines)
+
+
+def output_conference_counts(dictionary, postings):
+    """
+      Output the number of documents in each venue matching one of the conferences, and some totals
+    """
+
+    conferences = defaultdict(int)
+    for conf in confs:
+        for venue in venues_matching(dictionary, conf):
+            conferences[venue] = dictionary['venues'].find(venue)[1]
 
+    print "\n"
+    for key in sorted(conferences.keys()):
+        print "\t%s: %d" % (key, conferences[key])
 
-def matches_keywords(title):
-    title_keywords = set([stemmer.stemWord(w) for w in title.lower().split()])
-    return len(title_keywords.intersection(keywords))
+    print "Docs Matching Keywords: %d" % len(search(dictionary, postings, [], keywords, match_any_term=True))
+    print "Citations Found: %d" % dictionary['citations']
+    print "Docs Found: %d" % dictionary['docs']
 
 
-def matches_confs(conf):
-    return any([conf.strip() in real_conf for real_conf in confs])
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Search the full Arnetminer data by venue & title keywords')
+    parser.add_argument('-c', '--conf', action='append', default=[],
+                        help='find documents from venues containing this name (any of them, if given more than once)')
+    parser.add_argument('-k', '--keyword', action='append', default=[],
+                        help='find documents with this word in their title (all of them, if given more than once)')
+    parser.add_argument('--any', action='store_true', help='find documents with any of the keywords, rather than all')
+    parser.add_argument('-l', '--limit', type=int, default=20, help='the number of matching documents to output')
+    parser.add_argument('--data', default='arnetminer_full.txt', help='the data to search')
+    parser.add_argument('--rebuild', action='store_true', help='rebuild the search index, even if it is up to date')
+    args = parser.parse_args()
 
-citations_found = 0
-with open('arnetminer_full.txt') as f:
-    docs_found = 0
-    total_docs = 8409380
-    for line in f:
-        if line.strip().startswith('#conf'):
-            docs_found += 1
-            conf = line[len('#conf'):].strip().lower()
-            if matches_confs(conf):
-                conferences[conf] += 1
-        elif line.strip().startswith('#%'):
-            citations_found += 1
-        if docs_found % 20 == 0:
-            sys.stdout.write('\rProcessed %d (%2.2f%%)' % (docs_found, 100 * float(docs_found) / total_docs))
+    index_path = args.data + index_folder_suffix
+    if args.rebuild:
+        build_index(args.data, index_path)
+    dictionary, postings, document_offsets = load_index(args.data, index_path)
 
-print "\n"
-for key in sorted(conferences.keys()):
-    print "\t%s: %d" % (key, conferences[key])
+    # Without a query, count the documents from each of the conferences we're interested in
+    if not args.conf and not args.keyword:
+        output_conference_counts(dictionary, postings)
+        sys.exit()
 
-print "Citations Found: %d" % citations_found
-print "Docs Found: %d" % docs_found
+    terms = set([term for keyword in args.keyword for term in stemmed_terms(keyword)])
+    matches = search(dictionary, postings, args.conf, terms, args.any)
+    with open(args.data) as data_file:
+        for document_number in matches[:args.limit].tolist():
+            print read_document(data_file, document_offsets, document_number)
+    print "Found %d / %d docs" % (len(matches), dictionary['docs'])
@@ -0,0 +1,198 @@
+from collections import deque
+from cStringIO import StringIO
+import stage_timers
+import sys
+import threading
+import zipfile
+
+__author__ = 'jontedesco'
+
+# By default, read ahead into the next zip file while the current one is parsed (double buffering), holding at most this
+# many bytes of decompressed members at once
+default_depth = 2
+default_byte_budget = 64 * 1024 * 1024
+
+
+class PrefetchedZipFile(object):
+    """
+      A zip file whose members are read & decompressed ahead of time by a prefetcher, standing in for a read-only
+      zipfile.ZipFile whose members are read in order: namelist() yields each name as its member arrives, after which
+      that member can be read
+    """
+
+    def __init__(self, prefetcher, path):
+        self.prefetcher = prefetcher
+        self.path = path
+        self.member = None
+        self.closed = False
+
+    def namelist(self):
+        while True:
+            item = self.prefetcher.take()
+            if item is None:
+                self.closed = True
+                return
+            self.member = item
+            yield item[0]
+
+    def getinfo(self, name):
+        info = zipfile.ZipInfo(name)
+        info.file_size = self.member[1] or 0
+        return info
+
+    def read(self, name):
+        name_read, file_size, data, error = self.member
+        if name_read != name:
+            raise KeyError("'%s' was not prefetched next from '%s'" % (name, self.path))
+        if error is not None:
+            raise error
+        return data
+
+    def open(self, name):
+        return StringIO(self.read(name))
+
+    def close(self):
+        """
+          Skip any members not read yet
+        """
+
+        if not self.closed:
+            for name in self.namelist():
+                pass
+        self.member = None
+
+
+class ZipPrefetcher(object):
+    """
+      Reads & decompresses the members of a sequence of zip files on a background thread (file I/O & zlib both release
+      the GIL), so reading from slow storage overlaps with parsing. Members are queued until parsed, reading at most
+      'depth' zip files ahead (counting the one being parsed), and holding at most 'byte_budget' bytes of decompressed
+      members at once (though a member bigger than the budget is still read when nothing else is queued). Given stage
+      timers, it records the time spent opening each zip file, and decompressing & waiting for each member.
+    """
+
+    def __init__(self, zip_file_paths, open_zip_file=zipfile.ZipFile, depth=default_depth,
+                 byte_budget=default_byte_budget, member_filter=None, timers=None):
+        self.open_zip_file = open_zip_file
+        self.timers = timers
+        self.depth = max(1, depth)
+        self.byte_budget = byte_budget
+        self.member_filter = member_filter
+
+        # The queue of items read ahead: ('open', path, error), ('member', (name, size, data, error)) or ('close',),
+        # with one ('end',) once every zip file has been read
+        self.condition = threading.Condition()
+        self.items = deque()
+        self.buffered_bytes = 0
+        self.zip_files_ahead = 0
+        self.stall_count = 0
+
+        self.thread = threading.Thread(target=self.__read_zip_files, args=(zip_file_paths,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __put(self, item, size=0):
+        with self.condition:
+            self.items.append(item)
+            self.buffered_bytes += size
+            self.condition.notify_all()
+
+    def __wait_for_room(self, size):
+        with self.condition:
+            while self.buffered_bytes and self.buffered_bytes + size > self.byte_budget:
+                self.condition.wait()
+
+    def __read_zip_files(self, zip_file_paths):
+        """
+          Read every member of each zip file in turn into the queue (run on the background thread)
+        """
+
+        try:
+            for path in zip_file_paths:
+                with self.condition:
+                    while self.zip_files_ahead >= self.depth:
+                        self.condition.wait()
+                    self.zip_files_ahead += 1
+
+                try:
+                    start_time = stage_timers.timer()
+                    zipped_file = self.open_zip_file(path)
+                    if self.timers is not None:
+                        self.timers.record('zip_open', stage_timers.timer() - start_time)
+                except:
+                    self.__put(('open', path, sys.exc_info()[1]))
+                    self.__put(('close',))
+                    continue
+                self.__put(('open', path, None))
+
+                try:
+                    for name in zipped_file.namelist():
+                        if self.member_filter is not None and not self.member_filter(name):
+                            self.__put(('member', (name, None, None, None)))
+                            continue
+
+                        file_size = zipped_file.getinfo(name).file_size
+                        self.__wait_for_room(file_size)
+                        try:
+                            start_time = stage_timers.timer()
+                            data = zipped_file.read(name)
+                            if self.timers is not None:
+                                self.timers.record('decompress', stage_timers.timer() - start_time)
+                            error = None
+                        except:
+                            data = ''
+                            error = sys.exc_info()[1]
+                        self.__put(('member', (name, file_size, data, error)), len(data))
+                finally:
+                    zipped_file.close()
+                    self.__put(('close',))
+
+        # Always mark the end, so the parser isn't left waiting if reading fails unexpectedly
+        finally:
+            self.__put(('end',))
+
+    def take(self):
+        """
+          Take the next member of the zip file being parsed, as (name, size, data, error), or None at its end
+        """
+
+        with self.condition:
+            start_time = stage_timers.timer()
+            if not self.items:
+                self.stall_count += 1
+            while not self.items:
+                self.condition.wait()
+            item = self.items.popleft()
+            if self.timers is not None:
+                self.timers.record('prefetch_wait', stage_timers.timer() - start_time)
+
+            if item[0] == 'close':
+                self.zip_files_ahead -= 1
+                self.condition.notify_all()
+                return None
+            name, file_size, data, error = item[1]
+            self.buffered_bytes -= len(data or '')
+            self.condition.notify_all()
+            return item[1]
+
+    def __iter__(self):
+        """
+          Generator over the zip files read, in order, as (path, zip file, error opening it), where each zip file must
+          be closed (or read to its end) before the next is taken
+        """
+
+        while True:
+            with self.condition:
+                while not self.items:
+                    self.condition.wait()
+                item = self.items.popleft()
+            if item[0] == 'end':
+                return
+
+            path, error = item[1:]
+            zipped_file = PrefetchedZipFile(self, path)
+            if error is not None:
+                zipped_file.close()
+                yield path, None, error
+            else:
+                yield path, zipped_file, None